@@ -1,7 +1,14 @@
-import os, shutil, signal, time, argparse, threading, json, re, anthropic
-from queue import Queue, Empty
-from subprocess import Popen, PIPE
+import os, sys, shutil, signal, time, argparse, threading, multiprocessing, json, re, hashlib, select, struct, tempfile, random, asyncio, bisect, shlex, resource, ctypes, ctypes.util, contextlib, urllib.request, urllib.error, sqlite3, difflib, math
+from queue import Queue, Empty, Full
+from subprocess import Popen, PIPE, run, DEVNULL, TimeoutExpired
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.managers import BaseManager, AcquirerProxy
 from dotenv import load_dotenv
+# the anthropic package is needed only by the anthropic backend (see create_llm_backend)
+try:
+    import anthropic
+except ImportError:
+    anthropic = None
 #from openai import OpenAI
 
 # --------------------------------------------------------- #
@@ -23,8 +30,134 @@ from dotenv import load_dotenv
 # --------------------------------------------------------- #
 
 
-TMP_FOLDER_ABS = "~/workshop/tmp"
+TMP_FOLDER_ABS = os.path.abspath("tmp")
 CONFIG_FILE_PATH = "afl_loop_config.json"
+CRASH_INDEX_FILE = "crash_index.json"
+OBJECT_CACHE_FOLDER = "object_cache"
+LLM_CACHE_FOLDER = "llm_cache"
+SOURCE_INDEX_FILE = "source_index.json"
+MINIMIZED_INPUTS_FOLDER = "minimized_inputs"
+STATE_DB_FILE = "state.db"
+CRASH_INPUTS_FOLDER = "crash_inputs"
+REGRESSION_CORPUS_FOLDER = "regression_corpus"
+COMPILE_COMMANDS_FILE = "compile_commands.json"
+COMPILER_SHIMS_FOLDER = "compiler_shims"
+
+# compilers that are replaced by a shim during the first build to capture the compilation database, see create_compiler_shims
+COMPILER_NAMES = ("cc", "c++", "gcc", "g++", "clang", "clang++", "afl-cc", "afl-c++", "afl-clang-fast", "afl-clang-fast++",
+                  "afl-clang-lto", "afl-clang-lto++", "afl-gcc", "afl-g++", "afl-gcc-fast", "afl-g++-fast")
+# the syntax check does not need the instrumentation, the AFL++ wrappers are replaced by the compiler they wrap (if installed)
+AFL_COMPILERS = {"afl-cc": "clang", "afl-c++": "clang++", "afl-clang-fast": "clang", "afl-clang-fast++": "clang++", "afl-clang-lto": "clang",
+                 "afl-clang-lto++": "clang++", "afl-gcc": "gcc", "afl-g++": "g++", "afl-gcc-fast": "gcc", "afl-g++-fast": "g++"}
+# the shim logs the working directory and the arguments of every compilation and runs the real compiler,
+# the one found in PATH without the shims folder
+COMPILER_SHIM = """#!{python}
+import os, sys, json, shutil
+shims_folder = os.path.dirname(os.path.abspath(__file__))
+search_path = os.pathsep.join(item for item in os.environ.get("PATH", "").split(os.pathsep) if os.path.abspath(item or ".") != shims_folder)
+compiler = shutil.which(os.path.basename(sys.argv[0]), path=search_path)
+if compiler is None:
+    sys.exit(f"{{os.path.basename(sys.argv[0])}}: command not found")
+with open(os.path.join(shims_folder, "commands.jsonl"), "a") as file:
+    file.write(json.dumps({{"directory": os.getcwd(), "arguments": [os.path.basename(sys.argv[0])] + sys.argv[1:]}}) + "\\n")
+os.environ["PATH"] = search_path
+os.execv(compiler, [compiler] + sys.argv[1:])
+"""
+# the compiler errors of a patch are added to the report sent with the next request, see add_compiler_diagnostics
+COMPILER_DIAGNOSTICS_HEADER = "The previous fix did not compile:"
+# the fixes of the last attempt are added to the report of the next request, see add_rejected_fix
+REJECTED_FIX_HEADER = "The following fix has been tried and rolled back, do not return it again:"
+
+# the secret used to connect to the orchestrator is passed in the environment, not on the command line
+COORDINATOR_KEY_VARIABLE = "AFL_LOOP_COORDINATOR_KEY"
+# when the script is run by the orchestrator the builds of all the targets share these slots (see connect_to_coordinator)
+BUILD_SLOTS = None
+
+# LLM model and prompts, the prompts are part of the key of the LLM cache
+# the model and the system prompt can be changed in the configuration file (llm_model, llm_system_prompt)
+LLM_MODEL = "claude-3-opus-20240229"
+LLM_TRANSCRIPT_FILE = "transcript.jsonl"
+SYSTEM_PROMPT = "Respond only in Yoda-speak."
+FIND_PROMPT = """Given this information in which files and functions should i look into to locate the bug? Return the results in a json format structured like the following example, without any additional comments.
+                [{
+                    "file": "example1.py",
+                    "function": "function1"
+                    "line": 10
+                }]"""
+FIX_PROMPT = "Given this information, provide a fix. Return just the fixed code for the whole function without any additional comments, only the code itself."
+# raw string: the example must keep the escaped newlines of a valid json string
+BATCH_FIX_PROMPT = r"""Given this information, provide a fix. Return the fixed code of each function that needs to be changed in a json format structured like the following example, without any additional comments. Each "code" must contain the whole function.
+                {"patches": [{
+                    "function": "function1",
+                    "code": "int function1(int a)\n{\n    return a;\n}"
+                }]}"""
+
+# build steps that are skipped when rebuilding the target after a fix, matched against the command word of every
+# step of a line (see get_rebuild_commands); cd, make and the compiler and linker steps are always kept
+CONFIGURE_COMMANDS = ("autogen.sh", "configure", "autoreconf", "autoconf", "automake", "aclocal", "libtoolize", "bootstrap", "bootstrap.sh",
+                      "buildconf", "buildconf.sh", "wget", "curl")
+# the subcommands of git and the targets of make that are skipped
+CONFIGURE_SUBCOMMANDS = {"git": ("clone",), "make": ("clean", "distclean")}
+# the separators of the steps of a line
+STEP_SEPARATOR_PATTERN = re.compile(r"(&&|;)")
+
+# files that are indexed by the source index, see build_source_index
+SOURCE_EXTENSIONS = (".c", ".h", ".cc", ".cpp", ".cxx", ".hh", ".hpp", ".hxx", ".inc")
+
+# exit code of the target when a sanitizer finds a bug, see get_sanitizer_environment
+SANITIZER_EXIT_CODE = 86
+SANITIZER_REPORT_PATTERN = re.compile(r"ERROR: \w+Sanitizer|WARNING: MemorySanitizer|runtime error:")
+
+# line added by run_program to the output of a target that does not terminate, see is_hang
+HANG_MESSAGE = "the target did not terminate in {} seconds"
+HANG_PATTERN = re.compile(r"\nthe target did not terminate in \d+ seconds\n$")
+
+# severity of the bug types, see get_crash_severity: the memory corruptions are the most valuable bugs to fix,
+# the bug types that are not listed (e.g. the UBSan ones) have DEFAULT_SEVERITY
+BUG_TYPE_SEVERITY = {
+    "heap-buffer-overflow": 1.0, "heap-use-after-free": 1.0, "double-free": 1.0, "stack-buffer-overflow": 1.0,
+    "dynamic-stack-buffer-overflow": 1.0, "global-buffer-overflow": 1.0, "stack-use-after-return": 1.0, "stack-use-after-scope": 1.0,
+    "container-overflow": 0.8, "bad-free": 0.8, "alloc-dealloc-mismatch": 0.6, "use-of-uninitialized-value": 0.6, "data-race": 0.5,
+    "SEGV": 0.5, "SIGSEGV": 0.5, "SIGBUS": 0.5, "stack-overflow": 0.4, "SIGABRT": 0.3, "memory-leak": 0.2, "SIGKILL": 0.1
+}
+DEFAULT_SEVERITY = 0.3
+
+# frames of a sanitizer report, e.g. "#1 0x4f3a2b in parse_record /src/harness.c:16:5" or "#3 0x7f01 in __libc_start_main (/lib/libc.so.6+0x29d90)",
+# and of a compacted report, e.g. "#1 parse_record src/harness.c:16"
+FRAME_PATTERN = re.compile(r"^\s*#(?P<index>\d+)\s+(?:0x[\da-f]+\s+)?(?:(?:in\s+)?(?P<function>.+?)\s+)?(?P<location>\S+)\s*$")
+SOURCE_LOCATION_PATTERN = re.compile(r"^(?P<file>[^\s()]+?):(?P<line>\d+)(?::\d+)?$")
+RUNTIME_FRAME_PATTERN = re.compile(r"^(__interceptor_|__asan|__sanitizer|__ubsan|__msan|__libc_start|_start$|__GI_)|compiler-rt/|sanitizer_common/")
+
+# tokens of C/C++ code used by the function index, see index_c_functions
+C_TOKEN_PATTERN = re.compile(r"""
+    (?P<comment>//[^\n]*|/\*.*?\*/)
+    |(?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+    |(?P<directive>^[ \t]*\#(?:\\\n|[^\n])*)
+    |(?P<identifier>~?[A-Za-z_]\w*)
+    |(?P<number>\.?\d[\w.]*)
+    |(?P<punctuation>::|[{}();=:])
+""", re.S | re.M | re.X)
+
+# identifiers followed by a parenthesis that are not function names
+NOT_FUNCTION_NAMES = {"if", "for", "while", "switch", "return", "sizeof", "defined", "__attribute__", "__declspec", "__asm__", "asm",
+                      "alignas", "_Alignas", "alignof", "_Alignof", "typeof", "__typeof__", "decltype", "noexcept", "throw",
+                      "_Static_assert", "static_assert"}
+
+# file path -> function index of the file, see get_function_index
+FUNCTION_INDEX = {}
+
+# source file -> object files built from it, see find_object_files
+OBJECT_FILES_CACHE = {}
+
+# inotify constants, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
 
 
 def parse_arguments():
@@ -34,6 +167,8 @@ def parse_arguments():
     Four arguments can be specified, default values are provided for all of them.
     The arguments collected are the path of the target application, the path of the file containing the instructions to build the target,
     the path of the file containing the instructions to run the target without the fuzzer and the path of the file containing the instructions to fuzz the target.
+    The options set by the orchestrator (see afl_orchestrator.py) are returned as last value: the cores the fuzzer is pinned to
+    and the address of the coordinator that shares the LLM budget and the build slots between the targets.
     """
 
     help = "AFL loop script\n -p: the path of the target application - where the executable is contained.\n  -b: the path to a file containing the instructions to build the target, one per line.\n  -r: the path to a file containing the instructions to run the target without the fuzzer, in the instructions a placeholder called INPUT must be included where the input filename should be passed or INPUT_STDIN if the harness reads from stdin.\n  e.g. ./xml_harness file.xml --> ./xml_harness INPUT\n  -f: the path to a file with the instructions to run the fuzzer targeting the application in question."
@@ -45,16 +180,23 @@ def parse_arguments():
     parser.add_argument("-b", default="build.txt", type=str)
     parser.add_argument("-r", default="run.txt", type=str)
     parser.add_argument("-f", default="fuzz.txt", type=str)
+    parser.add_argument("--fuzzer-cores", default="", type=str, help="comma separated list of the cores the fuzzer is pinned to")
+    parser.add_argument("--coordinator", default="", type=str, help="host:port of the orchestrator")
     args = parser.parse_args()
 
+    options = {
+        "fuzzer_cores": [int(core) for core in args.fuzzer_cores.split(',') if core.strip()],
+        "coordinator": args.coordinator
+    }
+
     print(f"path: ./{args.p}, \nbuild_instr: {args.b}, \nrun_instr: {args.r}, \nfuzz_instr: {args.f}")
-    return args.p, args.b, args.r, args.f
+    return args.p, args.b, args.r, args.f, options
 # --------------------------------------------------------- #
 
 
 
 
-def build_program(path, file_path):
+def build_program(path, file_path, environment=None):
     """
     This function builds the program following the instructions provided in the file.
     To do that, it opens a shell, changes directory to the target directory
@@ -66,295 +208,2697 @@ def build_program(path, file_path):
         cd ..
         AFL_USE_ASAN=1 afl-clang-fast ./harness.c -I libxml2/include libxml2/.libs/libxml2.a -lz -lm -o fuzzer
 
+    The commands are run with environment if provided (e.g. with the compiler shims in PATH, see create_compiler_shims).
     """
 
     print("building the target...", end='')
-    shell = Popen(["/bin/bash"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-
-    #move into the target directory
-    command = f"cd ./{path}"
-    shell.stdin.write((command + '\n').encode())
-    shell.stdin.flush()
 
     with open(f"{path}/{file_path}", 'r') as file:
         lines = file.readlines()
-    
-    for line in lines:
-        command = line.strip()
 
-        # Send the command to the shell
+    with METRICS.timer("build", path=path):
+        run_build_commands(path, lines, environment)
+    print(" - target compiled") 
+# --------------------------------------------------------- #
+
+
+
+def run_build_commands(path, lines, environment=None):
+    """
+    This function opens a shell, changes directory to the target directory,
+    writes the provided commands to the shell's stdin, executes them and waits for them to finish.
+    When the script is run by the orchestrator the commands are run only once a build slot is available.
+    """
+
+    with BUILD_SLOTS if BUILD_SLOTS is not None else contextlib.nullcontext():
+        shell = Popen(["/bin/bash"], stdin=PIPE, stdout=PIPE, stderr=PIPE, env=environment)
+
+        #move into the target directory
+        command = f"cd ./{path}"
         shell.stdin.write((command + '\n').encode())
         shell.stdin.flush()
 
-    # Wait for the command to finish
-    stdout, stderr = shell.communicate()
-    print(" - target compiled") 
+        for line in lines:
+            command = line.strip()
+
+            # Send the command to the shell
+            shell.stdin.write((command + '\n').encode())
+            shell.stdin.flush()
+
+        # Wait for the command to finish
+        stdout, stderr = shell.communicate()
     #print(stdout.decode())
 # --------------------------------------------------------- #
 
 
 
+def get_rebuild_commands(path, build_instr, rebuild_instr):
+    """
+    This function returns the commands used to rebuild the target after a fix has been applied.
+    If the user has provided a file with the rebuild instructions (rebuild_instr) it is used,
+    otherwise the build instructions are used without the configuration steps (autogen, configure, clean, ...)
+    so that make only recompiles the objects whose sources have changed and relinks the target.
+    """
+
+    if rebuild_instr and os.path.exists(f"{path}/{rebuild_instr}"):
+        with open(f"{path}/{rebuild_instr}", 'r') as file:
+            return file.readlines()
+
+    with open(f"{path}/{build_instr}", 'r') as file:
+        lines = file.readlines()
+
+    commands = []
+    for line in lines:
+        line = remove_configure_steps(line.rstrip('\n'))
+        if line.strip():
+            commands.append(f"{line}\n")
+    return commands
+# --------------------------------------------------------- #
+
+
+
+def remove_configure_steps(line):
+    """
+    This function removes the configuration steps from a line of the build instructions.
+    The line is split in steps on "&&" and ";" and a step is removed if its command word, after the VAR=value assignments,
+    is one of CONFIGURE_COMMANDS (e.g. "./configure --disable-shared") or one of CONFIGURE_SUBCOMMANDS (e.g. "make clean");
+    only the command word is matched, so "cd curl" or "-Icurl/include" are kept.
+    The clean targets are removed from a make step that has other targets as well (e.g. "make clean all").
+    """
+
+    parts = STEP_SEPARATOR_PATTERN.split(line)
+    steps = []
+    for i in range(0, len(parts), 2):
+        step = parts[i]
+        try:
+            words = shlex.split(step)
+        except ValueError:
+            words = step.split()
+        assignments = 0
+        while assignments < len(words) and re.match(r"^\w+=", words[assignments]):
+            assignments += 1
+        if assignments == len(words):
+            steps.append((parts[i - 1] if i > 0 else None, step))
+            continue
+
+        command = os.path.basename(words[assignments])
+        arguments = words[assignments + 1:]
+        if command in CONFIGURE_COMMANDS:
+            continue
+        skipped = CONFIGURE_SUBCOMMANDS.get(command, ())
+        if any(word in skipped for word in arguments):
+            targets = [word for word in arguments if not word.startswith('-')]
+            if command != "make" or all(word in skipped for word in targets):
+                continue
+            step = ' '.join(shlex.quote(word) for word in words if word not in skipped)
+        steps.append((parts[i - 1] if i > 0 else None, step))
+
+    # the first remaining step loses its separator, the others keep the one they had
+    result = ''
+    for separator, step in steps:
+        result += f"{separator}{step}" if result else step.lstrip()
+    return result if result.strip() else ''
+# --------------------------------------------------------- #
+
+
+
+def find_object_files(source_file, search_path):
+    """
+    This function returns the object files built from a source file.
+    It looks for the objects in the directory of the source file and in its .libs folder (libtool),
+    it handles the "foo.o", "prefix-foo.o" (automake) and "foo.c.o" (cmake) names.
+    If nothing is found there the whole target tree is searched for a "foo.c.o" object (cmake out of tree builds).
+    The result is kept in memory since the objects of a source file do not move between builds.
+    """
+
+    if OBJECT_FILES_CACHE.get(source_file):
+        return OBJECT_FILES_CACHE[source_file]
+
+    directory = os.path.dirname(source_file) or '.'
+    basename = os.path.basename(source_file)
+    stem = os.path.splitext(basename)[0]
+    names = (f"{stem}.o", f"{stem}.lo", f"{basename}.o")
+
+    objects = []
+    for folder in (directory, f"{directory}/.libs"):
+        if not os.path.isdir(folder):
+            continue
+        for item in os.listdir(folder):
+            if item in names or item.endswith((f"-{stem}.o", f"-{stem}.lo")):
+                objects.append(f"{folder}/{item}")
+
+    if not objects:
+        for root, _, files in os.walk(search_path):
+            if f"{basename}.o" in files:
+                objects.append(os.path.join(root, f"{basename}.o"))
+
+    OBJECT_FILES_CACHE[source_file] = objects
+    return objects
+# --------------------------------------------------------- #
+
+
+
+def get_source_hash(source_file):
+    """
+    This function returns the hash of the content of a source file, it is the key of the object cache.
+    """
+
+    with open(source_file, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+# --------------------------------------------------------- #
+
+
+
+def restore_cached_objects(source_file, object_cache_path):
+    """
+    This function restores the objects built from the current content of a source file, if they are in the cache.
+    The objects are made newer than the source so that make does not compile them again.
+    It returns True if the objects have been restored.
+    """
+
+    cache_folder = f"{object_cache_path}/{get_source_hash(source_file)}"
+    if not os.path.isdir(cache_folder):
+        return False
+
+    with open(f"{cache_folder}/objects.json", 'r') as file:
+        objects = json.load(file)
+
+    directory = os.path.dirname(source_file) or '.'
+    timestamp = max(time.time(), os.path.getmtime(source_file) + 1)
+    for object_file, cached_name in objects.items():
+        object_file = os.path.normpath(f"{directory}/{object_file}")
+        shutil.copyfile(f"{cache_folder}/{cached_name}", object_file)
+        os.utime(object_file, (timestamp, timestamp))
+    return True
+# --------------------------------------------------------- #
+
+
+
+def store_objects_in_cache(source_file, search_path, object_cache_path):
+    """
+    This function stores in the cache the objects built from the current content of a source file.
+    """
+
+    objects = [item for item in find_object_files(source_file, search_path) if os.path.exists(item)]
+    if not objects:
+        return
+
+    cache_folder = f"{object_cache_path}/{get_source_hash(source_file)}"
+    if os.path.isdir(cache_folder):
+        return
+    # the cache can be shared by several worktrees, each one writes in its own folder before moving it in place
+    tmp_folder = f"{cache_folder}.{os.getpid()}.tmp"
+    os.makedirs(tmp_folder, exist_ok=True)
+
+    # the objects are stored relative to the source file so that the cache can be used from any copy of the target tree
+    directory = os.path.dirname(source_file) or '.'
+    cached_objects = {}
+    for i, object_file in enumerate(objects):
+        cached_name = f"{i}_{os.path.basename(object_file)}"
+        shutil.copyfile(object_file, f"{tmp_folder}/{cached_name}")
+        cached_objects[os.path.relpath(object_file, directory)] = cached_name
+
+    with open(f"{tmp_folder}/objects.json", 'w') as file:
+        json.dump(cached_objects, file)
+    try:
+        os.replace(tmp_folder, cache_folder)
+    except OSError:
+        # another worktree has stored the same objects in the meantime
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+# --------------------------------------------------------- #
+
+
+
+def rebuild_program(path, build_instr, rebuild_instr, touched_files, object_cache_path):
+    """
+    This function rebuilds the program after a fix has been applied to the files in touched_files.
+    Instead of running the whole build script again it runs only the rebuild commands (see get_rebuild_commands),
+    so that only the objects of the modified files are compiled and the target is relinked.
+    The objects are cached by the hash of the content of their source file: if a file goes back to a content
+    that has already been compiled (e.g. a fix is reverted) its objects are restored from the cache instead of compiled again.
+    """
+
+    print("rebuilding the target...", end='')
+
+    with METRICS.timer("rebuild", path=path, files=len(touched_files)) as fields:
+        restored = [source_file for source_file in touched_files if restore_cached_objects(source_file, object_cache_path)]
+        if restored:
+            print(f" (objects restored from cache for {', '.join(restored)})", end='')
+        fields["restored_files"] = len(restored)
+
+        run_build_commands(path, get_rebuild_commands(path, build_instr, rebuild_instr))
+
+        for source_file in touched_files:
+            store_objects_in_cache(source_file, path, object_cache_path)
+    print(" - target compiled")
+# --------------------------------------------------------- #
+
+
+
+def create_compiler_shims(shims_path):
+    """
+    This function creates a shim for every compiler in COMPILER_NAMES (see COMPILER_SHIM) and returns the environment
+    of the build with the shims first in PATH, so that the compilations of the first build are captured without
+    any change to the build script. The captured commands are turned into a compilation database by save_compile_commands.
+    """
+
+    os.makedirs(shims_path, exist_ok=True)
+    shims_path = os.path.abspath(shims_path)
+    for name in COMPILER_NAMES:
+        with open(f"{shims_path}/{name}", 'w') as file:
+            file.write(COMPILER_SHIM.format(python=sys.executable))
+        os.chmod(f"{shims_path}/{name}", 0o755)
+
+    environment = dict(os.environ)
+    environment["PATH"] = os.pathsep.join([shims_path, environment.get("PATH", "")])
+    return environment
+# --------------------------------------------------------- #
+
+
+
+def save_compile_commands(shims_path, file_path):
+    """
+    This function turns the compilations captured by the compiler shims into a compilation database (compile_commands.json format).
+    Only the compilations of a single source file are kept, the last one for every file (e.g. make after the configure tests).
+    It returns the number of files in the database.
+    """
+
+    commands_path = f"{shims_path}/commands.jsonl"
+    if not os.path.exists(commands_path):
+        return 0
+
+    entries = {}
+    with open(commands_path, 'r') as file:
+        for line in file:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue
+            sources = [argument for argument in item["arguments"][1:] if argument.endswith(SOURCE_EXTENSIONS) and not argument.endswith((".h", ".hh", ".hpp", ".hxx", ".inc"))]
+            if len(sources) != 1 or "-c" not in item["arguments"]:
+                continue
+            source_file = os.path.normpath(os.path.join(item["directory"], sources[0]))
+            entries[source_file] = {"directory": item["directory"], "arguments": item["arguments"], "file": source_file}
+
+    # nothing has been compiled (e.g. the tree was already built), the database is captured again at the next run
+    if not entries:
+        return 0
+    with open(file_path, 'w') as file:
+        json.dump(list(entries.values()), file, indent=2)
+    return len(entries)
+# --------------------------------------------------------- #
+
+
+
+def load_compilation_database(path, file_paths):
+    """
+    This function loads the first compilation database found in file_paths (e.g. the compile_commands.json of the target
+    or the one captured during the first build) and returns it as a dictionary from the source files, relative to the target tree,
+    to their working directory (relative to the target tree if inside it) and arguments.
+    The files that do not exist anymore (e.g. the tests of configure) are skipped. It returns None if there is no database.
+    """
+
+    absolute_path = os.path.abspath(path)
+    for file_path in file_paths:
+        if not os.path.exists(file_path):
+            continue
+        with open(file_path, 'r') as file:
+            entries = json.load(file)
+
+        compilation_database = {}
+        for entry in entries:
+            directory = entry["directory"]
+            source_file = os.path.normpath(os.path.join(directory, entry["file"]))
+            if not source_file.startswith(f"{absolute_path}/") or not os.path.exists(source_file):
+                continue
+            if directory == absolute_path or directory.startswith(f"{absolute_path}/"):
+                directory = os.path.relpath(directory, absolute_path)
+            compilation_database[os.path.relpath(source_file, absolute_path)] = {
+                "directory": directory,
+                "arguments": entry["arguments"] if "arguments" in entry else shlex.split(entry["command"]),
+                "file": source_file
+            }
+        print(f"compilation database {file_path}: {len(compilation_database)} files")
+        return compilation_database
+
+    return None
+# --------------------------------------------------------- #
+
+
+
+def get_syntax_check_arguments(arguments, directory, source_files, patched_file):
+    """
+    This function turns the arguments of a compilation run in directory into a syntax check of patched_file:
+    the source file (any of source_files, absolute paths) is replaced by patched_file,
+    the output and the dependency files are dropped, -fsyntax-only and -w (only the errors are reported) are added
+    and the AFL++ compiler wrappers are replaced by the compiler they wrap.
+    """
+
+    compiler = AFL_COMPILERS.get(os.path.basename(arguments[0]))
+    result = [compiler if compiler is not None and shutil.which(compiler) else arguments[0]]
+
+    skip = False
+    for argument in arguments[1:]:
+        if skip:
+            skip = False
+        elif argument in ("-o", "-MF", "-MT", "-MQ"):
+            skip = True
+        elif argument in ("-c", "-MD", "-MMD", "-MP", "-M", "-MM") or argument.startswith(("-o", "-MF")):
+            continue
+        elif not argument.startswith('-') and os.path.normpath(os.path.join(directory, argument)) in source_files:
+            result.append(patched_file)
+        else:
+            result.append(argument)
+
+    return result + ["-fsyntax-only", "-w"]
+# --------------------------------------------------------- #
+
+
+
+def check_syntax(compilation_database, touched_files, tree_path, timeout=60):
+    """
+    This function compiles the patched files with -fsyntax-only and the flags of the compilation database, before the build.
+    The files are compiled in the tree they have been patched in (the target tree, the repair snapshot or a worktree).
+    It returns the errors of the compiler, with the paths relative to the tree, or None if every file compiles
+    (the files that are not in the database are not checked).
+    """
+
+    diagnostics = []
+    absolute_tree_path = os.path.abspath(tree_path)
+    for file_path in sorted(touched_files):
+        entry = compilation_database.get(os.path.relpath(file_path, tree_path))
+        if entry is None:
+            continue
+
+        directory = entry["directory"] if os.path.isabs(entry["directory"]) else os.path.join(absolute_tree_path, entry["directory"])
+        patched_file = os.path.abspath(file_path)
+        arguments = get_syntax_check_arguments(entry["arguments"], directory, (entry["file"], patched_file), patched_file)
+        if patched_file not in arguments:
+            continue
+        try:
+            result = run(arguments, cwd=directory, stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE, timeout=timeout)
+        except (OSError, TimeoutExpired) as e:
+            print(f"could not check the syntax of {file_path}: {e}")
+            continue
+        if result.returncode != 0:
+            diagnostics.append(result.stderr.decode("utf-8", errors="ignore").replace(f"{absolute_tree_path}/", '').strip())
+
+    return '\n'.join(diagnostics) if diagnostics else None
+# --------------------------------------------------------- #
+
+
+
+def add_compiler_diagnostics(report, diagnostics):
+    """
+    This function adds the compiler errors of the last patch to the report sent to the LLM,
+    replacing the ones of a previous patch.
+    """
+
+    report = report.split(COMPILER_DIAGNOSTICS_HEADER)[0].rstrip('\n')
+    diagnostics = diagnostics.split(COMPILER_DIAGNOSTICS_HEADER)[-1].strip('\n')
+    return f"{report}\n{COMPILER_DIAGNOSTICS_HEADER}\n{diagnostics}"
+# --------------------------------------------------------- #
+
+
+
  
-def fuzz_program(path, file_path, event, absolute_tmp_path):
+def fuzz_program(path, file_path, event, absolute_tmp_path, cores=None, instances=1):
     """
     This function starts the fuzzer with the target application following the instructions provided.
     The function opens a shell changes directory to the target directory, reads the instructions from the provided file
     and writes them to the shell starting the fuzzer.
     Contestually, it writes the PID of the fuzzer to a file in the tmp folder and sends to the main thread a signal that the fuzzer has started.
+    If cores are provided the shell, and so the fuzzer, is pinned to them and AFL does not look for a free core on its own;
+    with several instances (see get_fuzzer_commands) each one is pinned to a different core, as long as there are enough of them.
     """
 
 
     print("starting fuzzer...", end='')
-    shell = Popen(["/bin/bash"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    if cores:
+        environment = dict(os.environ, AFL_NO_AFFINITY="1")
+        shell = Popen(["/bin/bash"], stdin=PIPE, stdout=PIPE, stderr=PIPE, env=environment, preexec_fn=lambda: os.sched_setaffinity(0, cores))
+    else:
+        shell = Popen(["/bin/bash"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+
+    # the PID file is emptied before the event is set, so that the PIDs of a previous launch are never read
+    open(f"{absolute_tmp_path}/process.pid", 'w').close()
 
     #move into the target directory
     shell.stdin.write((f"cd ./{path}\n").encode())
     shell.stdin.flush()
+
+    # Send the commands to the shell, the PID of every instance is appended to the file
+    for i, (_, command) in enumerate(get_fuzzer_commands(path, file_path, instances)):
+        if cores and instances > 1:
+            command = f"taskset -c {cores[i % len(cores)]} {command}"
+        shell.stdin.write((f"{command} & echo $! >> {absolute_tmp_path}/process.pid" + '\n').encode())
+    shell.stdin.flush()
+    event.set() # signal the main thread that we are starting the fuzzer
+
+    stdout, stderr = shell.communicate()
+# --------------------------------------------------------- #
+
+
+
+
+def get_fuzzer_commands(path, fuzz_instr, instances):
+    """
+    This function returns the names of the output folders of the fuzzer instances and the commands that start them.
+    If the file contains several commands (e.g. written by hand with AFL++ -M/-S options) each one is an instance.
+    Otherwise, with more than one instance, the single command is run in AFL++ parallel mode: the first instance
+    is the main one ("-M main") and the others are secondary ("-S secondary_N"), all sharing the same output folder.
+    The output folder of an instance is named after its -M/-S option, "default" if there is none.
+    """
+
+    with open(f"{path}/{fuzz_instr}", 'r') as file:
+        commands = [line.strip() for line in file if line.strip()]
+
+    if len(commands) == 1 and instances > 1:
+        command = re.sub(r"\s-[MS]\s+\S+", "", commands[0])
+        commands = [re.sub(r"(-o\s+\S+)", rf"\1 -{'M main' if i == 0 else f'S secondary_{i}'}", command, count=1) for i in range(instances)]
+
+    result = []
+    for command in commands:
+        name = re.search(r"\s-[MS]\s+(\S+)", command)
+        result.append((name.group(1) if name else "default", command))
+    return result
+# --------------------------------------------------------- #
+
+
+
+def stop_fuzzers(fuzzer_pids):
+    """
+    This function stops all the fuzzer instances, the ones that have already exited are ignored.
+    """
+
+    for pid in fuzzer_pids:
+        try:
+            os.kill(pid, signal.SIGINT)
+        except ProcessLookupError:
+            pass
+# --------------------------------------------------------- #
+
+
+
+def run_program(path, file_path, faulty_input_filename, timeout=60, memory_limit_mb=0, max_output_bytes=1024 * 1024, summary_grace=None):
+    """
+    This function runs the target application following the instructions provided,
+    its purpose is to run the application without the fuzzer with the bug-inducing input.
+
+    To do this, we need to fetch the user-provided instructions and substitute the placeholder "INPUT"
+    with the filename of the bug-inducing input; with "INPUT_STDIN" the content of the bug-inducing input
+    is fed to the standard input of the target.
+
+    The target is executed directly, without a shell, unless the instructions use shell features (pipes, redirections, ...).
+    It is killed if it runs for more than timeout seconds, its address space can be limited to memory_limit_mb
+    (0 means no limit, ASAN needs a huge address space) and only max_output_bytes of its stderr are kept (the beginning and the end).
+    The target is considered crashing if it is killed by a signal, if it exits with the sanitizer exit code
+    or if a sanitizer report is found in stderr; a target that does not terminate is considered crashing as well,
+    unless it has printed a sanitizer report a line is added to stderr so that the hang can be told apart (see is_hang).
+    stderr is parsed while it is read (see SanitizerReportParser), if summary_grace is not None the target is killed
+    summary_grace seconds after the SUMMARY line of the report if it has not exited yet, the rest of the report is not needed.
+    If the target is killed by a signal without any sanitizer report, a line with the signal is added to stderr.
+
+    Then, the function returns if the target is crashing and the content of stderr
+    """
+
     with open(f"{path}/{file_path}", 'r') as file:
         command = file.readline().strip()
 
-    # Send the command to the shell
-    shell.stdin.write((f"{command} & echo $! > {absolute_tmp_path}/process.pid" + '\n').encode())
-    shell.stdin.flush()
-    event.set() # signal the main thread that we are starting the fuzzer
+    stdin_file = DEVNULL
+    if "INPUT_STDIN" in command:
+        stdin_file = open(f"{path}/{faulty_input_filename}", 'rb')
+        command = command.replace("INPUT_STDIN", "")
+    else:
+        command = command.replace("INPUT", faulty_input_filename)
+
+    print(f"running: {command}")
+
+    arguments, environment = parse_run_command(command)
+    shell = arguments is None
+    if shell:
+        arguments = ["/bin/bash", "-c", command]
+
+    def limit_resources():
+        # no core dumps, they would only slow down the crash
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+        if memory_limit_mb:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit_mb * 1024 * 1024, memory_limit_mb * 1024 * 1024))
+
+    try:
+        process = Popen(arguments, cwd=path, env=get_sanitizer_environment(environment), stdin=stdin_file, stdout=DEVNULL, stderr=PIPE,
+                        preexec_fn=limit_resources, start_new_session=True)
+    except OSError as e:
+        print(f"could not run the target: {e}")
+        return False, ''
+    finally:
+        if stdin_file is not DEVNULL:
+            stdin_file.close()
+
+    output = BoundedOutput(max_output_bytes)
+    parser = SanitizerReportParser()
+    reader = threading.Thread(target=output.read_from, args=(process.stderr, parser))
+    reader.start()
+
+    timed_out = False
+    stopped_after_summary = False
+    deadline = time.monotonic() + timeout
+    try:
+        if summary_grace is not None and parser.finished.wait(timeout) and parser.summary:
+            try:
+                returncode = process.wait(timeout=min(summary_grace, max(0, deadline - time.monotonic())))
+            except TimeoutExpired:
+                stopped_after_summary = True
+                os.killpg(process.pid, signal.SIGKILL)
+                returncode = process.wait()
+        else:
+            returncode = process.wait(timeout=max(0, deadline - time.monotonic()))
+    except TimeoutExpired:
+        timed_out = True
+        os.killpg(process.pid, signal.SIGKILL)
+        returncode = process.wait()
+    reader.join()
+    stderr = output.getvalue().decode("utf-8", errors="ignore")
+
+    # a shell reports the death of its child by a signal as 128 + signal number
+    killed_by_signal = returncode < 0 or (shell and returncode > 128)
+    if stopped_after_summary:
+        print("the target has been stopped after the sanitizer report")
+    elif killed_by_signal and parser.sanitizer is None:
+        signal_number = -returncode if returncode < 0 else returncode - 128
+        try:
+            signal_name = signal.Signals(signal_number).name
+        except ValueError:
+            signal_name = str(signal_number)
+        stderr += f"\nthe target has been killed by signal {signal_name}\n"
+
+    if timed_out and parser.sanitizer is None:
+        print(f"the target did not terminate in {timeout} seconds")
+        return True, stderr + f"\n{HANG_MESSAGE.format(timeout)}\n"
+    elif timed_out:
+        print(f"the target did not terminate in {timeout} seconds after the sanitizer report")
+        return True, stderr
+    elif killed_by_signal or returncode == SANITIZER_EXIT_CODE or parser.sanitizer is not None:
+        print("the target is crashing")
+        return True, stderr
+    else:
+        print("the target is not crashing")
+        return False, ''
+# --------------------------------------------------------- #
+
+
+
+def is_hang(report):
+    """
+    This function checks if a report returned by run_program is the one of a target that did not terminate
+    without crashing: it has no stack to locate the bug, so the function-repair loop cannot do anything with it.
+    """
+
+    return HANG_PATTERN.search(report) is not None
+# --------------------------------------------------------- #
+
+
+
+def parse_run_command(command):
+    """
+    This function splits the command used to run the target into its arguments and the environment variables
+    assigned before it (e.g. "ASAN_OPTIONS=detect_leaks=0 ./harness file").
+    It returns None as arguments if the command needs a shell (pipes, redirections, variables, ...).
+    """
+
+    if re.search(r"[|&;<>$`(){}*?]", command):
+        return None, {}
+
+    try:
+        tokens = shlex.split(command)
+    except ValueError:
+        return None, {}
+
+    environment = {}
+    while tokens and re.match(r"^[A-Za-z_]\w*=", tokens[0]):
+        key, value = tokens.pop(0).split('=', 1)
+        environment[key] = value
+
+    if not tokens:
+        return None, {}
+    return tokens, environment
+# --------------------------------------------------------- #
+
+
+
+def get_sanitizer_environment(environment):
+    """
+    This function returns the environment of the target: the current environment with the variables assigned in the run
+    instructions, where the sanitizers are told to exit with SANITIZER_EXIT_CODE (unless the user has chosen an exit code)
+    and UBSan to print the stack and the summary of the bug.
+    """
+
+    result = dict(os.environ)
+    result.update(environment)
+    for variable in ("ASAN_OPTIONS", "UBSAN_OPTIONS", "MSAN_OPTIONS", "LSAN_OPTIONS"):
+        options = result.get(variable, "")
+        if "exitcode=" not in options:
+            result[variable] = f"{options}:exitcode={SANITIZER_EXIT_CODE}" if options else f"exitcode={SANITIZER_EXIT_CODE}"
+    # UBSan prints only the location of the bug, unless it is asked for the stack and the SUMMARY line (see SanitizerReportParser)
+    for option in ("print_stacktrace", "print_summary"):
+        if f"{option}=" not in result["UBSAN_OPTIONS"]:
+            result["UBSAN_OPTIONS"] += f":{option}=1"
+    return result
+# --------------------------------------------------------- #
+
+
+
+class BoundedOutput:
+    """
+    This class collects the output of the target keeping at most max_bytes of it: the first 3/4 and the last 1/4,
+    the part in between is dropped. The beginning contains the sanitizer report, the end its summary.
+    """
+
+    def __init__(self, max_bytes):
+        self.head_size = max_bytes * 3 // 4
+        self.tail_size = max_bytes - self.head_size
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.dropped = 0
+
+
+    def write(self, data):
+        if len(self.head) < self.head_size:
+            taken = data[: self.head_size - len(self.head)]
+            self.head += taken
+            data = data[len(taken):]
+        if data:
+            self.tail += data
+            if len(self.tail) > self.tail_size:
+                self.dropped += len(self.tail) - self.tail_size
+                del self.tail[: len(self.tail) - self.tail_size]
+
+
+    def read_from(self, stream, parser=None):
+        # the parser sees the whole output, also the part that is dropped
+        for data in iter(lambda: stream.read1(64 * 1024), b''):
+            self.write(data)
+            if parser is not None:
+                parser.feed(data)
+        stream.close()
+        if parser is not None:
+            parser.close()
+
+
+    def getvalue(self):
+        if self.dropped:
+            return bytes(self.head) + f"\n... {self.dropped} bytes dropped ...\n".encode() + bytes(self.tail)
+        return bytes(self.head + self.tail)
+# --------------------------------------------------------- #
+
+
+
+
+class SanitizerReportParser:
+    """
+    This class parses the stderr of the target while it is being read, line by line.
+    It classifies the report (sanitizer, bug type, kind of access and faulting address) of AddressSanitizer, MemorySanitizer, LeakSanitizer, ThreadSanitizer
+    and UndefinedBehaviorSanitizer, and of a target killed by a signal without any sanitizer (see run_program), and it collects
+    the frames of the crash stack and of the allocation and free stacks.
+    Only the first report is parsed. finished is set once the SUMMARY line of the report has been read or stderr has been closed,
+    so that run_program does not have to wait for the target to exit (e.g. leak checking or a slow shutdown).
+    """
+
+    HEADER_PATTERN = re.compile(r"(?:ERROR|WARNING): (?P<sanitizer>\w+Sanitizer): (?P<bug_type>[\w-]+)")
+    UBSAN_PATTERN = re.compile(r"^(?P<location>\S+:\d+(?::\d+)?): runtime error: (?P<message>.*)")
+    SUMMARY_PATTERN = re.compile(r"^SUMMARY: (?P<sanitizer>\w+Sanitizer)(?::\s*(?P<bug_type>[\w-]+))?")
+    SIGNAL_PATTERN = re.compile(r"^the target has been killed by signal (?P<signal>\w+)")
+    ADDRESS_PATTERN = re.compile(r"on (?:unknown )?address (?P<address>0x[\da-fA-F]+)")
+    # e.g. "WRITE of size 4 at 0x602000000014 thread T0" or "The signal is caused by a READ memory access."
+    ACCESS_PATTERN = re.compile(r"\b(?P<access>READ|WRITE) (?:of size|memory access)")
+    # stacks that follow the crash stack, e.g. "freed by thread T0 here:" or "previously allocated by thread T0 here:"
+    STACK_PATTERNS = (
+        (re.compile(r"^freed by thread"), "free"),
+        (re.compile(r"^(?:previously )?allocated by thread|^Uninitialized value was created by"), "allocation"),
+        (re.compile(r"^(?:Direct|Indirect) leak of"), "crash")
+    )
+    # UBSan reports a message instead of a bug type, e.g. "signed integer overflow: 2147483647 + 1 cannot be represented in type 'int'"
+    UBSAN_BUG_TYPES = (
+        ("signed integer overflow", "signed-integer-overflow"),
+        ("unsigned integer overflow", "unsigned-integer-overflow"),
+        ("shift exponent", "shift-exponent"),
+        ("left shift", "shift-base"),
+        ("division by zero", "division-by-zero"),
+        ("null pointer", "null-pointer-use"),
+        ("misaligned address", "misaligned-pointer-use"),
+        ("out of bounds for type", "out-of-bounds-index"),
+        ("pointer overflow", "pointer-overflow"),
+        ("is outside the range of representable values", "float-cast-overflow"),
+        ("load of value", "invalid-value-load"),
+        ("unreachable", "unreachable")
+    )
+
+    def __init__(self):
+        self.sanitizer = None
+        self.bug_type = None
+        self.access = None
+        self.address = None
+        self.stacks = {"crash": [], "allocation": [], "free": []}
+        self.current_stack = None
+        self.summary = False
+        self.finished = threading.Event()
+        self.partial_line = b''
+
+
+    def feed(self, data):
+        lines = (self.partial_line + data).split(b'\n')
+        self.partial_line = lines.pop()
+        for line in lines:
+            self.parse_line(line.decode("utf-8", errors="ignore"))
+
+
+    def close(self):
+        if self.partial_line:
+            self.parse_line(self.partial_line.decode("utf-8", errors="ignore"))
+            self.partial_line = b''
+        self.finished.set()
+
+
+    def parse_line(self, line):
+        if self.summary:
+            return
+        line = re.sub(r"^==\d+==\s*", "", line.rstrip())
+
+        match = FRAME_PATTERN.match(line)
+        if match is not None:
+            if self.current_stack is not None:
+                self.stacks[self.current_stack].append(match.groupdict())
+            return
+        # a stack ends at the first line that is not a frame
+        if self.current_stack is not None and self.stacks[self.current_stack]:
+            self.current_stack = None
+
+        match = self.SUMMARY_PATTERN.match(line)
+        if match is not None:
+            if self.sanitizer is None:
+                self.sanitizer, self.bug_type = match.group("sanitizer"), match.group("bug_type") or "unknown"
+            self.summary = True
+            self.finished.set()
+            return
+
+        if self.sanitizer is None:
+            self.parse_header(line)
+            return
+
+        match = self.ACCESS_PATTERN.search(line)
+        if match is not None and self.access is None:
+            self.access = match.group("access")
+            return
+
+        for pattern, stack in self.STACK_PATTERNS:
+            # only the first stack of every kind is kept, e.g. the first leak
+            if pattern.search(line) and not self.stacks[stack]:
+                self.current_stack = stack
+                return
+
+
+    def parse_header(self, line):
+        match = self.HEADER_PATTERN.search(line)
+        if match is not None:
+            self.sanitizer, self.bug_type = match.group("sanitizer"), match.group("bug_type")
+            address = self.ADDRESS_PATTERN.search(line)
+            if address is not None:
+                self.address = int(address.group("address"), 16)
+            # LeakSanitizer reports "detected memory leaks", the stack follows the first "Direct leak of ..." line
+            if self.sanitizer == "LeakSanitizer":
+                self.bug_type = "memory-leak"
+            else:
+                self.current_stack = "crash"
+            return
+
+        match = self.UBSAN_PATTERN.match(line)
+        if match is not None:
+            self.sanitizer = "UndefinedBehaviorSanitizer"
+            message = match.group("message")
+            self.bug_type = next((bug_type for text, bug_type in self.UBSAN_BUG_TYPES if text in message), "undefined-behavior")
+            self.current_stack = "crash"
+            return
+
+        match = self.SIGNAL_PATTERN.match(line)
+        if match is not None:
+            self.sanitizer, self.bug_type = "signal", match.group("signal")
+
+
+    def get_frames(self, stack="crash"):
+        """
+        This method returns the frames of a stack that have a source location, without the frames of the sanitizer runtime,
+        as dictionaries containing the file, function and line.
+        """
+
+        frames = []
+        for frame in self.stacks[stack]:
+            function_name = frame["function"] or ''
+            source = SOURCE_LOCATION_PATTERN.match(frame["location"])
+            if source is None or not function_name or RUNTIME_FRAME_PATTERN.search(function_name) or RUNTIME_FRAME_PATTERN.search(frame["location"]):
+                continue
+            frames.append({"file": source.group("file"), "function": function_name, "line": source.group("line")})
+        return frames
+# --------------------------------------------------------- #
+
+
+
+def parse_sanitizer_report(report):
+    """
+    This function parses a whole report with a SanitizerReportParser and returns the parser.
+    """
+
+    parser = SanitizerReportParser()
+    parser.feed(report.encode("utf-8", errors="ignore"))
+    parser.close()
+    return parser
+# --------------------------------------------------------- #
+
+
+
+def monitor_folder(path, queue, stop_event, backend="auto", prefix="", handled_files=None):
+    """
+    This function monitors the folder containing the output (the bug-inducing inputs) of the fuzzer.
+    The fuzzer will add a new file everytime the target application crashes, therefore we monitor the
+    folder to detect when and with which input the target application crashes. 
+    Once a new file(s) is added we store them in a queue so that the another thread can access them.
+
+    Two backends are available: "inotify", which reacts to the kernel notifications as soon as the fuzzer
+    closes a new file, and "polling", which lists the folder once a second.
+    With "auto" inotify is used when available and polling otherwise.
+    The filenames are added to the queue preceded by prefix (e.g. the crashes folder of an AFL++ instance).
+    The files already in the folder when the monitor starts are not new, if handled_files (the set of the prefixed filenames
+    that have been handled, see StateStore) is provided the ones that are not in it are added to the queue as well.
+    """
+
+    if backend in ("auto", "inotify"):
+        libc = load_inotify()
+        if libc is not None:
+            monitor_folder_inotify(libc, path, queue, stop_event, prefix, handled_files)
+            return
+        print("inotify is not available, falling back to polling")
+
+    monitor_folder_polling(path, queue, stop_event, prefix, handled_files)
+# --------------------------------------------------------- #
+
+
+
+           
+def load_inotify():
+    """
+    This function loads the inotify functions from the C library.
+    It returns the library handle or None if inotify is not available (e.g. not on Linux).
+    """
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+# --------------------------------------------------------- #
+
+
+
+def wait_for_folder(path, stop_event):
+    """
+    This function waits until the folder exists, the fuzzer creates the crashes folder only after it has started
+    and recreates it when it is restarted.
+    It returns False if the stop event has been set in the meantime.
+    """
+
+    while not os.path.isdir(path):
+        if stop_event.wait(1):
+            return False
+    return True
+# --------------------------------------------------------- #
+
+
+
+def monitor_folder_inotify(libc, path, queue, stop_event, prefix="", handled_files=None):
+    """
+    This function monitors the crashes folder using inotify.
+    A file is added to the queue only once the fuzzer has closed it (IN_CLOSE_WRITE) or moved it into the folder (IN_MOVED_TO),
+    so partially written files are never picked up.
+    If the folder is deleted or moved (e.g. the fuzzer has been restarted) we wait for it to be recreated and watch it again,
+    in that case all the files in the new folder are considered new.
+    If the event queue of the kernel overflows (IN_Q_OVERFLOW) the events of some files are lost: the folder is listed
+    once a second like the polling watcher does (see list_stable_files) until the files found have been queued.
+    """
+
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        print(f"inotify_init1 failed ({os.strerror(ctypes.get_errno())}), falling back to polling")
+        monitor_folder_polling(path, queue, stop_event, prefix, handled_files)
+        return
+
+    # the files already present when we start monitoring are not new
+    first_watch = True
+    files_set = set()
+
+    try:
+        while not stop_event.is_set():
+            if not wait_for_folder(path, stop_event):
+                break
+
+            wd = libc.inotify_add_watch(fd, path.encode(), IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF)
+            if wd < 0:
+                # the folder might have been removed again in the meantime
+                time.sleep(1)
+                continue
+
+            # we list the folder after adding the watch so that we do not miss files created in between
+            current_files = set(os.listdir(path))
+            if first_watch:
+                files_set = get_handled_files(current_files, prefix, handled_files)
+                first_watch = False
+                queue_new_files(current_files, files_set, queue, prefix)
+            else:
+                files_set = set()
+                queue_new_files(current_files, files_set, queue, prefix)
+
+            watching = True
+            overflowed = False
+            pending_files = {}
+            while watching and not stop_event.is_set():
+                readable, _, _ = select.select([fd], [], [], 1)
+                if overflowed or pending_files:
+                    overflowed = False
+                    try:
+                        queue_new_files(list_stable_files(path, files_set, pending_files), files_set, queue, prefix)
+                    except FileNotFoundError:
+                        pass
+                if not readable:
+                    continue
+
+                try:
+                    buffer = os.read(fd, 64 * 1024)
+                except BlockingIOError:
+                    continue
+
+                added_files = set()
+                offset = 0
+                while offset < len(buffer):
+                    event_wd, mask, _, length = struct.unpack_from("iIII", buffer, offset)
+                    name = buffer[offset + 16 : offset + 16 + length].rstrip(b'\0').decode(errors="ignore")
+                    offset += 16 + length
+
+                    # the overflow event is not bound to a watch (wd -1), the files it hides are found by listing the folder
+                    if mask & IN_Q_OVERFLOW:
+                        print("the inotify event queue has overflowed, listing the crashes folder")
+                        overflowed = True
+                        continue
+                    # events of a previous watch (e.g. on a folder that has been moved away) are ignored
+                    if event_wd != wd:
+                        continue
+                    if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                        if mask & IN_MOVE_SELF:
+                            libc.inotify_rm_watch(fd, wd)
+                        watching = False
+                    elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and name:
+                        added_files.add(name)
+
+                queue_new_files(added_files, files_set, queue, prefix)
+
+            if not watching:
+                print("the crashes folder has been removed, waiting for it to be recreated")
+    finally:
+        os.close(fd)
+# --------------------------------------------------------- #
+
+
+
+def monitor_folder_polling(path, queue, stop_event, prefix="", handled_files=None):
+    """
+    This function monitors the crashes folder by listing it once a second.
+    A new file is added to the queue only once its size has not changed between two consecutive listings,
+    so that we do not pick up files that the fuzzer is still writing.
+    If the folder is recreated (e.g. the fuzzer has been restarted) all the files in the new folder are considered new.
+    """
+
+    if not wait_for_folder(path, stop_event):
+        return
+
+    folder_inode = os.stat(path).st_ino
+    files_set = get_handled_files(os.listdir(path), prefix, handled_files)
+    pending_files = {}
+
+    while not stop_event.wait(1): # wait for 1 second
+        if not os.path.isdir(path) or os.stat(path).st_ino != folder_inode:
+            print("the crashes folder has been removed, waiting for it to be recreated")
+            if not wait_for_folder(path, stop_event):
+                break
+            folder_inode = os.stat(path).st_ino
+            files_set = set()
+            pending_files = {}
+
+        queue_new_files(list_stable_files(path, files_set, pending_files), files_set, queue, prefix)
+# --------------------------------------------------------- #
+
+
+
+def list_stable_files(path, files_set, pending_files):
+    """
+    This function lists the crashes folder and returns the files that are not in files_set and whose size has not changed
+    since the previous listing, the sizes of the other ones are kept in pending_files for the next listing.
+    """
+
+    current_files = set(os.listdir(path)) - files_set
+    for item in set(pending_files) - current_files:
+        del pending_files[item]
+
+    added_files = set()
+    for item in current_files:
+        try:
+            size = os.path.getsize(f"{path}/{item}")
+        except OSError:
+            continue
+        # the file is considered complete once its size is stable
+        if pending_files.get(item) == size:
+            added_files.add(item)
+            del pending_files[item]
+        else:
+            pending_files[item] = size
+    return added_files
+# --------------------------------------------------------- #
+
+
+
+def get_handled_files(current_files, prefix, handled_files):
+    """
+    This function returns the files found in the crashes folder when the monitor starts that must not be added to the queue:
+    all of them, unless the handled files are known, in which case only those (e.g. the crashes found while the script was not running
+    or before it was stopped are added to the queue).
+    """
+
+    if handled_files is None:
+        return set(current_files)
+    return {item for item in current_files if f"{prefix}{item}" in handled_files}
+# --------------------------------------------------------- #
+
+
+
+def queue_new_files(added_files, files_set, queue, prefix=""):
+    """
+    This function adds the new files detected by the monitor to the queue, skipping the README.txt that the fuzzer
+    writes in the crashes folder and the files that have already been queued.
+    """
+
+    added_files = set(added_files) - files_set
+    files_set.update(added_files)
+    added_files.discard("README.txt")
+
+    if added_files:
+        print(f"New files added: {', '.join(sorted(added_files))}")
+        for item in sorted(added_files):
+            queue.put(f"{prefix}{item}")
+# --------------------------------------------------------- #
+
+
+
+def monitor_instances(output_path, instance_names, queue, stop_event, backend="auto", handled_files=None):
+    """
+    This function monitors the crashes folders of all the fuzzer instances (<output>/<instance>/crashes),
+    one monitor_folder thread per instance. The crashes are merged in the same queue, each filename is
+    relative to the output folder of the fuzzer (e.g. "main/crashes/id:000000...").
+    It returns once the stop event has been set and all the threads have stopped.
+    """
+
+    threads = []
+    for name in instance_names:
+        thread = threading.Thread(target=monitor_folder, args=(f"{output_path}/{name}/crashes", queue, stop_event, backend, f"{name}/crashes/", handled_files))
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+# --------------------------------------------------------- #
+
+
+
+class CrashQueue:
+    """
+    This class replaces the FIFO queue of the crashes: the monitors put the new crashes in it and the loop takes
+    the new ones first, to reproduce them and compute their signature. The reproduced crashes are put back
+    with put_triaged and, once there are no new crashes, the one with the highest score is taken for repair.
+    The score is the weighted sum of:
+        - severity: the severity of the bug type, see get_crash_severity
+        - novelty: 1 if no other bucket of the crash index has the same top frame, less the more buckets share it
+        - frequency: how many inputs hit the bucket, relative to the most hit pending bucket
+        - age: how long [hours] the crash has been waiting, up to 1
+    The scores are computed when a crash is taken, so they follow the crashes that arrived in the meantime
+    (e.g. the duplicates that increase the count of a bucket). The weights missing in weights are 0.
+    If index_lock is provided the crash index is read under it, since other threads update it (see RepairPipeline).
+    If record is provided it is called with every new crash before it is queued (e.g. to store it, see StateStore.add_crash).
+    """
+
+    def __init__(self, crash_index, weights, index_lock=None, record=None):
+        self.crash_index = crash_index
+        self.weights = weights
+        self.index_lock = index_lock or threading.Lock()
+        self.record = record
+        self.new_items = []
+        self.triaged_items = {}
+        self.condition = threading.Condition()
+        self.last_put = time.monotonic()
+
+
+    def put(self, item):
+        if self.record is not None:
+            self.record(item)
+        with self.condition:
+            self.new_items.append(item)
+            self.last_put = time.monotonic()
+            self.condition.notify_all()
+
+
+    def put_triaged(self, item, info):
+        """
+        This method adds a reproduced crash, info contains its signature, severity, top frame
+        and the time it has been found, together with what is needed to repair it (report, frames, input).
+        """
+
+        with self.condition:
+            self.triaged_items[item] = info
+            self.condition.notify_all()
+
+
+    def get(self, block=True, timeout=None, new=True, triaged=True):
+        """
+        This method returns the next crash and its info, None if it is a new crash.
+        With new or triaged set to False only the other kind of crashes is returned (e.g. by the stages of RepairPipeline).
+        It raises Empty if no crash is available within timeout seconds, like Queue.get.
+        """
+
+        with self.condition:
+            if not self.condition.wait_for(lambda: (new and self.new_items) or (triaged and self.triaged_items), timeout if block else 0):
+                raise Empty
+            if new and self.new_items:
+                return self.new_items.pop(0), None
+
+            now = time.time()
+            with self.index_lock:
+                scores = {item: self.score(info, now) for item, info in self.triaged_items.items()}
+            item = max(scores, key=lambda key: (scores[key], -self.triaged_items[key]["found"]))
+            print(f"repairing {item} (score {scores[item]:.2f}), {len(scores) - 1} crashes left in the queue")
+            return item, self.triaged_items.pop(item)
+
+
+    def empty(self):
+        with self.condition:
+            return not self.new_items and not self.triaged_items
+
+
+    def score(self, info, now):
+        signature = info["signature"]
+        counts = [self.crash_index[other["signature"]]["count"] for other in self.triaged_items.values() if other["signature"] in self.crash_index]
+        count = self.crash_index[signature]["count"] if signature in self.crash_index else 1
+        frequency = math.log1p(count) / math.log1p(max(counts + [count]))
+
+        shared = 0
+        if info["top_frame"] is not None:
+            shared = sum(1 for other_signature, bucket in self.crash_index.items()
+                         if other_signature != signature and bucket["frames"] and bucket["frames"][0] == info["top_frame"])
+        novelty = 1 / (1 + shared)
+        age = min(1.0, (now - info["found"]) / 3600)
+
+        return (self.weights.get("severity", 0) * info["severity"] + self.weights.get("novelty", 0) * novelty
+                + self.weights.get("frequency", 0) * frequency + self.weights.get("age", 0) * age)
+# --------------------------------------------------------- #
+
+
+
+class RepairPipeline:
+    """
+    This class runs the stages that come before the repair of a crash in background threads, so that they overlap
+    with the build and the reproduction of the crash being repaired:
+        - triage: the new crashes are taken from the CrashQueue, reproduced and bucketed (triage, see triage_crash)
+          and put back in the queue to be ranked
+        - prepare: the best crash is taken from the queue, minimized and localized and its first fixes are requested
+          to the LLM (prepare, see prepare_crash)
+    The prepared crashes wait in a bounded queue of depth items, the loop takes them with get and repairs them one at a time,
+    so two fixes are never applied to the repair tree at the same time. prepare is called with the stop event of the pipeline.
+    The stages run on the target tree, the repair must be done in the repair snapshot.
+    """
+
+    def __init__(self, queue, triage, prepare, depth):
+        self.queue = queue
+        self.triage = triage
+        self.prepare = prepare
+        self.prepared = Queue(maxsize=max(1, depth))
+        self.stop_event = threading.Event()
+        self.busy = 0
+        self.lock = threading.Lock()
+        self.triage_thread = threading.Thread(target=self.run_stage, args=("triage", True, False), daemon=True)
+        self.prepare_thread = threading.Thread(target=self.run_stage, args=("prepare", False, True), daemon=True)
+
+
+    def start(self):
+        self.triage_thread.start()
+        self.prepare_thread.start()
+
+
+    def stop(self):
+        """
+        This method stops the stages and waits for them, so that nothing runs on the target tree, the function index
+        or the crash state once it returns (e.g. while the fixed tree is synced into the target tree).
+        The crash being prepared stops at its next step (see prepare_crash), a request already sent to the LLM is waited for.
+        The crashes in the stages and the prepared ones are dropped, they are still pending in the state store
+        and are queued again when the monitors restart.
+        """
+
+        self.stop_event.set()
+        self.triage_thread.join()
+        self.prepare_thread.join()
+
+
+    def run_stage(self, name, new, triaged):
+        while not self.stop_event.is_set():
+            try:
+                item, info = self.queue.get(block=True, timeout=1, new=new, triaged=triaged)
+            except Empty:
+                continue
+
+            with self.lock:
+                self.busy += 1
+            try:
+                if new:
+                    info = self.triage(item)
+                    if info is not None and not self.stop_event.is_set():
+                        self.queue.put_triaged(item, info)
+                else:
+                    prepared = self.prepare(item, info, self.stop_event)
+                    while prepared is not None and not self.stop_event.is_set():
+                        try:
+                            self.prepared.put((item, prepared), timeout=1)
+                            break
+                        except Full:
+                            continue
+            except Exception as e:
+                print(f"the {name} of {item} failed: {e}")
+            finally:
+                with self.lock:
+                    self.busy -= 1
+
+
+    def get(self, timeout):
+        """
+        This method returns the next prepared crash and what is needed to repair it (see prepare_crash).
+        It raises Empty if no crash has been found for timeout seconds and no crash is left in the stages.
+        """
+
+        start = time.monotonic()
+        while True:
+            try:
+                return self.prepared.get(timeout=1)
+            except Empty:
+                with self.lock:
+                    idle = self.busy == 0
+                if idle and self.queue.empty() and self.prepared.empty() and time.monotonic() - max(start, self.queue.last_put) > timeout:
+                    raise Empty
+# --------------------------------------------------------- #
+
+
+
+class RateLimiter:
+    """
+    This class implements two token buckets, one for the requests per minute and one for the tokens per minute.
+    The buckets are refilled continuously, a request can be sent only if both buckets contain enough tokens.
+    It is thread safe so that it can be shared by different clients (see afl_orchestrator.py).
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.capacity = {"requests": float(requests_per_minute), "tokens": float(tokens_per_minute)}
+        self.available = dict(self.capacity)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def refill(self):
+        now = time.monotonic()
+        for key in self.available:
+            self.available[key] = min(self.capacity[key], self.available[key] + self.capacity[key] * (now - self.last_refill) / 60)
+        self.last_refill = now
+
+
+    def try_acquire(self, tokens):
+        """
+        This method tries to take one request and the estimated tokens from the buckets.
+        It returns 0 if the request can be sent, otherwise the number of seconds to wait before trying again.
+        A request bigger than the whole bucket is let through once the bucket is full.
+        """
+
+        with self.lock:
+            self.refill()
+            needed = {"requests": 1.0, "tokens": min(float(tokens), self.capacity["tokens"])}
+            wait = 0
+            for key in needed:
+                if self.available[key] < needed[key]:
+                    wait = max(wait, (needed[key] - self.available[key]) * 60 / self.capacity[key])
+            if wait == 0:
+                for key in needed:
+                    self.available[key] -= needed[key]
+            return wait
+
+
+    def adjust(self, tokens):
+        """
+        This method corrects the tokens bucket once the actual usage of a request is known.
+        """
+
+        with self.lock:
+            self.available["tokens"] = min(self.capacity["tokens"], self.available["tokens"] - tokens)
+# --------------------------------------------------------- #
+
+
+
+class LLMResponse:
+    """
+    This class holds the answer of an LLM backend: the text, the tokens used, if the backend returned an error
+    and if the answer has been truncated because it reached max_tokens.
+    """
+
+    def __init__(self, text, input_tokens=0, output_tokens=0, error=False, truncated=False):
+        self.text = text
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.error = error
+        self.truncated = truncated
+# --------------------------------------------------------- #
+
+
+
+class LLMRateLimitError(Exception):
+    """
+    This exception is raised by the LLM backends when a request is rejected because of the rate limit (429)
+    or because the service is overloaded (529, 503), so that LLMClient can retry it.
+    """
+
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"LLM request rejected with status {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+# --------------------------------------------------------- #
+
+
+
+class AnthropicBackend:
+    """
+    This class sends the requests to the Anthropic API with the asynchronous Anthropic client.
+    """
+
+    rate_limited = True
+
+    def __init__(self, config):
+        if anthropic is None:
+            raise ImportError("the anthropic backend needs the anthropic package")
+        self.client = anthropic.AsyncAnthropic(max_retries=config["llm_max_retries"])
+
+
+    async def create(self, model, max_tokens, temperature, system, messages):
+        try:
+            message = await self.client.messages.create(model=model, max_tokens=max_tokens, temperature=temperature, system=system, messages=messages)
+        except anthropic.APIStatusError as e:
+            if e.status_code not in (429, 529):
+                raise
+            retry_after = e.response.headers.get("retry-after") if e.response is not None else None
+            raise LLMRateLimitError(e.status_code, int(retry_after) if retry_after and retry_after.isdigit() else None)
+
+        if message.content[0].type == "error":
+            return LLMResponse('', error=True)
+        usage = getattr(message, "usage", None)
+        return LLMResponse(message.content[0].text, usage.input_tokens if usage else 0, usage.output_tokens if usage else 0,
+                           truncated=getattr(message, "stop_reason", None) == "max_tokens")
+# --------------------------------------------------------- #
+
+
+
+class OpenAICompatibleBackend:
+    """
+    This class sends the requests to a server that implements the OpenAI chat completions API
+    (e.g. a local vLLM, llama.cpp or Ollama server), at llm_base_url.
+    The API key, if the server needs one, is read from the environment variable named in llm_api_key_variable.
+    The requests are sent with urllib in a thread of the default executor, no additional package is needed.
+    """
+
+    rate_limited = True
+
+    def __init__(self, config):
+        self.url = config["llm_base_url"].rstrip('/') + "/chat/completions"
+        self.api_key = os.environ.get(config["llm_api_key_variable"], "")
+        self.timeout = config["llm_request_timeout"]
+
+
+    def post(self, body):
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        request = urllib.request.Request(self.url, data=json.dumps(body).encode(), headers=headers, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read().decode())
+        except urllib.error.HTTPError as e:
+            if e.code not in (429, 503, 529):
+                raise
+            retry_after = e.headers.get("retry-after") if e.headers is not None else None
+            raise LLMRateLimitError(e.code, int(retry_after) if retry_after and retry_after.isdigit() else None)
+
+
+    async def create(self, model, max_tokens, temperature, system, messages):
+        body = {
+            "model": model,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "messages": [{"role": "system", "content": system}] + messages
+        }
+        answer = await asyncio.get_event_loop().run_in_executor(None, self.post, body)
+
+        choices = answer.get("choices") or []
+        if not choices or choices[0].get("message", {}).get("content") is None:
+            return LLMResponse('', error=True)
+        usage = answer.get("usage") or {}
+        return LLMResponse(choices[0]["message"]["content"], usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0),
+                           truncated=choices[0].get("finish_reason") == "length")
+# --------------------------------------------------------- #
+
+
+
+class ReplayBackend:
+    """
+    This class answers the requests with the responses recorded in the transcript of an earlier session (see LLMClient),
+    without any network access. A request is matched only if it is the same as the recorded one (model, prompts,
+    temperature, ...) but for the addresses and PIDs of the reports (see get_request_key);
+    the same request recorded several times is answered with the recorded responses in order.
+    A request that is not in the transcript gets an error response.
+    """
+
+    rate_limited = False
+
+    def __init__(self, config):
+        self.responses = {}
+        with open(config["llm_replay_transcript"], 'r') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                # the key is computed again from the request, so that the transcripts recorded with an older key are matched as well
+                key = get_request_key(**item["request"]) if "request" in item else item["key"]
+                self.responses.setdefault(key, []).append(item["response"])
+        self.lock = threading.Lock()
+
+
+    async def create(self, model, max_tokens, temperature, system, messages):
+        key = get_request_key(model=model, max_tokens=max_tokens, temperature=temperature, system=system, messages=messages)
+        with self.lock:
+            recorded = self.responses.get(key)
+            response = recorded.pop(0) if recorded else None
+        if response is None:
+            print("the request is not in the transcript")
+            return LLMResponse('', error=True)
+        return LLMResponse(response["text"], response["input_tokens"], response["output_tokens"], response["error"], response.get("truncated", False))
+# --------------------------------------------------------- #
+
+
+
+def create_llm_backend(config):
+    """
+    This function creates the LLM backend selected in the configuration (llm_backend):
+    "anthropic", "openai" (any OpenAI compatible server) or "replay" (a transcript of an earlier session).
+    """
+
+    backends = {"anthropic": AnthropicBackend, "openai": OpenAICompatibleBackend, "replay": ReplayBackend}
+    if config["llm_backend"] not in backends:
+        raise ValueError(f"unknown LLM backend {config['llm_backend']}, use one of {', '.join(backends)}")
+    return backends[config["llm_backend"]](config)
+# --------------------------------------------------------- #
+
+
+
+def get_request_key(**request):
+    """
+    This function returns the key of a request in the transcript, the hash of all its arguments.
+    The messages are normalized like the keys of the LLM cache (see LLMCache.normalize): the addresses, PIDs and thread ids
+    of a report change at every reproduction of the same crash (ASLR) and the request must be replayed anyway.
+    """
+
+    if "messages" in request:
+        request = dict(request, messages=[dict(message, content=LLMCache.normalize(message["content"])) for message in request["messages"]])
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+# --------------------------------------------------------- #
+
+
+
+class LLMClient:
+    """
+    This class sends the requests to the LLM backend (see create_llm_backend).
+    The requests are run in an asyncio event loop in a background thread, they are rate limited by a RateLimiter
+    and at most max_concurrency of them are in flight at the same time.
+    Requests rejected because of the rate limit (429) or overload (529) are retried with an exponential backoff with jitter.
+    Every request and its response are appended to a json lines transcript, that can be replayed with the replay backend.
+    """
+
+    def __init__(self, config, rate_limiter=None, cache=None, backend=None, transcript_path=None):
+        self.cache = cache
+        self.rate_limiter = rate_limiter or RateLimiter(config["llm_requests_per_minute"], config["llm_tokens_per_minute"])
+        self.max_concurrency = config["llm_max_concurrency"]
+        self.backoff_retries = config["llm_backoff_retries"]
+        self.max_backoff = config["llm_timeout"]
+        self.model = config["llm_model"] or LLM_MODEL
+        self.backend_name = config["llm_backend"]
+        # only the OpenAI compatible backend can be pointed to different servers
+        self.base_url = config["llm_base_url"] if config["llm_backend"] == "openai" else None
+        self.system_prompt = config["llm_system_prompt"]
+        self.temperature = config["llm_temperature"]
+        self.max_tokens = config["llm_max_tokens"]
+        self.transcript_path = transcript_path
+        self.transcript_lock = threading.Lock()
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.semaphore = self.run(self.create_semaphore())
+        self.backend = backend or create_llm_backend(config)
+
+
+    def get_cache_settings(self, temperature=None):
+        """
+        This method returns the settings of a request that are part of the key of the LLM cache (see LLMCache.key):
+        an answer is served again only to the same backend, model and system prompt, at the same temperature.
+        """
+
+        return {
+            "backend": self.backend_name,
+            "base_url": self.base_url,
+            "model": self.model,
+            "system_prompt": self.system_prompt,
+            "temperature": self.temperature if temperature is None else temperature
+        }
+
+
+    async def create_semaphore(self):
+        # the semaphore must be created inside the event loop it is used in
+        return asyncio.Semaphore(self.max_concurrency)
+
+
+    def run(self, coroutine):
+        """
+        This method runs a coroutine in the event loop of the client and waits for its result.
+        """
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+
+    def run_all(self, coroutines):
+        """
+        This method runs several coroutines concurrently and returns their results in order.
+        """
+
+        async def gather():
+            return await asyncio.gather(*coroutines)
+        return self.run(gather())
+
+
+    async def create_message(self, purpose, content, max_tokens, temperature=None):
+        """
+        This method sends a request with the model and the system prompt of the client and returns an LLMResponse.
+        purpose (e.g. "fix") is recorded in the transcript, the temperature of the client is used if it is not specified.
+        """
+
+        request = {
+            "model": self.model,
+            "max_tokens": max_tokens,
+            "temperature": self.temperature if temperature is None else temperature,
+            "system": self.system_prompt,
+            "messages": [{"role": "user", "content": content}]
+        }
+
+        # the tokens are estimated (4 characters per token) before sending the request and corrected afterwards
+        estimated_tokens = len(content) // 4 + max_tokens
+
+        attempt = 0
+        start = time.monotonic()
+        while True:
+            # the replayed answers do not count against the rate limit
+            wait = self.rate_limiter.try_acquire(estimated_tokens) if self.backend.rate_limited else 0
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self.rate_limiter.try_acquire(estimated_tokens)
+
+            try:
+                async with self.semaphore:
+                    response = await self.backend.create(**request)
+            except LLMRateLimitError as e:
+                if attempt >= self.backoff_retries:
+                    raise
+                backoff = min(self.max_backoff, 2 ** attempt) * random.uniform(0.5, 1.5)
+                if e.retry_after is not None:
+                    backoff = max(backoff, e.retry_after)
+                print(f"LLM rate limited or overloaded ({e.status_code}), retrying in {backoff:.1f}s")
+                attempt += 1
+                await asyncio.sleep(backoff)
+                continue
+
+            duration = time.monotonic() - start
+            if self.backend.rate_limited:
+                self.rate_limiter.adjust(response.input_tokens + response.output_tokens - estimated_tokens)
+            METRICS.event("llm", duration, input_tokens=response.input_tokens, output_tokens=response.output_tokens, retries=attempt)
+            self.record(purpose, request, response, duration)
+            return response
+
+
+    def record(self, purpose, request, response, duration):
+        """
+        This method appends a request and its response to the transcript.
+        """
+
+        if self.transcript_path is None:
+            return
+
+        line = {
+            "time": time.time(),
+            "purpose": purpose,
+            "key": get_request_key(**request),
+            "duration": round(duration, 3),
+            "request": request,
+            "response": {"text": response.text, "input_tokens": response.input_tokens, "output_tokens": response.output_tokens, "error": response.error,
+                         "truncated": response.truncated}
+        }
+        with self.transcript_lock:
+            with open(self.transcript_path, 'a') as file:
+                file.write(json.dumps(line) + '\n')
+# --------------------------------------------------------- #
+
+
+
+class Metrics:
+    """
+    This class records how long every stage of the loop takes (build, fuzzer start, crash detection, reproduction, parsing,
+    LLM requests, patch, rebuild) and the outcome of the fixes.
+    Every event is appended as a json line to the metrics file, counters and histograms of the durations are kept in memory
+    and, if a textfile is configured, written in the Prometheus text format for the textfile collector of node-exporter.
+    Until configure is called the events are discarded. The events of the worker processes are appended to the
+    same file, but only the main process writes the textfile and the timings of the state store (see StateStore).
+    """
+
+    BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+    def __init__(self):
+        self.jsonl_path = None
+        self.textfile_path = None
+        self.store = None
+        self.pid = os.getpid()
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+
+    def configure(self, jsonl_path, textfile_path=None, store=None, pid=None):
+        """
+        This method sets where the events are written, pid is the process that writes the textfile and the timings
+        of the state store (the main process, see init_worker), by default the current one.
+        """
+
+        self.jsonl_path = jsonl_path
+        self.textfile_path = textfile_path or None
+        self.store = store
+        self.pid = pid if pid is not None else os.getpid()
+
+
+    def event(self, stage, duration=None, **fields):
+        """
+        This method records an event of a stage, with its duration [seconds] if it is timed.
+        The fields are added to the json line, the numeric ones (e.g. tokens) are also added to the counters of the stage.
+        """
+
+        if self.jsonl_path is None and self.store is None:
+            return
+
+        line = {"time": time.time(), "stage": stage}
+        if duration is not None:
+            line["duration"] = round(duration, 6)
+        line.update(fields)
+
+        with self.lock:
+            if self.jsonl_path is not None:
+                with open(self.jsonl_path, 'a') as file:
+                    file.write(json.dumps(line) + '\n')
+
+            self.increment("events_total", stage)
+            for key, value in fields.items():
+                if isinstance(value, bool):
+                    self.increment(f"{key}_total", stage, str(value).lower())
+                elif isinstance(value, (int, float)):
+                    self.increment(f"{key}_total", stage, amount=value)
+            if duration is not None:
+                histogram = self.histograms.setdefault(stage, {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0})
+                for i, bound in enumerate(self.BUCKETS):
+                    if duration <= bound:
+                        histogram["buckets"][i] += 1
+                histogram["sum"] += duration
+                histogram["count"] += 1
+
+            if self.textfile_path is not None and os.getpid() == self.pid:
+                self.write_textfile()
+            if self.store is not None and os.getpid() == self.pid:
+                self.store.add_timing(line["time"], stage, duration, fields)
+
+
+    @contextlib.contextmanager
+    def timer(self, stage, **fields):
+        """
+        This method times the block it wraps and records it as an event of the stage.
+        The fields can be updated inside the block, e.g. with the outcome of the stage.
+        """
+
+        start = time.monotonic()
+        try:
+            yield fields
+        finally:
+            self.event(stage, time.monotonic() - start, **fields)
+
+
+    def increment(self, name, stage, value=None, amount=1):
+        key = (name, stage, value)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+
+    def write_textfile(self):
+        """
+        This method writes the counters and the histograms in the Prometheus text format.
+        The file is written to a temporary file and renamed, so the collector never reads it half written.
+        """
+
+        lines = []
+        for name in sorted({key[0] for key in self.counters}):
+            lines.append(f"# TYPE afl_loop_{name} counter")
+            for (counter_name, stage, value), amount in sorted(self.counters.items(), key=lambda item: str(item[0])):
+                if counter_name == name:
+                    labels = f'stage="{stage}"' + (f',value="{value}"' if value is not None else '')
+                    lines.append(f"afl_loop_{name}{{{labels}}} {amount}")
+
+        lines.append("# TYPE afl_loop_stage_duration_seconds histogram")
+        for stage, histogram in sorted(self.histograms.items()):
+            for bound, count in zip(self.BUCKETS, histogram["buckets"]):
+                lines.append(f'afl_loop_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'afl_loop_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'afl_loop_stage_duration_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'afl_loop_stage_duration_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+
+        tmp_path = f"{self.textfile_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.textfile_path)
+# --------------------------------------------------------- #
+
+
+METRICS = Metrics()
+
+
+
+class LLMCache:
+    """
+    This class implements an on-disk cache of the answers of the LLM, one json file per answer.
+    The key is the hash of the settings of the request (backend, model, system prompt and temperature, see LLMClient.get_cache_settings),
+    the prompt template and the normalized report and function code, so that equivalent reports (that only differ in addresses, PIDs or whitespace) share the same answer.
+    The fixes that have been verified to fix a bug are marked as good.
+    When the cache grows bigger than max_bytes the least recently used answers are removed.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.size = sum(os.path.getsize(f"{folder}/{item}") for item in os.listdir(folder))
+
+
+    @staticmethod
+    def normalize(text):
+        # addresses, PIDs and thread ids change between runs of the same crash
+        text = re.sub(r"0x[0-9a-fA-F]+", "0x", text)
+        text = re.sub(r"==\d+==", "==", text)
+        text = re.sub(r"\bT\d+\b", "T", text)
+        return ' '.join(text.split())
+
+
+    def key(self, settings, template, *parts):
+        content = '\0'.join([json.dumps(settings, sort_keys=True), template] + [self.normalize(part) for part in parts])
+        return hashlib.sha256(content.encode()).hexdigest()
+
+
+    def get(self, key, only_good=False):
+        """
+        This method returns the cached answer or None, using an answer updates its access time for the LRU eviction.
+        """
+
+        file_path = f"{self.folder}/{key}.json"
+        entry = None
+        try:
+            with open(file_path, 'r') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            pass
+
+        with self.lock:
+            if entry is None or (only_good and not entry["good"]):
+                self.misses += 1
+                return None
+            self.hits += 1
+        try:
+            os.utime(file_path)
+        except OSError:
+            pass
+        return entry["text"]
+
+
+    def put(self, key, text, good=False):
+        file_path = f"{self.folder}/{key}.json"
+        with self.lock:
+            old_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+            with open(f"{file_path}.tmp", 'w') as file:
+                json.dump({"text": text, "good": good, "created": time.ctime()}, file)
+            os.replace(f"{file_path}.tmp", file_path)
+            self.size += os.path.getsize(file_path) - old_size
+            if self.size > self.max_bytes:
+                self.evict()
+
+
+    def mark_good(self, key, text):
+        """
+        This method stores an answer that has fixed a bug, it is served even when a new candidate is requested.
+        """
+
+        self.put(key, text, good=True)
+
+
+    def invalidate(self, key):
+        """
+        This method removes an answer that did not fix the bug, unless it is known to be good.
+        """
+
+        file_path = f"{self.folder}/{key}.json"
+        with self.lock:
+            try:
+                with open(file_path, 'r') as file:
+                    if json.load(file)["good"]:
+                        return
+                size = os.path.getsize(file_path)
+                os.remove(file_path)
+                self.size -= size
+            except (OSError, ValueError):
+                pass
+
+
+    def evict(self):
+        # the least recently used answers are removed until the cache is at 90% of its maximum size
+        entries = []
+        for item in os.listdir(self.folder):
+            try:
+                entries.append((os.path.getmtime(f"{self.folder}/{item}"), item))
+            except OSError:
+                continue
+        for _, item in sorted(entries):
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                size = os.path.getsize(f"{self.folder}/{item}")
+                os.remove(f"{self.folder}/{item}")
+                self.size -= size
+            except OSError:
+                continue
+
+
+    def stats(self):
+        return f"hits: {self.hits}, misses: {self.misses}"
+# --------------------------------------------------------- #
+
+
+
+def ask_llm_to_find(client, report, logs_folder_name):
+    """
+    This function asks the LLM to find the file and functions responsible for the bug and waits for the answer,
+    see ask_llm_to_find_async.
+    """
+
+    return client.run(ask_llm_to_find_async(client, report, logs_folder_name))
+# --------------------------------------------------------- #
+
+
+
+async def ask_llm_to_find_async(client, report, logs_folder_name):
+    """
+    Creates and sends the request to Claude3 and returns the response from it.
+    This function in used to ask the LLM to parse generic bug reports.
+
+    The reponse should contain a json file containing a list of items
+    each item should contain the file name, function name and line number.
+
+    The request and the answer of the LLM are recorded in the transcript of the client (see LLMClient).
+    """
+
+    print("we ask the LLM to find the file and functions responsible for the bug")
+    # completion =  client.chat.completions.create(
+
+    #     messages=[
+    #         {
+    #             "role": "user",
+    #             "content": report + """Given this information in which files and functions should i look into to locate the bug? Return the results in a json format structured like the following example, without any additional comments.
+    #             [{
+    #                 "file": "example1.py",
+    #                 "function": "function1"
+    #                 "line": 10
+    #             }]""",
+    #         }
+    #     ],
+
+    #     model="gpt-3.5-turbo",
+    # )
+
+    # the same report might have already been localized in a previous run
+    cache_key = client.cache.key(client.get_cache_settings(0.0), FIND_PROMPT, report) if client.cache else None
+    if cache_key:
+        cached_text = client.cache.get(cache_key)
+        if cached_text is not None:
+            print(f"answer served from the LLM cache ({client.cache.stats()})")
+            return cached_text
+
+    # the request and the answer are recorded in the transcript of the client
+    message = await client.create_message("find", report + FIND_PROMPT, client.max_tokens, temperature=0.0)
+
+    if message.error:
+        return None
+    text = message.text
+    
+
+    #if completion.choices[0].message.content starts with ``` then we want to discard the first and last line
+    # if completion.choices[0].message.content.startswith("```"):
+    #     return '\n'.join(completion.choices[0].message.content.split('\n')[1:-1]) #we return a string
+    if text.startswith("```"):
+        text = '\n'.join(text.split('\n')[1:-1])
+
+    if cache_key:
+        client.cache.put(cache_key, text)
+    
+    #return completion.choices[0].message.content
+    return text
+# --------------------------------------------------------- #
+
+
+
+
+def ask_llm_to_fix(client, report, function_code, logs_folder_name, temperature=None):
+    """
+    This function asks the LLM to fix a buggy function and waits for the answer, see ask_llm_to_fix_async.
+    """
+
+    return client.run(ask_llm_to_fix_async(client, report, function_code, logs_folder_name, temperature))
+# --------------------------------------------------------- #
+
+
+
+async def ask_llm_to_fix_async(client, report, function_code, logs_folder_name, temperature=None):
+    """
+    This function creates and sends the request to the LLM and returns its response.
+    This function asks the LLM to return the fixed code of given a buggy function.
+    A temperature higher than 0 is used when several candidate fixes are requested for the same function,
+    if it is not specified the temperature of the client (llm_temperature) is used.
+    """
+
+    temperature = client.temperature if temperature is None else temperature
+
+    print("asking llm for a fix")
+    # completion =  client.chat.completions.create(
+
+    #     messages=[
+    #         {
+    #             "role": "user",
+    #             "content": f"{report}\n{function_code}\n Given this information, provide a fix. Return the fixed code for the whole function without any additional comments.",
+    #         }
+    #     ],
+
+    #     model="gpt-3.5-turbo",
+    # )
+    # a fix for the same function and an equivalent report might have already been requested,
+    # when several candidates are requested (temperature > 0) only the fixes known to be good are served
+    cache_key = client.cache.key(client.get_cache_settings(temperature), FIX_PROMPT, report, function_code) if client.cache else None
+    if cache_key:
+        cached_text = client.cache.get(cache_key, only_good=temperature > 0)
+        if cached_text is not None:
+            print(f"fix served from the LLM cache ({client.cache.stats()})")
+            return cached_text
+
+    message = await client.create_message("fix", f"{report}\n{function_code}\n {FIX_PROMPT}", client.max_tokens, temperature)
+    print("Response from the LLM")
+    # print(completion.choices[0].message.content)
+    # print("\n\n")
+
+    if message.error:
+        return None
+    # a truncated function would not compile, a new request is better than a patch that breaks the build
+    if message.truncated:
+        print("the fix has been truncated, increase llm_max_tokens")
+        return None
+    text = message.text
+
+    #if completion.choices[0].message.content starts with ``` then we want to discard the first and last line
+    # if completion.choices[0].message.content.startswith("```"):
+    #     return '\n'.join(completion.choices[0].message.content.split('\n')[1:-1])
+    if text.startswith("```"):
+        text = '\n'.join(text.split('\n')[1:-1])
+
+    # the answers of the candidates are all different, only the one that fixes the bug is stored (see mark_good)
+    if cache_key and temperature == 0:
+        client.cache.put(cache_key, text)
+
+    # return completion.choices[0].message.content
+    return text
+# --------------------------------------------------------- #
+
+
+
+async def ask_llm_to_fix_batch_async(client, report, functions, logs_folder_name, temperature=None):
+    """
+    This function asks the LLM to fix all the buggy functions of a crash with a single request, so that the report
+    is sent only once. functions is a list of tuples containing the path of the file, the name and the code of the function.
+    The LLM is asked to answer with a json object containing the fixed code of every function (see BATCH_FIX_PROMPT).
+    It returns the list of the fixed functions (None for the functions the LLM did not fix), in the same order of functions,
+    or None if the request failed or the answer could not be parsed.
+    """
+
+    temperature = client.temperature if temperature is None else temperature
+    print(f"asking llm for a fix of {len(functions)} functions")
+    function_codes = [function_code for _, _, function_code in functions]
+    function_names = [function_name for _, function_name, _ in functions]
+
+    cache_key = client.cache.key(client.get_cache_settings(temperature), BATCH_FIX_PROMPT, report, *function_codes) if client.cache else None
+    if cache_key:
+        cached_text = client.cache.get(cache_key, only_good=temperature > 0)
+        if cached_text is not None:
+            print(f"fixes served from the LLM cache ({client.cache.stats()})")
+            return parse_llm_batch_fix_response(cached_text, function_names)
+
+    content = report + '\n'
+    for file_path, function_name, function_code in functions:
+        content += f"\nFunction {function_name} in file {os.path.basename(file_path)}:\n{function_code}\n"
+
+    message = await client.create_message("fix_batch", f"{content}\n {BATCH_FIX_PROMPT}", client.max_tokens, temperature)
+    print("Response from the LLM")
+
+    if message.error:
+        return None
+    if message.truncated:
+        print("the fixes have been truncated, increase llm_max_tokens")
+        return None
+    text = message.text
+
+    fixes = parse_llm_batch_fix_response(text, function_names)
+    if fixes is not None and cache_key and temperature == 0:
+        client.cache.put(cache_key, text)
+    return fixes
+# --------------------------------------------------------- #
+
+
+
+def parse_llm_batch_fix_response(text, function_names):
+    """
+    This function parses the answer of a batched fix request.
+    The answer should be a json object {"patches": [{"function": ..., "code": ...}]}, it might be wrapped in a ``` block.
+    It returns the fixed code of every function in function_names (None if missing) or None if the answer is not valid json.
+    """
+
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end == -1:
+        print("could not parse the batched fix")
+        return None
+
+    try:
+        # strict=False accepts the raw newlines and tabs that the models often leave in the code strings
+        patches = json.loads(text[start : end + 1], strict=False)["patches"]
+        fixed_functions = {item["function"]: item["code"] for item in patches}
+    except (ValueError, KeyError, TypeError):
+        print("could not parse the batched fix")
+        return None
+
+    return [fixed_functions.get(function_name) for function_name in function_names]
+# --------------------------------------------------------- #
+
+
+
+async def request_fixes_async(client, report, functions, logs_folder_name, batch, temperature=None):
+    """
+    This function asks the LLM to fix the buggy functions and returns the fixed code of every function, in the same order.
+    With batch the functions are sent in a single request (see ask_llm_to_fix_batch_async), if its answer cannot be
+    parsed, or without batch, a request is sent for every function; these requests are sent concurrently.
+    """
+
+    if batch and len(functions) > 1:
+        fixes = await ask_llm_to_fix_batch_async(client, report, functions, logs_folder_name, temperature)
+        if fixes is not None:
+            return fixes
+        print("falling back to one request per function")
+
+    return await asyncio.gather(*[ask_llm_to_fix_async(client, report, function_code, logs_folder_name, temperature)
+                                  for _, _, function_code in functions])
+# --------------------------------------------------------- #
+
+
+
+def add_rejected_fix(report, functions, fixes, reason):
+    """
+    This function adds to the report sent with the next request the fixes of the last attempt, which have been rolled back,
+    and why they have been rejected (e.g. the program still crashes), so that the LLM does not return the same fixes again.
+    report must be built from the rolled back code (see compact_report), the one sent with the request.
+    """
+
+    rejected = '\n'.join(f"Function {function_name}:\n{fixed_function_code.strip()}" for (_, function_name, _), fixed_function_code in zip(functions, fixes)
+                          if fixed_function_code is not None and fixed_function_code != "None" and fixed_function_code != "")
+    return f"{report.rstrip()}\n{REJECTED_FIX_HEADER}\n{rejected}\nIt has been rejected because {reason}"
+# --------------------------------------------------------- #
+
+
+
+def record_fix_outcome(client, report, functions, fixes, is_fixed, temperature=None):
+    """
+    This function updates the LLM cache of the client once the fixes of a crash have been tested: if the bug has been fixed they are
+    marked as good, both one by one and as a batch, otherwise they are removed from the cache.
+    temperature is the one the fixes have been requested at (the one of the client by default), it is part of the key of the cache.
+    """
+
+    llm_cache = client.cache
+    if llm_cache is None:
+        return
+    settings = client.get_cache_settings(temperature)
+
+    batch = {"patches": []}
+    for (_, function_name, function_code), fixed_function_code in zip(functions, fixes):
+        if fixed_function_code is None or fixed_function_code == "None" or fixed_function_code == "":
+            continue
+        batch["patches"].append({"function": function_name, "code": fixed_function_code})
+        cache_key = llm_cache.key(settings, FIX_PROMPT, report, function_code)
+        if is_fixed:
+            llm_cache.mark_good(cache_key, fixed_function_code)
+        else:
+            llm_cache.invalidate(cache_key)
+
+    if len(functions) > 1:
+        cache_key = llm_cache.key(settings, BATCH_FIX_PROMPT, report, *[function_code for _, _, function_code in functions])
+        if is_fixed:
+            llm_cache.mark_good(cache_key, json.dumps(batch))
+        else:
+            llm_cache.invalidate(cache_key)
+# --------------------------------------------------------- #
+
+
+
+
+def find_file(filename, search_path, source_index=None):
+    """
+    This function looks for the file reported by the sanitizer in the target tree and returns its path (search_path/relative_path).
+    If a source index is provided (see build_source_index) the file is looked up by its basename and, if several files
+    have the same basename, the one that shares the longest path suffix with the reported file is returned.
+    If the file is not in the index, the index is refreshed before giving up.
+    Without an index the whole target tree is walked.
+    """
+
+    # Check if search_path is in filename and exclude everything in filename that comes before it
+    if search_path in filename:
+        relative_path = filename.split(search_path, 1)[1].lstrip('/')
+    else:
+        return None
+
+    if source_index is not None:
+        candidates = [item for item in lookup_source_index(source_index, filename) if os.path.exists(f"{search_path}/{item}")]
+        if not candidates and refresh_source_index(source_index, search_path):
+            candidates = lookup_source_index(source_index, filename)
+        if candidates:
+            print(f"{search_path}/{candidates[0]}")
+            return f"{search_path}/{candidates[0]}"
+        print(f"Could not find the file {search_path}/{relative_path}")
+        return None
+
+    for root, dir, files in os.walk(search_path):
+        if os.path.basename(filename) in files:
+            print(f"{search_path}/{os.path.relpath(os.path.join(root, os.path.basename(filename)), search_path)}")
+            return f"{search_path}/{os.path.relpath(os.path.join(root, os.path.basename(filename)), search_path)}"
+        
+    print(f"Could not find the file {search_path}/{relative_path}")   
+    return None
+# --------------------------------------------------------- #
+
+
+
+def build_source_index(search_path, exclude):
+    """
+    This function builds the index of the source files of the target tree.
+    The index maps every folder (relative to search_path) to its mtime and to the source files it contains,
+    a basename -> paths map is derived from it to look the files up (see lookup_source_index).
+    Hidden folders and the entries in exclude (e.g. the fuzzer output folder) are skipped.
+    """
+
+    source_index = {"exclude": sorted(exclude), "folders": {}, "basenames": {}}
+    index_folder(source_index, search_path, '.')
+    update_basenames(source_index)
+    return source_index
+# --------------------------------------------------------- #
+
+
+
+def index_folder(source_index, search_path, folder):
+    """
+    This function adds a folder and its subfolders to the source index.
+    """
+
+    for root, dirs, files in os.walk(f"{search_path}/{folder}"):
+        relative_root = os.path.normpath(os.path.relpath(root, search_path))
+        dirs[:] = [item for item in dirs if not item.startswith('.') and os.path.normpath(f"{relative_root}/{item}") not in source_index["exclude"]]
+        source_index["folders"][relative_root] = {
+            "mtime": os.stat(root).st_mtime,
+            "files": [item for item in files if item.endswith(SOURCE_EXTENSIONS)],
+            "subfolders": dirs[:]
+        }
+# --------------------------------------------------------- #
+
+
+
+def update_basenames(source_index):
+    """
+    This function rebuilds the basename -> paths map of the source index.
+    """
+
+    basenames = {}
+    for folder, info in source_index["folders"].items():
+        for item in info["files"]:
+            basenames.setdefault(item, []).append(os.path.normpath(f"{folder}/{item}"))
+    source_index["basenames"] = basenames
+# --------------------------------------------------------- #
+
+
+
+def refresh_source_index(source_index, search_path):
+    """
+    This function updates the source index: only the folders whose mtime has changed (a file has been added, removed
+    or renamed) are listed again, the folders that no longer exist are removed.
+    It returns True if the index has changed.
+    """
+
+    changed = False
+    for folder in list(source_index["folders"]):
+        if folder not in source_index["folders"]:
+            continue # removed together with its parent
+        try:
+            mtime = os.stat(f"{search_path}/{folder}").st_mtime
+        except OSError:
+            mtime = None
+
+        if mtime == source_index["folders"][folder]["mtime"]:
+            continue
+
+        changed = True
+        old_subfolders = set(source_index["folders"][folder]["subfolders"])
+        if mtime is None:
+            remove_folder_from_index(source_index, folder)
+            continue
+
+        # the folder itself is listed again, its new subfolders are indexed and the removed ones are dropped
+        entries = os.listdir(f"{search_path}/{folder}")
+        subfolders = [item for item in entries if os.path.isdir(f"{search_path}/{folder}/{item}") and not item.startswith('.')
+                      and os.path.normpath(f"{folder}/{item}") not in source_index["exclude"]]
+        source_index["folders"][folder] = {
+            "mtime": mtime,
+            "files": [item for item in entries if item.endswith(SOURCE_EXTENSIONS) and os.path.isfile(f"{search_path}/{folder}/{item}")],
+            "subfolders": subfolders
+        }
+        for item in old_subfolders - set(subfolders):
+            remove_folder_from_index(source_index, os.path.normpath(f"{folder}/{item}"))
+        for item in set(subfolders) - old_subfolders:
+            index_folder(source_index, search_path, os.path.normpath(f"{folder}/{item}"))
+
+    if changed:
+        update_basenames(source_index)
+    return changed
+# --------------------------------------------------------- #
+
+
 
-    stdout, stderr = shell.communicate()
-# --------------------------------------------------------- #
+def remove_folder_from_index(source_index, folder):
+    """
+    This function removes a folder and its subfolders from the source index.
+    """
 
+    for item in [item for item in source_index["folders"] if item == folder or item.startswith(f"{folder}/")]:
+        del source_index["folders"][item]
+# --------------------------------------------------------- #
 
 
 
-def run_program(path, file_path, faulty_input_filename):
+def lookup_source_index(source_index, filename):
+    """
+    This function returns the paths of the indexed files with the same basename of filename,
+    sorted by the length of the path suffix they share with filename (longest first).
     """
-    This function runs the target application following the instructions provided,
-    its purpose is to run the application without the fuzzer with the bug-triggering input.
 
-    To do this, we need to fetch the user-provided instructions and substitute the placeholder "INPUT"
-    or "INPUT_STDIN" with the filename of the bug-inducing input or the content of the bug-inducing input, respectively.
+    candidates = source_index["basenames"].get(os.path.basename(filename), [])
+    components = os.path.normpath(filename).split('/')[::-1]
 
-    Then, the function returns the content of stderr
-    """
+    def shared_suffix(candidate):
+        length = 0
+        for a, b in zip(components, candidate.split('/')[::-1]):
+            if a != b:
+                break
+            length += 1
+        return length
 
+    return sorted(candidates, key=shared_suffix, reverse=True)
+# --------------------------------------------------------- #
 
-    shell = Popen(["/bin/bash"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
 
-    #move into the target directory
-    command = f"cd ./{path}"
-    shell.stdin.write((command + '\n').encode())
-    shell.stdin.flush()
 
-    with open(f"{path}/{file_path}", 'r') as file:
-        command = file.readline().strip()
+def load_source_index(file_path, search_path, exclude):
+    """
+    This function loads the source index from disk and refreshes it, if it does not exist (or it has been built
+    with different excluded folders) it is built from scratch. The index is saved back to disk if it has changed.
+    """
 
-    if "INPUT_STDIN" in command:
-        with open(f"{path}/{faulty_input_filename}", 'rb') as file:
-            faulty_input = str(file.read())
-        command = command.replace("INPUT_STDIN", faulty_input)
-    else:
-        command = command.replace("INPUT", faulty_input_filename)
+    source_index = None
+    if os.path.exists(file_path):
+        with open(file_path, 'r') as file:
+            source_index = json.load(file)
+        if source_index.get("exclude") != sorted(exclude):
+            source_index = None
+
+    if source_index is None:
+        print("building the source index...", end='')
+        source_index = build_source_index(search_path, exclude)
+        print(f" - {sum(len(paths) for paths in source_index['basenames'].values())} source files")
+    elif not refresh_source_index(source_index, search_path):
+        return source_index
+
+    save_source_index(source_index, file_path)
+    return source_index
+# --------------------------------------------------------- #
 
-    print(f"running: {command}")
 
-    # Send the command to the shell
-    shell.stdin.write((command + '\n').encode())
-    shell.stdin.flush()
 
-    stdout, stderr = shell.communicate()
+def save_source_index(source_index, file_path):
+    """
+    This function writes the source index to disk.
+    """
 
-    if stderr:
-        print("the target is crashing")
-        return True, stderr.decode("utf-8", errors="ignore")
-    else:
-        print("the target is not crashing")
-        return False, ''
+    with open(f"{file_path}.tmp", 'w') as file:
+        json.dump(source_index, file)
+    os.replace(f"{file_path}.tmp", file_path)
 # --------------------------------------------------------- #
 
 
 
 
-def monitor_folder(path, queue, stop_event):
+def get_function_code(file_path, function_name):
     """
-    This function monitors the folder containing the output (the bug-inducing inputs) of the fuzzer.
-    The fuzzer will add a new file everytime the target application crashes, therefore we monitor the
-    folder to detect when and with which input the target application crashes. 
-    Once a new file(s) is added we store them in a queue so that the another thread can access them.
+    This function, given a file path and a function name, will return the first line of the body of the function
+    (the line after the opening curly brace), its last line (the closing curly brace) and its code.
+
+    The functions are looked up in the function index of the file (see get_function_index), which is built once and kept in memory.
+    If the function is not in the index (e.g. it is defined through a macro) the file is scanned line by line (see scan_function_code).
+    For a function written on one line the first line of the body is after the last one, the function is replaced by its
+    byte range anyway (see replace_function_in_c_file). The functions whose body crosses a preprocessor conditional
+    (e.g. an #else with another signature and opening curly brace) cannot be replaced without breaking a branch, None is returned.
     """
 
-    files_set = set(os.listdir(path))
+    print(f"Searching for function {function_name} in file {file_path}")
+    entry = find_indexed_function(get_function_index(file_path), function_name)
+    if entry is None:
+        return scan_function_code(file_path, get_function_lookup_names(function_name)[-1])
+    if entry["crosses_conditional"]:
+        print(f"The body of the function {function_name} in file {file_path} crosses a preprocessor conditional, it is skipped")
+        return None, None, None
 
-    while not stop_event.is_set():
-        new_files_set = set(os.listdir(path))
-        if new_files_set != files_set:
-            added_files = new_files_set - files_set
-            if added_files and (len(added_files) > 1 or "README.txt" not in added_files):
-                print(f"New files added: {', '.join(added_files)}")
-                added_files.discard("README.txt")
-                for item in added_files:
-                    queue.put(item)
-            files_set = new_files_set
+    with open(file_path, 'r') as file:
+        lines = file.readlines()
 
-        time.sleep(1)  # wait for 1 second
+    print(f"Found function {function_name} in file {file_path}")
+    return entry["body_line"] + 1, entry["end_line"], ''.join(lines[entry["start_line"] - 1 : entry["end_line"]])
 # --------------------------------------------------------- #
 
 
 
-           
-def ask_llm_to_find(client, report, logs_folder_name):
+def get_function_lookup_names(function_name):
     """
-    Creates and sends the request to Claude3 and returns the response from it.
-    This function in used to ask the LLM to parse generic bug reports.
-
-    The reponse should contain a json file containing a list of items
-    each item should contain the file name, function name and line number.
-
-    A log is kept of the answer of the LLM in a file called log_llm.txt.
+    This function returns the names under which a function of a stack frame can be in the function index, from the most
+    to the least qualified. The C++ frames have the full signature (e.g. "ns::Foo::bar(int, char const*) const"):
+    the parameter list, the qualifiers after it and the template arguments are removed, then the namespace and class
+    qualifiers one by one ("ns::Foo::bar", "Foo::bar", "bar"). A C frame gives only its name.
     """
 
-    print("we ask the LLM to find the file and functions responsible for the bug")
-    # completion =  client.chat.completions.create(
-
-    #     messages=[
-    #         {
-    #             "role": "user",
-    #             "content": report + """Given this information in which files and functions should i look into to locate the bug? Return the results in a json format structured like the following example, without any additional comments.
-    #             [{
-    #                 "file": "example1.py",
-    #                 "function": "function1"
-    #                 "line": 10
-    #             }]""",
-    #         }
-    #     ],
+    name = re.sub(r"(\s+(const|volatile|&&|&)|\s*noexcept)+\s*$", "", function_name.strip())
+    # the parameter list is the last balanced parentheses, they can be nested (e.g. a function pointer parameter)
+    if name.endswith(')'):
+        depth = 0
+        for position in range(len(name) - 1, -1, -1):
+            depth += {')': 1, '(': -1}.get(name[position], 0)
+            if depth == 0:
+                name = name[:position]
+                break
+    # the template arguments, unless they are part of an operator (e.g. operator<)
+    if "operator" not in name:
+        while re.search(r"<[^<>]*>", name):
+            name = re.sub(r"<[^<>]*>", "", name)
 
-    #     model="gpt-3.5-turbo",
-    # )
+    parts = name.strip().split("::")
+    return ["::".join(parts[i:]) for i in range(len(parts))]
+# --------------------------------------------------------- #
 
-    message = client.messages.create (
-        model="claude-3-opus-20240229",
-        max_tokens=1000,
-        temperature=0.0,
-        system="Respond only in Yoda-speak.",
-        messages=[
-            {
-                "role": "user",
-                "content": report + """Given this information in which files and functions should i look into to locate the bug? Return the results in a json format structured like the following example, without any additional comments.
-                [{
-                    "file": "example1.py",
-                    "function": "function1"
-                    "line": 10
-                }]""",
-            }
-        ]
-    )
 
-    if message.content[0].type == "error":
-        with open(f"{logs_folder_name}/log_llm.txt", 'a') as file:
-            file.write(f"Response from Claude: ERROR\n\n\n\n")
-        return None
-    text = message.content[0].text
 
-    with open(f"{logs_folder_name}/log_llm.txt", 'a') as file:
-        file.write("ask_llm_to_find\n")
-        file.write(f"report:\n{report}\n\n")
-        #file.write(f"Response from OpenAI\n{completion.choices[0].message.content}\n\n\n\n")
-        file.write(f"Response from Claude\n{text}\n\n\n\n")
-    
+def find_indexed_function(index, function_name):
+    """
+    This function looks up a function of a stack frame in a function index (see get_function_index), trying every
+    name returned by get_function_lookup_names. It returns the entry of the function, None if it is not in the index.
+    """
 
-    #if completion.choices[0].message.content starts with ``` then we want to discard the first and last line
-    # if completion.choices[0].message.content.startswith("```"):
-    #     return '\n'.join(completion.choices[0].message.content.split('\n')[1:-1]) #we return a string
-    if text.startswith("```"):
-        return '\n'.join(text.split('\n')[1:-1])
-    
-    #return completion.choices[0].message.content
-    return text
+    return next((index[name] for name in get_function_lookup_names(function_name) if name in index), None)
 # --------------------------------------------------------- #
 
 
 
-
-def ask_llm_to_fix(client, report, function_code, logs_folder_name):
+def get_function_index(file_path):
     """
-    This function creates and sends the request to Claude3 and returns its response.
-    This function asks the LLM to return the fixed code of given a buggy function.
+    This function returns the function index of a C/C++ file: a dictionary that maps every function name to its byte range
+    and to the lines where its definition starts, where its body starts (opening curly brace) and where it ends.
+    The index is kept in memory and built again only if the file has been modified by someone else,
+    replace_function_in_c_file keeps it up to date (see update_function_index).
     """
 
-    print("asking llm for a fix")
-    # completion =  client.chat.completions.create(
+    stat = os.stat(file_path)
+    cached = FUNCTION_INDEX.get(file_path)
+    if cached is None or cached["mtime"] != stat.st_mtime_ns or cached["size"] != stat.st_size:
+        # latin-1 maps every byte to one character, so the offsets in the text are byte offsets in the file
+        with open(file_path, 'rb') as file:
+            text = file.read().decode("latin-1")
+        cached = {"mtime": stat.st_mtime_ns, "size": stat.st_size, "functions": index_c_functions(text)}
+        FUNCTION_INDEX[file_path] = cached
 
-    #     messages=[
-    #         {
-    #             "role": "user",
-    #             "content": f"{report}\n{function_code}\n Given this information, provide a fix. Return the fixed code for the whole function without any additional comments.",
-    #         }
-    #     ],
+    return cached["functions"]
+# --------------------------------------------------------- #
 
-    #     model="gpt-3.5-turbo",
-    # )
-    message = client.messages.create (
-        model="claude-3-opus-20240229",
-        max_tokens=1000,
-        temperature=0.0,
-        system="Respond only in Yoda-speak.",
-        messages=[
-            {
-                "role": "user",
-                "content": f"{report}\n{function_code}\n Given this information, provide a fix. Return just the fixed code for the whole function without any additional comments, only the code itself.",
-            }
-        ]
-    )
-    print("Response from Claude3")
-    # print(completion.choices[0].message.content)
-    # print("\n\n")
 
-    if message.content[0].type == "error":
-        with open(f"{logs_folder_name}/log_llm.txt", 'a') as file:
-            file.write(f"Response from Claude: ERROR\n\n\n\n")
-        return None
-    text = message.content[0].text
 
+def index_c_functions(text):
+    """
+    This function finds the definitions of the functions in the code of a C/C++ file in one pass.
+    The code is split in tokens (see C_TOKEN_PATTERN) so that comments, strings, character literals and preprocessor
+    directives are skipped and the braces they contain are not counted, only one branch of every #if/#else is read.
+    At the top level (outside of any function, struct or initializer) a definition is an identifier followed by a parameter
+    list and by an opening curly brace, prototypes (ending with ';') and initializers ('=') are ignored.
+    namespace and extern "C" blocks are transparent, C++ qualified names (Class::method) are indexed with and without the class.
+    """
 
-    with open(f"{logs_folder_name}/log_llm.txt", 'a') as file:
-        file.write("ask_llm_to_fix\n")
-        file.write(f"function code:\n{function_code}\n\n")
-        #file.write(f"Response from OpenAI\n{completion.choices[0].message.content}\n\n\n\n")
-        file.write(f"Response from Claude\n{text}\n\n\n\n")
+    newlines = [match.start() for match in re.finditer('\n', text)]
+
+    def line_of(position):
+        return bisect.bisect_left(newlines, position) + 1
+
+    functions = {}
+    blocks = [] # the blocks opened at the top level, "transparent" (namespace, extern "C") or "block" (struct, enum, initializer)
+
+    def reset():
+        return {"start": None, "name": None, "params_closed": False, "not_a_function": False, "init_list": False,
+                "paren_depth": 0, "identifier": None, "qualify": False, "tokens": []}
+    declaration = reset()
+    previous_kind = None
+    body_start = None
+    depth = 0
+
+    # preprocessor conditionals: only one branch of every #if/#else chain is read, otherwise braces opened in both
+    # branches would be counted twice. The first branch is read, unless it is "#if 0"
+    conditionals = []
+    # a body that starts in a branch and ends after it (#else, #elif or #endif of a conditional opened before the body)
+    # crosses the conditional
+    body_conditionals = 0
+    crosses_conditional = False
+
+    for match in C_TOKEN_PATTERN.finditer(text):
+        kind = match.lastgroup
+        if kind == "directive":
+            directive = re.match(r"\s*#\s*(\w*)\s*(.*)", match.group(), re.S)
+            keyword, condition = directive.group(1), directive.group(2).strip()
+            if body_start is not None and keyword in ("elif", "else", "endif") and len(conditionals) <= body_conditionals:
+                crosses_conditional = True
+            if keyword in ("if", "ifdef", "ifndef"):
+                dead = keyword == "if" and condition == '0'
+                conditionals.append({"skip": dead, "taken": not dead})
+            elif keyword in ("elif", "else") and conditionals:
+                conditionals[-1]["skip"] = conditionals[-1]["taken"]
+                conditionals[-1]["taken"] = True
+            elif keyword == "endif" and conditionals:
+                conditionals.pop()
+            continue
+        if kind == "comment" or any(item["skip"] for item in conditionals):
+            continue
+        token = match.group()
+
+        # inside a function body we only count the curly braces
+        if body_start is not None:
+            if token == '{':
+                depth += 1
+            elif token == '}':
+                depth -= 1
+                if depth == 0:
+                    entry = {
+                        "start": declaration["start"],
+                        "body": body_start + 1,
+                        "end": match.end(),
+                        "start_line": line_of(declaration["start"]),
+                        "body_line": line_of(body_start),
+                        "end_line": line_of(match.start()),
+                        "crosses_conditional": crosses_conditional
+                    }
+                    functions.setdefault(declaration["name"], entry)
+                    functions.setdefault(declaration["name"].split("::")[-1], entry)
+                    body_start = None
+                    declaration = reset()
+            continue
+
+        # the content of structs, enums and initializers is skipped
+        if "block" in blocks:
+            if token == '{':
+                blocks.append("block")
+            elif token == '}':
+                blocks.pop()
+            continue
+
+        if declaration["start"] is None:
+            declaration["start"] = match.start()
+
+        if kind == "identifier":
+            if declaration["qualify"] and declaration["identifier"]:
+                declaration["identifier"] = f"{declaration['identifier']}::{token}"
+            else:
+                declaration["identifier"] = token
+            declaration["qualify"] = False
+            declaration["tokens"].append(token)
+        elif kind == "string":
+            declaration["tokens"].append('"')
+        elif token == "::":
+            declaration["qualify"] = True
+        elif token == '(':
+            name = declaration["identifier"]
+            if (declaration["paren_depth"] == 0 and previous_kind == "identifier" and not declaration["init_list"]
+                    and name.split("::")[-1] not in NOT_FUNCTION_NAMES):
+                declaration["name"] = name
+                declaration["params_closed"] = False
+            declaration["paren_depth"] += 1
+        elif token == ')':
+            declaration["paren_depth"] = max(declaration["paren_depth"] - 1, 0)
+            if declaration["paren_depth"] == 0 and declaration["name"]:
+                declaration["params_closed"] = True
+        elif declaration["paren_depth"] > 0:
+            pass
+        elif token == '=':
+            declaration["not_a_function"] = True
+        elif token == ':':
+            # C++ constructor initializer list
+            if declaration["params_closed"]:
+                declaration["init_list"] = True
+        elif token == ';':
+            declaration = reset()
+        elif token == '{':
+            if declaration["name"] and declaration["params_closed"] and not declaration["not_a_function"]:
+                body_start = match.start()
+                depth = 1
+                body_conditionals = len(conditionals)
+                crosses_conditional = False
+            elif "namespace" in declaration["tokens"] or declaration["tokens"][:2] == ["extern", '"']:
+                blocks.append("transparent")
+                declaration = reset()
+            else:
+                blocks.append("block")
+        elif token == '}':
+            if blocks:
+                blocks.pop()
+            declaration = reset()
+
+        previous_kind = kind if token != '(' else None
+
+    return functions
+# --------------------------------------------------------- #
 
-    #if completion.choices[0].message.content starts with ``` then we want to discard the first and last line
-    # if completion.choices[0].message.content.startswith("```"):
-    #     return '\n'.join(completion.choices[0].message.content.split('\n')[1:-1])
-    if text.startswith("```"):
-        return '\n'.join(text.split('\n')[1:-1])
 
-    # return completion.choices[0].message.content
-    return text
-# --------------------------------------------------------- #
 
+def update_function_index(file_path, starting_line, ending_line, line_delta, byte_delta, balanced):
+    """
+    This function updates the function index of a file after replace_function_in_c_file has replaced the body of a function,
+    from starting_line (the line after the opening curly brace) to ending_line: the functions that follow are moved by
+    line_delta lines and byte_delta bytes and the function that has been replaced is resized.
+    If the new code does not have balanced curly braces the index of the file is dropped and will be built again.
+    """
+
+    cached = FUNCTION_INDEX.get(file_path)
+    if cached is None:
+        return
+    if not balanced:
+        del FUNCTION_INDEX[file_path]
+        return
+
+    # qualified functions are indexed twice, every entry is updated only once
+    for entry in {id(entry): entry for entry in cached["functions"].values()}.values():
+        if entry["start_line"] > ending_line:
+            for key in ("start_line", "body_line", "end_line"):
+                entry[key] += line_delta
+            for key in ("start", "body", "end"):
+                entry[key] += byte_delta
+        elif entry["end_line"] >= ending_line and entry["body_line"] < starting_line:
+            entry["end_line"] += line_delta
+            entry["end"] += byte_delta
+
+    stat = os.stat(file_path)
+    cached["mtime"] = stat.st_mtime_ns
+    cached["size"] = stat.st_size
+# --------------------------------------------------------- #
 
 
 
-def find_file(filename, search_path):
+def count_curly_braces(code):
     """
+    This function returns the difference between the closing and the opening curly braces in a piece of C/C++ code,
+    ignoring the ones in comments, strings and character literals.
     """
 
-    # Check if search_path is in filename and exclude everything in filename that comes before it
-    if search_path in filename:
-        relative_path = filename.split(search_path, 1)[1].lstrip('/')
-    else:
-        return None
-
-    for root, dir, files in os.walk(search_path):
-        if os.path.basename(filename) in files:
-            print(f"{search_path}/{os.path.relpath(os.path.join(root, os.path.basename(filename)), search_path)}")
-            return f"{search_path}/{os.path.relpath(os.path.join(root, os.path.basename(filename)), search_path)}"
-        
-    print(f"Could not find the file {search_path}/{relative_path}")   
-    return None
+    difference = 0
+    for match in C_TOKEN_PATTERN.finditer(code):
+        if match.group() == '}':
+            difference += 1
+        elif match.group() == '{':
+            difference -= 1
+    return difference
 # --------------------------------------------------------- #
 
 
 
-
-def get_function_code(file_path, function_name):
+def scan_function_code(file_path, function_name):
     """
     This function, given a file path and a function name, will return the code of the function
 
@@ -363,7 +2907,6 @@ def get_function_code(file_path, function_name):
     finally the function code is extracted and returned up to the closing curly brace
     """
 
-    print(f"Searching for function {function_name} in file {file_path}")
     with open(file_path, 'r') as file:
         lines = file.readlines()
 
@@ -439,7 +2982,7 @@ def process_new_function_code(function_code, function_name):
     """
 
     lines = function_code.split('\n')
-    if function_name in lines[0]:
+    if get_function_lookup_names(function_name)[-1] in lines[0]:
         opening_brace_index = function_code.find('{')
         if opening_brace_index != -1:
             #print("Opening brace found")
@@ -452,39 +2995,538 @@ def process_new_function_code(function_code, function_name):
 def replace_function_in_c_file(filepath, function_name, new_function_code, starting_line, ending_line):
     """
     This function replaces the code of a function in a C file with the new code provided.
+    If the function is in the function index (see get_function_code) its byte range is replaced, from the opening curly brace
+    to the closing one, so that the code before and after them on the same lines is kept (e.g. a function written on one line);
+    otherwise the lines from starting_line to ending_line are replaced.
     """
 
+    new_function_code = process_new_function_code(new_function_code, function_name)
+
+    entry = find_indexed_function(get_function_index(filepath), function_name)
+    if entry is not None and entry["body_line"] + 1 == starting_line and entry["end_line"] == ending_line:
+        with open(filepath, 'rb') as file:
+            content = file.read()
+        old_code = content[entry["body"] : entry["end"]]
+        new_code = new_function_code.rstrip().encode()
+        line_delta = new_code.count(b'\n') - old_code.count(b'\n')
+        balanced = count_curly_braces(new_code.decode("latin-1")) == count_curly_braces(old_code.decode("latin-1"))
+
+        with open(filepath, 'wb') as file:
+            file.write(content[:entry["body"]] + new_code + content[entry["end"]:])
+
+        update_function_index(filepath, starting_line, ending_line, line_delta, len(new_code) - len(old_code), balanced)
+        return
+
     with open(filepath, 'r') as file:
         lines = file.readlines()
 
-    new_function_code = process_new_function_code(new_function_code, function_name)
+    # Split the new function code into lines, adding the newline characters back
+    new_lines = [line + '\n' for line in new_function_code.split('\n')]
+
+    # the function index of the file is moved by the difference in lines and bytes
+    old_lines = lines[starting_line - 1 : ending_line]
+    line_delta = len(new_lines) - len(old_lines)
+    byte_delta = len(''.join(new_lines).encode()) - len(''.join(old_lines).encode())
+    balanced = count_curly_braces(''.join(new_lines)) == count_curly_braces(''.join(old_lines))
+
+    # Replace the lines with the new function code
+    lines[starting_line - 1 : ending_line] = new_lines
+
+    with open(filepath, 'w') as file:
+        file.writelines(lines)
+
+    update_function_index(filepath, starting_line, ending_line, line_delta, byte_delta, balanced)
+# --------------------------------------------------------- #
+
+
+
+def snapshot_files(snapshot, file_paths):
+    """
+    This function adds to the snapshot (a dictionary from the path of a file to its content) the files that are not in it yet.
+    The snapshot is kept in memory: it holds only the files of the buggy functions, taken before they are patched,
+    so that every fix attempt starts from the original code (see restore_files).
+    """
+
+    for file_path in file_paths:
+        if file_path not in snapshot:
+            with open(file_path, 'rb') as file:
+                snapshot[file_path] = file.read()
+# --------------------------------------------------------- #
+
+
+
+def restore_files(snapshot):
+    """
+    This function writes back the content of the files in the snapshot that have been modified since it was taken.
+    It returns the set of the restored files, the ones that must be rebuilt.
+    """
+
+    restored = set()
+    for file_path, content in snapshot.items():
+        with open(file_path, 'rb') as file:
+            if file.read() == content:
+                continue
+        with open(file_path, 'wb') as file:
+            file.write(content)
+        # the function index of the file is built again at the next lookup
+        FUNCTION_INDEX.pop(file_path, None)
+        restored.add(file_path)
+    return restored
+# --------------------------------------------------------- #
+
+
+
+def export_fix_diff(snapshot, tree_path, diff_path):
+    """
+    This function writes the unified diff between the files in the snapshot and their current content in the tree,
+    with paths relative to the tree, so that the fix can be applied elsewhere with patch -p1 or git apply.
+    It returns the diff, empty if nothing has changed.
+    """
+
+    diff = []
+    for file_path, content in sorted(snapshot.items()):
+        with open(file_path, 'rb') as file:
+            new_content = file.read()
+        if new_content == content:
+            continue
+        relative_path = os.path.relpath(file_path, tree_path)
+        diff += difflib.unified_diff(content.decode("latin-1").splitlines(keepends=True), new_content.decode("latin-1").splitlines(keepends=True),
+                                     f"a/{relative_path}", f"b/{relative_path}")
+
+    diff = ''.join(line if line.endswith('\n') else line + "\n\\ No newline at end of file\n" for line in diff)
+    if diff:
+        os.makedirs(os.path.dirname(diff_path), exist_ok=True)
+        with open(diff_path, 'w', encoding="latin-1") as file:
+            file.write(diff)
+    return diff
+# --------------------------------------------------------- #
+
+
+
+def create_worktree(path, worktree_path, exclude):
+    """
+    This function creates a copy of the target tree where a candidate fix can be applied, built and run
+    without touching the original tree.
+    The copy is made with "cp --reflink=auto" so that, on filesystems that support it (btrfs, xfs), the files are
+    shared copy-on-write and the copy is almost free; on other filesystems a regular copy is made.
+    The build artifacts are copied as well so that the candidate can be rebuilt incrementally.
+    The top-level entries in exclude (e.g. the fuzzer output folder) are not copied.
+    """
+
+    os.makedirs(worktree_path)
+    entries = [f"{path}/{item}" for item in os.listdir(path) if item not in exclude]
+    if not entries:
+        return
+
+    result = run(["cp", "-a", "--reflink=auto"] + entries + [worktree_path], stdout=DEVNULL, stderr=DEVNULL)
+    if result.returncode != 0:
+        for entry in entries:
+            destination = f"{worktree_path}/{os.path.basename(entry)}"
+            if os.path.isdir(entry) and not os.path.islink(entry):
+                shutil.copytree(entry, destination, symlinks=True, dirs_exist_ok=True)
+            else:
+                shutil.copy2(entry, destination, follow_symlinks=False)
+# --------------------------------------------------------- #
+
+
+
+def sync_tree(source_path, destination_path, exclude):
+    """
+    This function makes a copy of the target tree (see create_worktree) equal to another one: the files whose size or
+    modification time differ are copied, preserving their modification time so that make sees the same state in both trees.
+    The files that only exist in the destination are left there. The top-level entries in exclude are skipped.
+    """
+
+    for root, dirs, files in os.walk(source_path):
+        relative_root = os.path.relpath(root, source_path)
+        if relative_root == '.':
+            dirs[:] = [item for item in dirs if item not in exclude and item != ".afl_loop_input"]
+            files = [item for item in files if item not in exclude]
+        os.makedirs(f"{destination_path}/{relative_root}", exist_ok=True)
+
+        for item in files + [item for item in dirs if os.path.islink(f"{root}/{item}")]:
+            source = f"{root}/{item}"
+            destination = f"{destination_path}/{relative_root}/{item}"
+            source_stat = os.lstat(source)
+            try:
+                destination_stat = os.lstat(destination)
+                if destination_stat.st_size == source_stat.st_size and destination_stat.st_mtime_ns == source_stat.st_mtime_ns:
+                    continue
+                os.remove(destination)
+            except FileNotFoundError:
+                pass
+            shutil.copy2(source, destination, follow_symlinks=False)
+# --------------------------------------------------------- #
+
+
+
+def evaluate_candidate(worktree_path, build_instr, run_instr, crash_input, patches, rebuild_instr, object_cache_path, run_options, compilation_database=None):
+    """
+    This function applies a candidate fix to a worktree, rebuilds it and runs it with the bug-triggering input.
+    It is run in a worker process, one for each candidate.
+    patches is a list of dictionaries containing the file (relative to the target tree), the function and the new code of the function.
+    If rebuild_instr is None the whole build script is run, run_options are passed to run_program.
+    If compilation_database is provided the patched files are checked (see check_syntax) and a candidate that does not compile is not built.
+    It returns if the target is still crashing, the report (the compiler errors if the candidate does not compile) and the files that have been modified.
+    """
+
+    touched_files = set()
+    for patch in patches:
+        file_path = f"{worktree_path}/{patch['file']}"
+        starting_line, ending_line, _ = get_function_code(file_path, patch["function"])
+        if starting_line is None:
+            continue
+        replace_function_in_c_file(file_path, patch["function"], patch["code"], starting_line, ending_line)
+        touched_files.add(file_path)
+
+    if not touched_files:
+        return True, '', []
+
+    diagnostics = check_syntax(compilation_database, touched_files, worktree_path) if compilation_database else None
+    if diagnostics is not None:
+        return True, add_compiler_diagnostics('', diagnostics), []
+
+    rebuild_tree(worktree_path, build_instr, rebuild_instr, touched_files, object_cache_path)
+
+    is_crashing, report = run_program(worktree_path, run_instr, crash_input, **run_options)
+    return is_crashing, report, [os.path.relpath(file_path, worktree_path) for file_path in touched_files]
+# --------------------------------------------------------- #
+
+
+
+def rebuild_tree(path, build_instr, rebuild_instr, touched_files, object_cache_path):
+    """
+    This function rebuilds a tree after touched_files have been modified: incrementally (see rebuild_program)
+    or, if rebuild_instr is None, with the whole build script.
+    """
+
+    if rebuild_instr is not None:
+        rebuild_program(path, build_instr, rebuild_instr, touched_files, object_cache_path)
+    else:
+        build_program(path, build_instr)
+# --------------------------------------------------------- #
+
+
+
+def remove_worktrees(executor, worktrees_path):
+    """
+    This function waits for the candidates that are still running to finish and removes their worktrees.
+    It is run in a separate thread so that the loop can go on as soon as a candidate has fixed the bug.
+    """
+
+    executor.shutdown(wait=True)
+    shutil.rmtree(worktrees_path, ignore_errors=True)
+# --------------------------------------------------------- #
+
+
+
+def collect_buggy_functions(buggy_functions, path, logs_folder_name, source_index=None, tree_path=None):
+    """
+    This function looks for the file and the code of every buggy function.
+    The files are looked up in the target tree (path), if tree_path is provided the code is read from the same file
+    in that copy of the target tree (e.g. the repair snapshot).
+    It returns a list of tuples containing the path of the file, the name and the code of the function,
+    the functions whose file or code cannot be found are skipped.
+    """
+
+    functions = []
+    for item in buggy_functions:
+        file_path = find_file(item["file"], path, source_index)
+        print(f"file_path: {file_path}")
+        if file_path is None:
+            with open(f"{logs_folder_name}/log.txt", 'a') as file:
+                file.write(f"Could not find the file {item['file']} @ {time.ctime()}\n")
+            continue
+        if tree_path is not None:
+            file_path = f"{tree_path}/{os.path.relpath(file_path, path)}"
+        # the C++ frames have the full signature, the function is sent to the LLM with its qualified name only
+        function_name = get_function_lookup_names(item["function"])[0]
+        starting_line, ending_line, function_code = get_function_code(file_path, function_name)
+        print(f"starting_line: {starting_line}, ending_line: {ending_line}")
+        if starting_line is not None:
+            print(f"function_code: {function_code}")
+            functions.append((file_path, function_name, function_code))
+
+    return functions
+# --------------------------------------------------------- #
+
+
+
+def triage_crash(new_file, path, fuzzer_output_folder, run_instr, config, crash_index, crash_index_path, store, logs_folder_name, index_lock):
+    """
+    This function reproduces a new crash found by the fuzzer and computes its signature (see compute_crash_signature).
+    The inputs that do not crash and the duplicates of a known bucket are recorded and dropped, the crash index is updated under index_lock.
+    It returns the info of the crash (see CrashQueue.put_triaged), None if it has been dropped.
+    """
+
+    with open(f"{logs_folder_name}/log.txt", 'a') as file:
+        file.write(f"new bug-triggering input: {new_file} @ {time.ctime()}\n")
+    # the crash stays pending until it has been handled, so that it is resumed if the script is stopped in the meantime
+    crash_input = f"./{fuzzer_output_folder}/{new_file}"
+    if store is not None:
+        store.add_crash(new_file, f"{path}/{crash_input}")
+        # the input is read from its copy in the state folder, the crashes folder of the fuzzer does not survive a restart
+        if store.input_path(new_file) is not None:
+            crash_input = os.path.relpath(store.input_path(new_file), path)
+
+    if not os.path.isfile(f"{path}/{crash_input}"):
+        print(f"the input {new_file} does not exist anymore, skipping")
+        if store is not None:
+            store.update_crash(new_file, "missing")
+        return None
+
+    # we substitute "INPUT" or "INPUT_STDIN" in the provided instructions with the faulty input identified by the fuzzer
+    # the detection latency is the time between the fuzzer writing the input and the input leaving the queue
+    METRICS.event("crash_detection", max(0.0, time.time() - os.path.getmtime(f"{path}/{crash_input}")), input=new_file)
+    with METRICS.timer("reproduce", input=new_file) as fields:
+        is_crashing, report = run_program(path, run_instr, crash_input, **get_run_options(config))
+        fields["crashing"] = is_crashing
+
+    # if we could not reproduce the bug we log it and move on
+    if not is_crashing:
+        with open(f"{logs_folder_name}/log.txt", 'a') as file:
+            file.write(f"No fix needed, moving on @ {time.ctime()}\n\n")
+        if store is not None:
+            store.update_crash(new_file, "not_crashing")
+        return None
+
+    # a hang has no frames to locate the buggy functions, it is recorded and not sent to the repair loop
+    if is_hang(report):
+        print(f"the input {new_file} makes the target hang, skipping")
+        with open(f"{logs_folder_name}/log.txt", 'a') as file:
+            file.write(f"hang {new_file}, not repaired @ {time.ctime()}\n\n")
+        METRICS.event("hang", input=new_file)
+        if store is not None:
+            store.update_crash(new_file, "hang")
+        return None
+
+    # we compute the signature of the crash, if we have already seen it the input is added to the bucket and dropped
+    with METRICS.timer("parse", report_bytes=len(report)):
+        frames, _ = asan_report_parser(report)
+    signature, bug_type, signature_frames = compute_crash_signature(report, frames, config["crash_signature_frames"])
+    if signature is not None:
+        with index_lock:
+            was_fixed = signature in crash_index and crash_index[signature]["status"] == "fixed"
+            is_new_bucket = add_crash_to_index(crash_index, signature, bug_type, signature_frames, new_file)
+            save_crash_index(crash_index, crash_index_path)
+            if store is not None:
+                store.save_bucket(signature, crash_index[signature])
+            count = crash_index[signature]["count"]
+        if not is_new_bucket:
+            print(f"duplicate of crash bucket {signature[:12]} ({count} inputs), skipping")
+            with open(f"{logs_folder_name}/log.txt", 'a') as file:
+                file.write(f"duplicate crash {new_file} of bucket {signature} ({bug_type}), skipping @ {time.ctime()}\n\n")
+            METRICS.event("duplicate", signature=signature)
+            if store is not None:
+                store.update_crash(new_file, "duplicate", signature=signature, bug_type=bug_type)
+            return None
+        if was_fixed:
+            print(f"crash bucket {signature[:12]} had been fixed but {new_file} still crashes, reopening it")
+            with open(f"{logs_folder_name}/log.txt", 'a') as file:
+                file.write(f"fixed bucket {signature} ({bug_type}) reopened by {new_file} @ {time.ctime()}\n")
+            METRICS.event("reopen", signature=signature)
+
+    return {
+        "crash_input": crash_input,
+        "report": report,
+        "frames": frames,
+        "signature": signature,
+        "severity": get_crash_severity(report),
+        "top_frame": signature_frames[0] if signature_frames else None,
+        "found": os.path.getmtime(f"{path}/{crash_input}")
+    }
+# --------------------------------------------------------- #
+
+
+
+def prepare_crash(new_file, info, path, run_instr, config, minimized_inputs_path, store, logs_folder_name, client, compact, compiled_with_asan, source_index, prefetch=False, stop_event=None):
+    """
+    This function prepares the repair of a triaged crash (see triage_crash): the input is minimized, the report is compacted
+    (compact is called with the report and the tree) and the buggy functions are located, from the frames of the report
+    or by asking the LLM if the target is not compiled with ASAN.
+    With prefetch the first fixes are requested as well, for the code of the functions in the target tree.
+    If stop_event is set (see RepairPipeline.stop) the preparation stops before its next step and None is returned.
+    It returns a dictionary with the input, the report, the frames, the signature, the buggy functions,
+    the functions whose fixes have been requested and the fixes (None without prefetch).
+    """
+
+    crash_input, report, frames, signature = info["crash_input"], info["report"], info["frames"], info["signature"]
+    stopped = lambda: stop_event is not None and stop_event.is_set()
+
+    # the input is minimized preserving the signature of the crash, a smaller input reproduces faster and gives a shorter report
+    if config["minimize_inputs"] and not stopped():
+        with METRICS.timer("minimize", input=new_file):
+            minimized_input = minimize_crash_input(path, run_instr, crash_input, signature, config, minimized_inputs_path)
+        if minimized_input != crash_input:
+            minimized_is_crashing, minimized_report = run_program(path, run_instr, minimized_input, **get_run_options(config))
+            if minimized_is_crashing and not is_hang(minimized_report):
+                crash_input, report = minimized_input, minimized_report
+                if store is not None:
+                    store.update_crash(new_file, "pending", minimized_input=minimized_input)
+                frames, _ = asan_report_parser(report)
+                with open(f"{logs_folder_name}/log.txt", 'a') as file:
+                    file.write(f"minimized {new_file} into {minimized_input} @ {time.ctime()}\n")
+
+    if stopped():
+        return None
+
+    # the report sent to the LLM keeps only the bug type, the frames of the target and the faulting lines
+    report = compact(report, path)
+
+    # we try to fix the program leveraging an LLM model (e.g. ChatGPT 3.5)
+    # first of all if we have a generic report we use the LLM to find file, fucntion and line of possible buggy functions
+    if not compiled_with_asan:
+        file_to_check_json = ask_llm_to_find(client, report, logs_folder_name)
+        buggy_functions = parse_llm_buggy_function_response(file_to_check_json)
+    # otherwise we use the frames of the ASAN report
+    else:
+        buggy_functions = frames
+
+    functions, fixes = [], None
+    if stopped():
+        return None
+    if prefetch:
+        functions = collect_buggy_functions(buggy_functions, path, logs_folder_name, source_index)
+        if functions and not stopped():
+            fixes = client.run(request_fixes_async(client, report, functions, logs_folder_name, config["batch_fix_requests"]))
+
+    return {
+        "crash_input": crash_input,
+        "report": report,
+        "frames": frames,
+        "signature": signature,
+        "buggy_functions": buggy_functions,
+        "functions": functions,
+        "fixes": fixes
+    }
+# --------------------------------------------------------- #
+
+
+
+def fix_with_parallel_candidates(client, report, functions, path, build_instr, run_instr, crash_input, config, tmp_path, exclude, object_cache_path, logs_folder_name, validate=None, compilation_database=None):
+    """
+    This function asks the LLM for num_candidates fixes of the buggy functions (see collect_buggy_functions), applies each candidate to its own
+    worktree (see create_worktree) and builds and runs them in parallel in a process pool.
+    The first candidate that stops the crash wins: its modified files are copied back into the target tree, which is rebuilt.
+    If validate is provided it is called with the target tree to check the winner (see check_regressions), a candidate it rejects
+    is removed from the target tree and the next candidate is considered.
+    compilation_database is passed to evaluate_candidate, the compiler errors of a candidate are added to the report of the next round.
+    The target tree is modified only if a candidate has fixed the bug, so every round starts from the original code.
+    It returns if the target is still crashing, the report of a failed candidate and if any candidate has been evaluated.
+    """
 
-    # Split the new function code into lines, adding the newline characters back
-    new_lines = [line + '\n' for line in new_function_code.split('\n')]
+    # all the requests for all the candidates are sent concurrently, they share the rate limit of the client
+    candidate_fixes = client.run_all([request_fixes_async(client, report, functions, logs_folder_name, config["batch_fix_requests"], config["candidate_temperature"])
+                                      for _ in range(config["num_candidates"])])
+
+    candidates = []
+    for fixes in candidate_fixes:
+        patches = []
+        for (file_path, function_name, _), fixed_function_code in zip(functions, fixes):
+            if fixed_function_code is not None and fixed_function_code != "None" and fixed_function_code != "":
+                patches.append({"file": os.path.relpath(file_path, path), "function": function_name, "code": fixed_function_code})
+        if patches:
+            candidates.append((patches, fixes))
+
+    if not candidates:
+        return True, report, False
+
+    # every candidate gets its own copy of the target tree with the bug-triggering input in it
+    worktrees_path = os.path.relpath(tempfile.mkdtemp(prefix="candidates_", dir=tmp_path))
+    worktrees = []
+    for i in range(len(candidates)):
+        worktree_path = f"{worktrees_path}/candidate_{i}"
+        create_worktree(path, worktree_path, exclude)
+        os.makedirs(f"{worktree_path}/.afl_loop_input", exist_ok=True)
+        shutil.copyfile(f"{path}/{crash_input}", f"{worktree_path}/.afl_loop_input/{os.path.basename(crash_input)}")
+        worktrees.append(worktree_path)
+
+    rebuild_instr = config["rebuild_instr"] if config["incremental_rebuild"] else None
+    workers = min(len(candidates), config["candidate_workers"] or os.cpu_count())
+    print(f"evaluating {len(candidates)} candidate fixes with {workers} workers")
+
+    executor = create_process_pool(workers)
+    futures = {}
+    for i, (patches, _) in enumerate(candidates):
+        future = executor.submit(evaluate_candidate, worktrees[i], build_instr, run_instr, f"./.afl_loop_input/{os.path.basename(crash_input)}", patches, rebuild_instr, object_cache_path, get_run_options(config), compilation_database)
+        futures[future] = i
+
+    request_report = report
+    is_crashing = True
+    for future in as_completed(futures):
+        i = futures[future]
+        try:
+            candidate_is_crashing, candidate_report, touched_files = future.result()
+        except Exception as e:
+            print(f"candidate #{i} failed: {e}")
+            continue
+        print(f"candidate #{i} - is_crashing: {candidate_is_crashing}")
+
+        if not candidate_is_crashing:
+            # the winner's modified files are copied back into the target tree and it is rebuilt, the objects
+            # of the modified files have already been compiled by the candidate and are restored from the cache
+            original_files = {}
+            for relative_path in touched_files:
+                with open(f"{path}/{relative_path}", 'rb') as file:
+                    original_files[relative_path] = file.read()
+                shutil.copyfile(f"{worktrees[i]}/{relative_path}", f"{path}/{relative_path}")
+            rebuild_tree(path, build_instr, rebuild_instr, [f"{path}/{relative_path}" for relative_path in touched_files], object_cache_path)
+
+            regression_report = validate(path) if validate is not None else None
+            if regression_report is not None:
+                for relative_path, content in original_files.items():
+                    with open(f"{path}/{relative_path}", 'wb') as file:
+                        file.write(content)
+                rebuild_tree(path, build_instr, rebuild_instr, [f"{path}/{relative_path}" for relative_path in touched_files], object_cache_path)
+                record_fix_outcome(client, request_report, functions, candidates[i][1], False, config["candidate_temperature"])
+                report = regression_report
+                continue
+
+            with open(f"{logs_folder_name}/log.txt", 'a') as file:
+                file.write(f"candidate #{i} of {len(candidates)} fixed the bug @ {time.ctime()}\n")
+            # the winning fixes are stored in the LLM cache so that they can be served again without a request
+            record_fix_outcome(client, request_report, functions, candidates[i][1], True, config["candidate_temperature"])
+            is_crashing = False
+            break
+        if candidate_report.startswith(COMPILER_DIAGNOSTICS_HEADER):
+            report = add_compiler_diagnostics(request_report, candidate_report)
+        elif candidate_report:
+            report = candidate_report
 
-    # Replace the lines with the new function code
-    lines[starting_line - 1 : ending_line] = new_lines
+    for future in futures:
+        future.cancel()
+    threading.Thread(target=remove_worktrees, args=(executor, worktrees_path)).start()
 
-    with open(filepath, 'w') as file:
-        file.writelines(lines)
+    return is_crashing, report, True
 # --------------------------------------------------------- #
 
 
 
-def check_fuzzer_launch(event, thread, logs_folder_name):
+def check_fuzzer_launch(event, thread, logs_folder_name, instances, timeout=10):
     """
     This function checks if the fuzzer has started correctly.
-    If so, it reads the file that contains the PID and returns it.
-    Otherwise, it writes a log message and exits the program.
+    If so, it waits until the file that contains the PIDs of the fuzzer instances holds the PIDs of all the instances
+    (the shell appends them one by one after the event is set) and returns them.
+    Otherwise, or if they are not all there after timeout seconds, it writes a log message, stops the instances
+    that have been started and exits the program, they would be left running and clash with the next launch.
     """
 
     event.wait()
-    time.sleep(0.1)
 
-    if not thread.is_alive():
+    fuzzer_pids = []
+    deadline = time.monotonic() + timeout
+    while thread.is_alive() and time.monotonic() < deadline:
+        with open(f"{tmp_path}/process.pid", 'r') as file:
+            fuzzer_pids = [int(line.strip()) for line in file if line.strip()]
+        if len(fuzzer_pids) >= instances:
+            break
+        time.sleep(0.1)
+
+    if not thread.is_alive() or len(fuzzer_pids) < instances:
         with open(f"{logs_folder_name}/log.txt", 'a') as file:
-            file.write(f"fuzzer has failed to start, exiting @ {time.ctime()}\n\n\n")
-        print(" - fuzzer has failed to start.")
+            file.write(f"fuzzer has failed to start ({len(fuzzer_pids)} of {instances} instances), exiting @ {time.ctime()}\n\n\n")
+        print(f" - fuzzer has failed to start ({len(fuzzer_pids)} of {instances} instances).")
+        stop_fuzzers(fuzzer_pids)
         shutil.rmtree(tmp_path)
         thread.join()
         print("exiting...")
@@ -492,10 +3534,7 @@ def check_fuzzer_launch(event, thread, logs_folder_name):
     else:
         print(" - fuzzing...")
 
-    with open(f"{tmp_path}/process.pid", 'r') as file:
-        fuzzer_pid = int(file.readline().strip())
-    
-    return fuzzer_pid
+    return fuzzer_pids
 # --------------------------------------------------------- #
 
 
@@ -573,6 +3612,21 @@ def set_tmp_folder_name(path, absolute_path):
 
 
 
+def set_state_folder_name(path):
+    """
+    Sets up the state folder, unlike the tmp folder it is kept between runs.
+    It holds the data that must survive a restart of the script (e.g. the crash index).
+    """
+
+    if path.endswith('/'):
+        path = path[:-1]
+    path = os.path.basename(path)
+
+    return f"state_{path}"
+# --------------------------------------------------------- #
+
+
+
 def extract_info_asan_report_info(line):
     """
     This functions levarages a regex pattern to extract the file, function and line of the buggy functions from an ASAN report.
@@ -595,8 +3649,8 @@ def extract_info_asan_report_info(line):
 def asan_report_parser(report):
     """
     This function parses the ASAN report and returns a list of dictionaries containing the file, function and line of the buggy functions.
-    It looks for the a line made only by "=" which separates the report.
-    Then it looks for all subsequent lines that start with '#' and extracts the file, function and line of the buggy functions.
+    The functions are the frames of the crash stack (see SanitizerReportParser) that have a source location,
+    the frames of the sanitizer runtime and of the libraries without debug information are skipped.
     """
     # print("parsing the ASAN report")
     # print(report)
@@ -626,52 +3680,820 @@ def asan_report_parser(report):
             
     # # if we reach this point we have not found any buggy functions
     # return result, report
-    pattern = r"#\d+ 0x[\da-f]+ in (\w+) (.*):(\d+):\d+"
-    info = []
-    started = False
-
-    for line in report.split('\n'):
-        match = re.search(pattern, line)
-        if match:
-            started = True
-            function_name, file_name, line_number = match.groups()
-            info.append({
-                "file": file_name,
-                "function": function_name,
-                "line": line_number
-            })
-        elif started:
-            break
+    # pattern = r"#\d+ 0x[\da-f]+ in (\w+) (.*):(\d+):\d+"
+    # info = []
+    # started = False
+
+    # for line in report.split('\n'):
+    #     match = re.search(pattern, line)
+    #     if match:
+    #         started = True
+    #         function_name, file_name, line_number = match.groups()
+    #         info.append({
+    #             "file": file_name,
+    #             "function": function_name,
+    #             "line": line_number
+    #         })
+    #     elif started:
+    #         break
+
+    # the frames of the crash stack, of any sanitizer, are collected by the same parser used while the target runs
+    info = parse_sanitizer_report(report).get_frames("crash")
 
     #print(info)
     return info, report
 # --------------------------------------------------------- #               
+
+
+
+def compact_report(report, path, source_index, token_budget, context_lines=3, max_snippets=3):
+    """
+    This function compacts a crash report before it is sent to the LLM, so that the prompts of every try are shorter.
+    It keeps the header of the sanitizer report (bug type, access, SUMMARY), the frames of the target and the description
+    of the stacks (e.g. where the memory has been freed), and adds the source lines around the faulting lines of the first frames.
+    It drops the shadow bytes map, the hints, the frames of the sanitizer runtime and of the libraries, the frames that appear
+    in more than one stack, the PIDs and the addresses of the frames and the repeated lines of the output of the target.
+    The files are looked up in path, the tree the crashing program has been built in (the target tree or the repair snapshot).
+    The tokens are estimated as in LLMClient (4 characters per token), if the report is over token_budget the output of the target
+    printed before the report, the source lines, the frames of the secondary stacks (allocation, free) and the deeper frames
+    of the first stack are removed, in this order.
+    """
+
+    # a report that has already been compacted ends with its source lines, they are computed again
+    report = report.split("\nSource of the faulting lines:\n")[0]
+
+    resolved_files = {}
+    def resolve(file_name):
+        if file_name not in resolved_files:
+            # the frames of a report that has already been compacted are relative to the tree
+            resolved_files[file_name] = find_file(file_name, path, source_index) or (f"{path}/{file_name}" if os.path.isfile(f"{path}/{file_name}") else None)
+        return resolved_files[file_name]
+
+    entries = []
+    seen_frames = set()
+    seen_lines = set()
+    snippet_frames = []
+    stack_id = -1
+    in_stack = False
+    in_report = False
+    skipping_shadow = False
+
+    for line in report.split('\n'):
+        line = re.sub(r"^==\d+==\s*", "", line.rstrip())
+        if line.startswith("Shadow bytes around the buggy address"):
+            skipping_shadow = True
+            continue
+        if skipping_shadow:
+            if line.startswith("ABORTING") or not line.startswith(' ') and ':' not in line:
+                skipping_shadow = False
+            continue
+        if not line.strip() or line.startswith("HINT:") or line.startswith("ABORTING") or set(line.strip()) == {'='}:
+            continue
+
+        match = FRAME_PATTERN.match(line)
+        if match is None:
+            in_stack = False
+            # the output of the target is often the same line repeated
+            if line in seen_lines and not line.startswith("SUMMARY"):
+                continue
+            seen_lines.add(line)
+            in_report = in_report or SANITIZER_REPORT_PATTERN.search(line) is not None
+            entries.append({"text": line, "output": not in_report})
+            continue
+
+        if not in_stack:
+            stack_id += 1
+            in_stack = True
+        function_name = match.group("function") or ''
+        location = match.group("location")
+        if RUNTIME_FRAME_PATTERN.search(function_name) or RUNTIME_FRAME_PATTERN.search(location) or location.startswith('('):
+            continue
+        if (function_name, location) in seen_frames:
+            continue
+        seen_frames.add((function_name, location))
+
+        source = SOURCE_LOCATION_PATTERN.match(location)
+        file_path = resolve(source.group("file")) if source else None
+        if file_path is not None:
+            location = f"{os.path.relpath(file_path, path)}:{source.group('line')}"
+            line_number = int(source.group("line"))
+            # a line already shown in the source of a previous frame is not shown again
+            if len(snippet_frames) < max_snippets and not any(file_path == item and abs(line_number - number) <= context_lines for item, number in snippet_frames):
+                snippet_frames.append((file_path, line_number))
+        entries.append({"text": f"    #{match.group('index')} {function_name} {location}".rstrip(), "stack": stack_id, "project": file_path is not None})
+
+    # if some frames are in the target tree only those are kept, otherwise the binary has been built without the paths of the sources
+    if any(entry.get("project") for entry in entries):
+        entries = [entry for entry in entries if "stack" not in entry or entry["project"]]
+
+    snippets = []
+    for file_path, line_number in snippet_frames:
+        try:
+            with open(file_path, 'r', errors="ignore") as file:
+                lines = file.readlines()
+        except OSError:
+            continue
+        first = max(1, line_number - context_lines)
+        last = min(len(lines), line_number + context_lines)
+        snippet = [f"{os.path.relpath(file_path, path)}:{line_number}"]
+        for i in range(first, last + 1):
+            snippet.append(f"{'>' if i == line_number else ' '} {i:5} | {lines[i - 1].rstrip()}")
+        snippets.append('\n'.join(snippet))
+
+    def render():
+        text = '\n'.join(entry["text"] for entry in entries)
+        if snippets:
+            text += "\nSource of the faulting lines:\n" + '\n\n'.join(snippets)
+        return text
+
+    # the least useful parts are removed until the report fits the budget
+    while len(render()) // 4 > token_budget:
+        frames = [i for i, entry in enumerate(entries) if "stack" in entry]
+        secondary_frames = [i for i in frames if entries[i]["stack"] > 0]
+        output = [i for i, entry in enumerate(entries) if entry.get("output")]
+        if output:
+            del entries[output[0]]
+        elif snippets:
+            snippets.pop()
+        elif secondary_frames:
+            del entries[secondary_frames[-1]]
+        elif len(frames) > 1:
+            del entries[frames[-1]]
+        else:
+            break
+
+    text = render()
+    if len(text) // 4 > token_budget:
+        text = text[:token_budget * 4] + "\n[...]"
+    return text
+# --------------------------------------------------------- #
+
+
+
+def get_bug_type(report):
+    """
+    This function extracts the bug type (e.g. heap-buffer-overflow, signed-integer-overflow, SIGSEGV) from a report,
+    see SanitizerReportParser. If the report does not contain a sanitizer report or a signal "unknown" is returned.
+    """
+
+    return parse_sanitizer_report(report).bug_type or "unknown"
+# --------------------------------------------------------- #
+
+
+
+def get_crash_severity(report):
+    """
+    This function returns the severity of a crash, between 0 and 1, from its bug type (see BUG_TYPE_SEVERITY).
+    A memory error that only reads is less severe than one that writes, an access near the null address
+    (e.g. a SEGV on a null pointer dereference) is the least severe.
+    """
+
+    parser = parse_sanitizer_report(report)
+    severity = BUG_TYPE_SEVERITY.get(parser.bug_type, DEFAULT_SEVERITY)
+    if parser.access == "READ":
+        severity *= 0.7
+    if parser.address is not None and parser.address < 4096:
+        severity = min(severity, 0.2)
+    return severity
+# --------------------------------------------------------- #
+
+
+
+def compute_crash_signature(report, buggy_functions, num_frames):
+    """
+    This function computes the signature of a crash, it is used to group together inputs that trigger the same bug.
+    The signature is the hash of the bug type and of the top num_frames frames (function and file name) returned by asan_report_parser.
+    Line numbers are left out on purpose since they change every time a fix is applied to the same file.
+    It returns the signature, the bug type and the frames used, or None if the report contains no frames.
+    """
+
+    if not buggy_functions:
+        return None, None, None
+
+    bug_type = get_bug_type(report)
+    frames = [f"{item['function']}@{os.path.basename(item['file'])}" for item in buggy_functions[:num_frames]]
+    signature = hashlib.sha1('\n'.join([bug_type] + frames).encode()).hexdigest()
+
+    return signature, bug_type, frames
+# --------------------------------------------------------- #
+
+
+
+def load_crash_index(file_path):
+    """
+    This function loads the crash index, a json file that maps every crash signature to its bucket.
+    Each bucket stores the bug type, the frames, the first input that triggered it, the inputs that followed and the repair status.
+    If the file does not exist an empty index is returned.
+    """
+
+    if os.path.exists(file_path):
+        with open(file_path, 'r') as file:
+            return json.load(file)
+    return {}
+# --------------------------------------------------------- #
+
+
+
+def save_crash_index(crash_index, file_path):
+    """
+    This function writes the crash index to disk.
+    The index is first written to a temporary file that then replaces the old one, so that a crash of the script does not corrupt it.
+    """
+
+    with open(f"{file_path}.tmp", 'w') as file:
+        json.dump(crash_index, file, indent=2)
+    os.replace(f"{file_path}.tmp", file_path)
+# --------------------------------------------------------- #
+
+
+
+def add_crash_to_index(crash_index, signature, bug_type, frames, input_filename):
+    """
+    This function adds a bug-triggering input to the bucket of its signature.
+    If the bucket does not exist it is created and the input becomes the one that is sent to repair.
+    It returns True if a new bucket has been created, False if the input is a duplicate.
+    The first input of a bucket whose repair has been interrupted (e.g. the script has been stopped) is not a duplicate.
+    An input that still crashes in a fixed bucket is not a duplicate either: the fix was incomplete, the bucket is reopened
+    (its status goes back to "pending") and the input becomes its first input, the one that is sent to repair.
+    """
+
+    if signature not in crash_index:
+        crash_index[signature] = {
+            "bug_type": bug_type,
+            "frames": frames,
+            "first_input": input_filename,
+            "duplicates": [],
+            "count": 1,
+            "status": "pending",
+            "first_seen": time.ctime()
+        }
+        return True
+
+    bucket = crash_index[signature]
+    if bucket["status"] == "fixed":
+        if input_filename != bucket["first_input"]:
+            if input_filename in bucket["duplicates"]:
+                bucket["duplicates"].remove(input_filename)
+            else:
+                bucket["count"] += 1
+            bucket["duplicates"].append(bucket["first_input"])
+            bucket["first_input"] = input_filename
+        bucket["status"] = "pending"
+        return True
+    if input_filename == bucket["first_input"] and bucket["status"] == "pending":
+        return True
+    if input_filename != bucket["first_input"] and input_filename not in bucket["duplicates"]:
+        bucket["duplicates"].append(input_filename)
+        bucket["count"] += 1
+    return False
+# --------------------------------------------------------- #
                
 
 
+class StateStore:
+    """
+    This class keeps the state of the loop in an SQLite database in the state folder, so that a restarted script
+    resumes the crashes that had not been handled and the history of the repairs can be queried afterwards.
+    It stores the crashes (every input taken from the queue and what has been done with it), the buckets of the crash index,
+    the fix attempts with their outcome, the patches applied at every attempt and the timings of the stages (see Metrics).
+    The database is used only by the main process, the accesses of the different threads are serialized by a lock.
+    Every crash input is copied into inputs_path when it is recorded: the fuzzer renames or clears its crashes folder
+    when it is restarted, so the pending crashes are resumed from the copies.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS crashes (input TEXT PRIMARY KEY, status TEXT, signature TEXT, bug_type TEXT,
+                                            minimized_input TEXT, found REAL, handled REAL);
+        CREATE TABLE IF NOT EXISTS buckets (signature TEXT PRIMARY KEY, bug_type TEXT, frames TEXT, first_input TEXT,
+                                            count INTEGER, status TEXT, first_seen TEXT);
+        CREATE TABLE IF NOT EXISTS attempts (id INTEGER PRIMARY KEY AUTOINCREMENT, input TEXT, signature TEXT, try INTEGER,
+                                             candidates INTEGER, started REAL, duration REAL, outcome TEXT);
+        CREATE TABLE IF NOT EXISTS patches (attempt INTEGER, file TEXT, function TEXT, code TEXT);
+        CREATE TABLE IF NOT EXISTS timings (time REAL, stage TEXT, duration REAL, fields TEXT);
+    """
+
+    def __init__(self, file_path, inputs_path):
+        self.inputs_path = inputs_path
+        os.makedirs(inputs_path, exist_ok=True)
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            # with WAL the database can be read (e.g. by the sqlite3 shell) while the loop is writing it
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(self.SCHEMA)
+
+
+    def execute(self, query, parameters=()):
+        with self.lock, self.connection:
+            return self.connection.execute(query, parameters).fetchall()
+
+
+    def handled_inputs(self):
+        """
+        This method returns the set of the inputs that have been handled, the ones taken from the queue whose handling
+        has not been completed are not part of it.
+        """
+
+        return {row[0] for row in self.execute("SELECT input FROM crashes WHERE status != 'pending'")}
+
+
+    def pending_inputs(self):
+        return [row[0] for row in self.execute("SELECT input FROM crashes WHERE status = 'pending' ORDER BY found")]
+
+
+    def input_path(self, input_filename):
+        """
+        This method returns the path of the copy of a crash input, None if it has not been copied.
+        """
+
+        file_path = f"{self.inputs_path}/{input_filename.replace('/', '_')}"
+        return file_path if os.path.isfile(file_path) else None
+
+
+    def add_crash(self, input_filename, source_path=None):
+        """
+        This method records a crash as pending and copies its input from source_path, if it has not been copied yet.
+        """
+
+        if source_path is not None and self.input_path(input_filename) is None and os.path.isfile(source_path):
+            shutil.copy2(source_path, f"{self.inputs_path}/{input_filename.replace('/', '_')}")
+        self.execute("INSERT INTO crashes (input, status, found) VALUES (?, 'pending', ?) ON CONFLICT(input) DO UPDATE SET status = 'pending'",
+                     (input_filename, time.time()))
+
+
+    def update_crash(self, input_filename, status, **fields):
+        """
+        This method records what has been done with a crash: "not_crashing", "hang", "duplicate", "missing", "fixed" or "not_fixed".
+        The fields (signature, bug_type, minimized_input) are updated as well.
+        """
+
+        fields["status"] = status
+        fields["handled"] = time.time() if status != "pending" else None
+        columns = ', '.join(f"{key} = ?" for key in fields)
+        self.execute(f"UPDATE crashes SET {columns} WHERE input = ?", tuple(fields.values()) + (input_filename,))
+
+
+    def save_bucket(self, signature, bucket):
+        self.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (signature, bucket["bug_type"], json.dumps(bucket["frames"]), bucket["first_input"], bucket["count"],
+                      bucket["status"], bucket["first_seen"]))
+
+
+    def add_attempt(self, input_filename, signature, number, candidates=1):
+        """
+        This method records the start of a fix attempt and returns its id.
+        """
+
+        with self.lock, self.connection:
+            cursor = self.connection.execute("INSERT INTO attempts (input, signature, try, candidates, started) VALUES (?, ?, ?, ?, ?)",
+                                             (input_filename, signature, number, candidates, time.time()))
+            return cursor.lastrowid
+
+
+    def finish_attempt(self, attempt_id, outcome):
+        """
+        This method records the outcome of a fix attempt: "fixed", "crashing", "regression" or "no_patch".
+        """
+
+        self.execute("UPDATE attempts SET duration = ? - started, outcome = ? WHERE id = ?", (time.time(), outcome, attempt_id))
+
+
+    def add_patch(self, attempt_id, file_path, function_name, code):
+        self.execute("INSERT INTO patches VALUES (?, ?, ?, ?)", (attempt_id, file_path, function_name, code))
+
+
+    def add_timing(self, event_time, stage, duration, fields):
+        self.execute("INSERT INTO timings VALUES (?, ?, ?, ?)", (event_time, stage, duration, json.dumps(fields)))
+# --------------------------------------------------------- #
+
+
+
+def get_regression_corpus_file(corpus_path, item):
+    """
+    This function returns the path of an input of the crash index (relative to the output folder of the fuzzer) in the regression corpus.
+    The inputs stored before the fuzzer could run several instances are named after the file only and are in "default/crashes".
+    """
+
+    if '/' not in item:
+        item = f"default/crashes/{item}"
+    return f"{corpus_path}/{item.replace('/', '_')}"
+# --------------------------------------------------------- #
+
+
+
+def add_to_regression_corpus(corpus_path, bucket, output_path, store=None):
+    """
+    This function copies the inputs of a fixed bucket of the crash index into the regression corpus, a folder of the state folder:
+    the crashes folders of the fuzzer are renamed or cleared when it is restarted, the corpus keeps the inputs of the fixed crashes
+    replayed by check_regressions. The inputs are copied from the state store (see StateStore.add_crash) or from the output folder.
+    """
+
+    os.makedirs(corpus_path, exist_ok=True)
+    for item in [bucket["first_input"]] + bucket["duplicates"]:
+        corpus_file = get_regression_corpus_file(corpus_path, item)
+        if os.path.isfile(corpus_file):
+            continue
+        source = store.input_path(item) if store is not None else None
+        if source is None:
+            source = f"{output_path}/{item if '/' in item else f'default/crashes/{item}'}"
+        if os.path.isfile(source):
+            shutil.copy2(source, corpus_file)
+# --------------------------------------------------------- #
+
+
+
+def get_regression_inputs(crash_index, output_path, instance_names, sample_size, corpus_path=None):
+    """
+    This function returns the paths of the inputs replayed to check a fix for regressions: all the stored inputs of the crash index,
+    taken from the regression corpus if they are in it (see add_to_regression_corpus) or from the output folder of the fuzzer if they still exist,
+    and a random sample of sample_size inputs of the queues of the fuzzer instances.
+    """
+
+    inputs = []
+    for bucket in crash_index.values():
+        for item in [bucket["first_input"]] + bucket["duplicates"]:
+            file_path = get_regression_corpus_file(corpus_path, item) if corpus_path is not None else None
+            if file_path is None or not os.path.isfile(file_path):
+                file_path = f"{output_path}/{item if '/' in item else f'default/crashes/{item}'}"
+            if file_path not in inputs and os.path.isfile(file_path):
+                inputs.append(file_path)
+
+    queue_inputs = []
+    for name in instance_names:
+        if os.path.isdir(f"{output_path}/{name}/queue"):
+            queue_inputs += [f"{output_path}/{name}/queue/{item}" for item in sorted(os.listdir(f"{output_path}/{name}/queue"))
+                             if os.path.isfile(f"{output_path}/{name}/queue/{item}")]
+    if len(queue_inputs) > sample_size:
+        queue_inputs = random.sample(queue_inputs, sample_size)
+
+    return inputs + queue_inputs
+# --------------------------------------------------------- #
+
+
+
+def replay_input(path, run_instr, crash_input, num_frames, run_options):
+    """
+    This function runs the target with an input and computes the signature of the crash, if any.
+    It is run in a worker process, one for each input being replayed.
+    It returns if the target is crashing, the signature (None if the report has no frames) and the report.
+    """
+
+    is_crashing, report = run_program(path, run_instr, crash_input, **run_options)
+    if not is_crashing:
+        return False, None, ''
+
+    frames, _ = asan_report_parser(report)
+    return True, compute_crash_signature(report, frames, num_frames)[0], report
+# --------------------------------------------------------- #
+
+
+
+def check_regressions(path, run_instr, output_path, instance_names, crash_index, config, logs_folder_name, corpus_path=None, repaired_signature=None):
+    """
+    This function replays in parallel, against the fixed program in path, the stored crash inputs (from the regression corpus
+    in corpus_path if provided) and a sample of the queue of the fuzzer (see get_regression_inputs) to find the crashes introduced by a fix.
+    A crash is new if its signature is not in the crash index, if its bucket had already been fixed, or if it has no signature;
+    the crashes of the buckets that have not been fixed yet are expected, but for the bucket being repaired (repaired_signature):
+    the fix must stop all of its inputs, not only the one it has been written for.
+    It returns None if there are no new crashes, otherwise a report with the new crashes to be sent to the LLM.
+    """
+
+    inputs = get_regression_inputs(crash_index, output_path, instance_names, config["regression_queue_sample"], corpus_path)
+    if not inputs:
+        return None
+
+    workers = min(len(inputs), config["regression_workers"] or os.cpu_count())
+    print(f"replaying {len(inputs)} inputs with {workers} workers to check for regressions")
+
+    regressions = {}
+    with METRICS.timer("regression_replay", inputs=len(inputs)) as fields, create_process_pool(workers) as executor:
+        futures = {executor.submit(replay_input, path, run_instr, os.path.relpath(item, path), config["crash_signature_frames"], get_run_options(config)): item
+                   for item in inputs}
+        for future in as_completed(futures):
+            is_crashing, signature, report = future.result()
+            if not is_crashing:
+                continue
+            if signature is None or signature not in crash_index or crash_index[signature]["status"] == "fixed" or signature == repaired_signature:
+                regressions.setdefault(signature, (futures[future], report))
+        fields["regressions"] = len(regressions)
+
+    if not regressions:
+        print("no regressions found")
+        return None
+
+    with open(f"{logs_folder_name}/log.txt", 'a') as file:
+        for signature, (item, _) in regressions.items():
+            if signature is not None and signature == repaired_signature:
+                file.write(f"the fix does not stop the crash {signature} with {item} @ {time.ctime()}\n")
+            else:
+                file.write(f"the fix introduces a new crash {signature} with {item} @ {time.ctime()}\n")
+    print(f"the fix introduces {len(regressions)} new crashes")
+
+    reports = '\n'.join(f"crash with input {item}:\n{report}" for item, report in regressions.values())
+    if repaired_signature is not None and list(regressions) == [repaired_signature]:
+        return f"The fix stops the original crash but not the same crash with other inputs:\n{reports}"
+    return f"The fix stops the original crash but introduces new ones:\n{reports}"
+# --------------------------------------------------------- #
+
+
+
+def minimize_crash_input(path, run_instr, crash_input, signature, config, cache_path):
+    """
+    This function minimizes a bug-triggering input while preserving the signature of its crash (see compute_crash_signature),
+    or just the crash if the report has no frames to compute a signature from.
+    The input is minimized with afl-tmin, if available, and the result is checked since afl-tmin only preserves the crash;
+    otherwise, or if the check fails, the built-in delta debugging minimizer is used (see minimize_input_ddmin).
+    The minimized inputs are cached in cache_path by the hash of the original input.
+    It returns the path, relative to path, of the minimized input in the .afl_loop_input folder, or crash_input if it could not be reduced.
+    """
+
+    with open(f"{path}/{crash_input}", 'rb') as file:
+        data = file.read()
+    input_hash = hashlib.sha1(data).hexdigest()
+    minimized_input = f"./.afl_loop_input/min_{input_hash[:16]}"
+    os.makedirs(f"{path}/.afl_loop_input", exist_ok=True)
+
+    if os.path.exists(f"{cache_path}/{input_hash}"):
+        shutil.copyfile(f"{cache_path}/{input_hash}", f"{path}/{minimized_input}")
+        print("minimized input found in cache")
+        return minimized_input
+
+    print(f"minimizing the input ({len(data)} bytes)...")
+    run_options = get_run_options(config)
+    deadline = time.monotonic() + config["minimize_timeout"]
+    minimized = None
+
+    if config["minimizer"] in ("auto", "afl-tmin") and shutil.which("afl-tmin"):
+        minimized = minimize_input_tmin(path, run_instr, crash_input, minimized_input, run_options["timeout"], config["minimize_timeout"])
+        if minimized is not None and not reproduces_crash(path, run_instr, minimized_input, signature, config["crash_signature_frames"], run_options):
+            print("the input minimized by afl-tmin does not preserve the crash signature")
+            minimized = None
+
+    if minimized is None and config["minimizer"] in ("auto", "ddmin"):
+        workers = config["minimize_workers"] or os.cpu_count()
+        with create_process_pool(workers) as executor:
+            minimized = minimize_input_ddmin(data, path, run_instr, signature, config["crash_signature_frames"], run_options, executor, deadline)
+
+    if minimized is None or len(minimized) >= len(data):
+        print("the input could not be reduced")
+        return crash_input
+
+    print(f"input minimized from {len(data)} to {len(minimized)} bytes")
+    os.makedirs(cache_path, exist_ok=True)
+    with open(f"{cache_path}/{input_hash}", 'wb') as file:
+        file.write(minimized)
+    with open(f"{path}/{minimized_input}", 'wb') as file:
+        file.write(minimized)
+    return minimized_input
+# --------------------------------------------------------- #
+
+
+
+def minimize_input_tmin(path, run_instr, crash_input, output_file, run_timeout, timeout):
+    """
+    This function minimizes an input with afl-tmin, the target is run as in the run instructions with "INPUT" replaced
+    by "@@" (afl-tmin feeds the standard input when "@@" is missing, as needed by "INPUT_STDIN").
+    It returns the minimized input, or None if afl-tmin has failed or the instructions need a shell.
+    """
+
+    with open(f"{path}/{run_instr}", 'r') as file:
+        command = file.readline().strip()
+    command = command.replace("INPUT_STDIN", "") if "INPUT_STDIN" in command else command.replace("INPUT", "@@")
+
+    arguments, environment = parse_run_command(command)
+    if arguments is None:
+        return None
+
+    try:
+        result = run(["afl-tmin", "-i", crash_input, "-o", output_file, "-m", "none", "-t", str(run_timeout * 1000), "--"] + arguments,
+                     cwd=path, env=get_sanitizer_environment(environment), stdout=DEVNULL, stderr=DEVNULL, timeout=timeout)
+    except TimeoutExpired:
+        return None
+    if result.returncode != 0 or not os.path.exists(f"{path}/{output_file}"):
+        return None
+
+    with open(f"{path}/{output_file}", 'rb') as file:
+        return file.read()
+# --------------------------------------------------------- #
+
+
+
+def minimize_input_ddmin(data, path, run_instr, signature, num_frames, run_options, executor, deadline):
+    """
+    This function minimizes an input with the delta debugging algorithm (ddmin): the input is split in n chunks,
+    if a chunk or the input without a chunk still triggers the same crash it becomes the new input, otherwise the
+    chunks are made smaller. All the candidates of a round are run in parallel in the process pool, the first one
+    in order that reproduces the crash is kept so that the result does not depend on the scheduling.
+    It stops at the deadline and returns the smallest input found.
+    """
+
+    n = 2
+    round_id = 0
+    while len(data) >= 2 and time.monotonic() < deadline:
+        chunk_size = -(-len(data) // n)
+        starts = range(0, len(data), chunk_size)
+        subsets = [data[start:start + chunk_size] for start in starts]
+        complements = [data[:start] + data[start + chunk_size:] for start in starts] if n > 2 else []
+
+        candidates = subsets + complements
+        futures = [executor.submit(reproduces_crash_with_data, path, run_instr, candidate, signature, num_frames, run_options, f"ddmin_{os.getpid()}_{round_id}_{i}")
+                   for i, candidate in enumerate(candidates)]
+        results = [future.result() for future in futures]
+        round_id += 1
+
+        if True in results[:len(subsets)]:
+            data = subsets[results.index(True)]
+            n = 2
+        elif True in results[len(subsets):]:
+            data = complements[results[len(subsets):].index(True)]
+            n = max(n - 1, 2)
+        elif n < len(data):
+            n = min(n * 2, len(data))
+        else:
+            break
+
+    return data
+# --------------------------------------------------------- #
+
+
+
+def reproduces_crash_with_data(path, run_instr, data, signature, num_frames, run_options, name):
+    """
+    This function writes a candidate input in the .afl_loop_input folder of the target and checks if it reproduces the crash
+    (see reproduces_crash), the file is removed afterwards.
+    """
+
+    candidate_input = f"./.afl_loop_input/{name}"
+    with open(f"{path}/{candidate_input}", 'wb') as file:
+        file.write(data)
+    try:
+        return reproduces_crash(path, run_instr, candidate_input, signature, num_frames, run_options)
+    finally:
+        os.remove(f"{path}/{candidate_input}")
+# --------------------------------------------------------- #
+
+
+
+def reproduces_crash(path, run_instr, crash_input, signature, num_frames, run_options):
+    """
+    This function checks if an input crashes the target with the given signature, if the signature is None any crash is accepted.
+    """
+
+    is_crashing, report = run_program(path, run_instr, crash_input, **run_options)
+    # an input that makes the target hang does not reproduce the crash, even if any crash is accepted
+    if not is_crashing or is_hang(report):
+        return False
+    if signature is None:
+        return True
+
+    frames, _ = asan_report_parser(report)
+    return compute_crash_signature(report, frames, num_frames)[0] == signature
+# --------------------------------------------------------- #
+
+
+
+def create_process_pool(max_workers):
+    """
+    This function creates the process pools of the candidate fixes, of the regression replays and of the minimizer.
+    The workers are started by a forkserver instead of being forked from this process: it runs several threads (monitors,
+    LLM client, pipeline) and a forked worker could inherit a lock held by one of them (e.g. the lock of METRICS or of the
+    state store) and deadlock on its first use. The build slots of the orchestrator, if any, and the configuration of METRICS
+    are passed to the workers (see init_worker).
+    """
+
+    metrics = (METRICS.jsonl_path, METRICS.textfile_path, METRICS.pid)
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("forkserver"),
+                               initializer=init_worker, initargs=(BUILD_SLOTS, metrics))
+# --------------------------------------------------------- #
+
+
+
+def init_worker(build_slots, metrics):
+    """
+    This function initializes a worker of a process pool (see create_process_pool): the workers do not inherit the globals
+    set by the main process, the build slots shared with the other targets are set again and METRICS is configured
+    to append the events of the worker to the metrics file of the main process (metrics is its jsonl path, textfile path and pid).
+    The state store is not shared with the workers.
+    """
+
+    global BUILD_SLOTS
+    BUILD_SLOTS = build_slots
+    jsonl_path, textfile_path, pid = metrics
+    METRICS.configure(jsonl_path, textfile_path, None, pid)
+# --------------------------------------------------------- #
+
+
+
+def connect_to_coordinator(address, authkey):
+    """
+    This function connects to the coordinator started by the orchestrator (see afl_orchestrator.py).
+    It returns the proxies of the rate limiter shared by all the targets, to be used by LLMClient in place of
+    its own, and of the semaphore that limits how many targets are building at the same time.
+    """
+
+    class CoordinatorClient(BaseManager):
+        pass
+
+    CoordinatorClient.register("rate_limiter")
+    CoordinatorClient.register("build_slots", proxytype=AcquirerProxy)
+
+    host, port = address.rsplit(':', 1)
+    manager = CoordinatorClient(address=(host, int(port)), authkey=authkey.encode())
+    manager.connect()
+    return manager.rate_limiter(), manager.build_slots()
+# --------------------------------------------------------- #
+
+
+
+def get_run_options(config):
+    """
+    This function returns the options of run_program specified in the configuration.
+    """
+
+    return {
+        "timeout": config["run_timeout"],
+        "memory_limit_mb": config["run_memory_limit_mb"],
+        "max_output_bytes": config["run_max_output_kb"] * 1024,
+        "summary_grace": config["run_summary_grace"] if config["run_stop_after_summary"] else None
+    }
+# --------------------------------------------------------- #
+
+
+
 def load_config_file(file_path):
     """
     This function loads a configuration json file and returns the specified parameters.
     currently: queue_timeout [seconds], llm_max_retries, num_tries_to_fix, llm_timeout [seconds]
+    The whole configuration is returned as last value, missing parameters are set to their default value.
     """
 
+    # Set default values
+    data = {
+        "queue_timeout": 7200,
+        "llm_max_retries": 0,
+        "num_tries_to_fix": 10,
+        "llm_timeout": 60,
+        "crash_signature_frames": 3,
+        "monitor_backend": "auto",
+        "incremental_rebuild": True,
+        "rebuild_instr": "rebuild.txt",
+        "num_candidates": 1,
+        "candidate_temperature": 0.7,
+        "candidate_workers": 0,
+        "llm_requests_per_minute": 50,
+        "llm_tokens_per_minute": 40000,
+        "llm_max_concurrency": 4,
+        "llm_backoff_retries": 5,
+        "llm_cache": True,
+        "llm_cache_max_mb": 100,
+        "source_index": True,
+        "batch_fix_requests": True,
+        "run_timeout": 60,
+        "run_memory_limit_mb": 0,
+        "run_max_output_kb": 1024,
+        "repair_snapshot": True,
+        "fuzzer_instances": 1,
+        "minimize_inputs": False,
+        "minimizer": "auto",
+        "minimize_workers": 0,
+        "minimize_timeout": 300,
+        "regression_replay": True,
+        "regression_queue_sample": 200,
+        "regression_workers": 0,
+        "metrics": True,
+        "metrics_textfile": "",
+        "llm_backend": "anthropic",
+        "llm_model": "",
+        "llm_system_prompt": SYSTEM_PROMPT,
+        "llm_temperature": 0.0,
+        "llm_base_url": "http://localhost:8000/v1",
+        "llm_api_key_variable": "OPENAI_API_KEY",
+        "llm_request_timeout": 600,
+        "llm_replay_transcript": "",
+        "llm_max_tokens": 4096,
+        "compact_reports": True,
+        "report_token_budget": 2000,
+        "report_context_lines": 3,
+        "state_db": True,
+        "run_stop_after_summary": True,
+        "run_summary_grace": 1,
+        "priority_queue": True,
+        "priority_weights": {"severity": 1.0, "novelty": 0.5, "frequency": 0.3, "age": 0.2},
+        "syntax_check": True,
+        "pipeline": True,
+        "pipeline_depth": 1
+        # Add more parameters as needed
+    }
+
     if os.path.exists(file_path):
         with open(file_path, 'r') as file:
-            data = json.load(file)
+            data.update(json.load(file))
     else:
-        # Set default values
-        data = {
-            "queue_timeout": 7200,
-            "llm_max_retries": 0,
-            "num_tries_to_fix": 10,
-            "llm_timeout": 60
-            # Add more parameters as needed
-        }
         with open(CONFIG_FILE_PATH, 'w') as f:
             json.dump(data, f)
     
 
-    return data["queue_timeout"], data["llm_max_retries"], data["num_tries_to_fix"], data["llm_timeout"]
+    return data["queue_timeout"], data["llm_max_retries"], data["num_tries_to_fix"], data["llm_timeout"], data
 
 
 
@@ -679,7 +4501,7 @@ if __name__ == "__main__":
 
 #|_|_| beginning of setup phase |_|_|#
     #parse command line arguments
-    path, build_instr, run_instr, fuzz_instr = parse_arguments()
+    path, build_instr, run_instr, fuzz_instr, options = parse_arguments()
 
     # set up the tmp folder
     tmp_path, tmp_folder_absolute_path = set_tmp_folder_name(path, TMP_FOLDER_ABS)
@@ -693,11 +4515,83 @@ if __name__ == "__main__":
     load_dotenv()
 
     # load and parse the configuration file
-    queue_timeout, llm_max_retries, num_tries_to_fix, llm_timeout = load_config_file(CONFIG_FILE_PATH)
+    queue_timeout, llm_max_retries, num_tries_to_fix, llm_timeout, config = load_config_file(CONFIG_FILE_PATH)
+
+    # set up the state folder and load the crash index, it groups the bug-triggering inputs by crash signature
+    # so that only the first input of every bucket is sent to repair
+    state_path = set_state_folder_name(path)
+    if not os.path.exists(state_path):
+        os.mkdir(state_path)
+    crash_index_path = f"{state_path}/{CRASH_INDEX_FILE}"
+    crash_index = load_crash_index(crash_index_path)
+
+    # the crashes, the buckets, the fix attempts, the patches and the timings are recorded in an SQLite database in the state folder,
+    # the crashes that had not been handled when the script stopped are added to the queue again once the fuzzer is restarted
+    store = StateStore(f"{state_path}/{STATE_DB_FILE}", f"{state_path}/{CRASH_INPUTS_FOLDER}") if config["state_db"] else None
+    if store is not None:
+        for signature, bucket in crash_index.items():
+            store.save_bucket(signature, bucket)
+        pending_inputs = store.pending_inputs()
+        if pending_inputs:
+            print(f"resuming {len(pending_inputs)} crashes whose handling had been interrupted")
+
+    # the duration of every stage, the tokens and the outcome of the fixes are recorded in a jsonl file in the logs folder
+    if config["metrics"] or store is not None:
+        METRICS.configure(f"{logs_folder_name}/metrics.jsonl" if config["metrics"] else None,
+                          config["metrics_textfile"] if config["metrics"] else None, store)
+
+    # the inputs of the fixed crashes are kept here, the crashes folders of the fuzzer do not survive its restarts (see add_to_regression_corpus)
+    regression_corpus_path = f"{state_path}/{REGRESSION_CORPUS_FOLDER}"
+
+    # the minimized bug-triggering inputs are cached here by the hash of the original input
+    minimized_inputs_path = f"{state_path}/{MINIMIZED_INPUTS_FOLDER}"
+
+    # the objects compiled during the fix attempts are cached here by the hash of their source
+    object_cache_path = f"{state_path}/{OBJECT_CACHE_FOLDER}"
+    if not os.path.exists(object_cache_path):
+        os.mkdir(object_cache_path)
 
     # set up the Claude3 thing - set max retries to 0 for debugging
     #client = OpenAI( max_retries=llm_max_retries )
-    client = anthropic.Anthropic()
+    llm_cache = LLMCache(f"{state_path}/{LLM_CACHE_FOLDER}", config["llm_cache_max_mb"] * 1024 * 1024) if config["llm_cache"] else None
+    # when run by the orchestrator the LLM budget and the build slots are shared with the other targets
+    rate_limiter = None
+    if options["coordinator"]:
+        rate_limiter, BUILD_SLOTS = connect_to_coordinator(options["coordinator"], os.environ.get(COORDINATOR_KEY_VARIABLE, ""))
+    # every request and its answer are recorded in the transcript, an earlier transcript can be replayed with the replay backend
+    client = LLMClient(config, rate_limiter=rate_limiter, cache=llm_cache, transcript_path=f"{logs_folder_name}/{LLM_TRANSCRIPT_FILE}")
+
+    # the entries of the target folder that are not copied in the worktrees of the candidate fixes
+    worktree_exclude = set()
+    if os.path.abspath(path) == os.getcwd():
+        worktree_exclude.update([tmp_path, state_path, "logs"])
+    worktree_exclude.add(os.path.normpath(get_fuzzer_output_folder(path, fuzz_instr)).split('/')[0])
+
+    # the source files of the target are indexed once, the index is kept on disk and updated when the folders change
+    source_index = load_source_index(f"{state_path}/{SOURCE_INDEX_FILE}", path, worktree_exclude) if config["source_index"] else None
+
+    # the tree where the fixes are applied: the target tree itself or its snapshot
+    repair_path = f"{tmp_path}/repair" if config["repair_snapshot"] else path
+    needs_build = True
+
+    # the stages of the pipeline run on the target tree while the fixes are built, so it needs the repair snapshot
+    use_pipeline = config["pipeline"] and repair_path != path
+    if config["pipeline"] and not use_pipeline:
+        print("the pipeline needs the repair snapshot, the crashes are repaired one stage at a time")
+    # the crash index is updated by the triage stage of the pipeline and by the loop
+    index_lock = threading.Lock()
+
+    # the patches are compiled with -fsyntax-only before the build (see check_syntax) with the compilation database of the target
+    # or, if it has none, the one captured with the compiler shims during the first build
+    compile_commands_path = f"{state_path}/{COMPILE_COMMANDS_FILE}"
+    compilation_database = None
+    if config["syntax_check"]:
+        compilation_database = load_compilation_database(path, [f"{path}/{COMPILE_COMMANDS_FILE}", f"{path}/build/{COMPILE_COMMANDS_FILE}", compile_commands_path])
+    shims_path = f"{tmp_path}/{COMPILER_SHIMS_FOLDER}" if config["syntax_check"] and compilation_database is None else None
+
+    # the reports are compacted to the token budget before being sent to the LLM, see compact_report
+    compact = lambda report, tree_path: compact_report(report, tree_path, source_index, config["report_token_budget"],
+                                                       config["report_context_lines"]) if config["compact_reports"] else report
 
     # is it the first run - if so we use the provided instructions to fuzz the program otherwise
     # we must change the provided input folder to "-" e.g. "-i input" --> "-i -"
@@ -717,11 +4611,31 @@ if __name__ == "__main__":
 
 #|_|_| start of outer loop |_|_|#
     while True:
-        # we build the program following the instructions provided
-        build_program(path, build_instr)
+        # we build the program following the instructions provided, unless a fix has been built and validated in the repair snapshot
+        if needs_build and shims_path is not None:
+            build_program(path, build_instr, create_compiler_shims(shims_path))
+            print(f"captured the compilation of {save_compile_commands(shims_path, compile_commands_path)} files")
+            compilation_database = load_compilation_database(path, [compile_commands_path])
+            shutil.rmtree(shims_path, ignore_errors=True)
+            shims_path = None
+        elif needs_build:
+            build_program(path, build_instr)
         with open(f"{logs_folder_name}/log.txt", 'a') as file:
             file.write(f"{path}\n")
 
+        # the fixes are applied, built and validated in a snapshot of the target tree, so that the fuzzer can keep running
+        # on the last good binary in the target tree
+        if config["repair_snapshot"] and not os.path.exists(repair_path):
+            print("creating the repair snapshot...", end='')
+            create_worktree(path, repair_path, worktree_exclude)
+            print(" - done")
+        elif config["repair_snapshot"]:
+            # the snapshot left by a previous run might hold the patches of an interrupted attempt (tmp_<target> is not
+            # removed when the script is killed), it is brought back to the target tree that has just been built
+            print("syncing the repair snapshot...", end='')
+            sync_tree(path, repair_path, worktree_exclude)
+            print(" - done")
+
         # if it is not the first run we change the input folder to "-"
         if not first_run and not changed_fuzz_instr:
             with open(f"{path}/{fuzz_instr}", 'r') as file:
@@ -737,8 +4651,9 @@ if __name__ == "__main__":
 
 
         # we launch the fuzzer as specified in the provided instructions
+        fuzzer_start = time.monotonic()
         fuzzer_started_event = threading.Event()
-        fuzzing_thread = threading.Thread(target=fuzz_program, args=(path, fuzz_instr, fuzzer_started_event, tmp_folder_absolute_path))
+        fuzzing_thread = threading.Thread(target=fuzz_program, args=(path, fuzz_instr, fuzzer_started_event, tmp_folder_absolute_path, options["fuzzer_cores"], config["fuzzer_instances"]))
         fuzzing_thread.start()
         first_run = False
         
@@ -746,35 +4661,70 @@ if __name__ == "__main__":
             file.write(f"started fuzzing @ {time.ctime()}\n")
 
 
-        # we create a queue where new bug-triggering input filenames will be added by the monitoring_thread
-        queue = Queue()
+        # we create a queue where new bug-triggering input filenames will be added by the monitoring_thread,
+        # the reproduced crashes are ranked so that the most valuable one is repaired first (see CrashQueue)
+        # with the pipeline the crashes are taken in the order they were found if they are not ranked
+        # every crash is recorded, and its input copied into the state folder, as soon as it is found
+        record = (lambda item: store.add_crash(item, f"{path}/{fuzzer_output_folder}/{item}")) if store is not None else None
+        queue = CrashQueue(crash_index, config["priority_weights"] if config["priority_queue"] else {}, index_lock, record)
 
 
         # after we have started fuzzing we wait for the fuzzing thread to signal us that we have indeed started fuzzing
         # we obtain AFL pid and retrieve the output folder
         # we create a new thread that will monitor the output folder for new files, it will add their filename to the queue
-        fuzzer_pid = check_fuzzer_launch(fuzzer_started_event, fuzzing_thread, logs_folder_name)
+        # with several instances the crashes of all of them are merged in the queue
+        instance_names = [name for name, _ in get_fuzzer_commands(path, fuzz_instr, config["fuzzer_instances"])]
+        fuzzer_pids = check_fuzzer_launch(fuzzer_started_event, fuzzing_thread, logs_folder_name, len(instance_names))
+        METRICS.event("fuzzer_start", time.monotonic() - fuzzer_start, instances=len(fuzzer_pids))
         fuzzer_output_folder = get_fuzzer_output_folder(path, fuzz_instr)
+        # the buckets fixed before the regression corpus existed are added to it while their inputs can still be found
+        for bucket in crash_index.values():
+            if bucket["status"] == "fixed":
+                add_to_regression_corpus(regression_corpus_path, bucket, f"{path}/{fuzzer_output_folder}", store)
 
         stop_monitoring_event = threading.Event()
-        monitoring_thread = threading.Thread(target=monitor_folder, args=(f"{path}/{fuzzer_output_folder}/default/crashes", queue, stop_monitoring_event))
+        # the crashes that have not been handled yet (e.g. found while the script was not running) are added to the queue as well,
+        # the pending ones are resumed from the copies of their inputs in the state folder
+        handled_files = None
+        if store is not None:
+            pending_inputs = store.pending_inputs()
+            handled_files = store.handled_inputs() | set(pending_inputs)
+            for item in pending_inputs:
+                queue.put(item)
+        monitoring_thread = threading.Thread(target=monitor_instances, args=(f"{path}/{fuzzer_output_folder}", instance_names, queue, stop_monitoring_event,
+                                                                             config["monitor_backend"], handled_files))
         monitoring_thread.start()
 
+        # the crashes are triaged and prepared for repair in the background while the loop repairs the previous one (see RepairPipeline)
+        triage = lambda new_file: triage_crash(new_file, path, fuzzer_output_folder, run_instr, config, crash_index, crash_index_path,
+                                               store, logs_folder_name, index_lock)
+        prepare = lambda new_file, info, stop_event=None: prepare_crash(new_file, info, path, run_instr, config, minimized_inputs_path, store, logs_folder_name,
+                                                                        client, compact, compiled_with_asan, source_index,
+                                                                        use_pipeline and config["num_candidates"] == 1, stop_event)
+        pipeline = RepairPipeline(queue, triage, prepare, config["pipeline_depth"]) if use_pipeline else None
+        if pipeline is not None:
+            pipeline.start()
+
 
     #|_|_| start of inner loop |_|_|#
         inner_loop = True
         while inner_loop:
             # we grab a new filename from the queue, if none is available we wait for at most x time
+            # with the pipeline the crash has already been reproduced and localized, and its first fixes requested, in the background
             print("waiting for new files...")
             try:
-                new_file = queue.get(block=True, timeout=queue_timeout)
-                with open(f"{logs_folder_name}/log.txt", 'a') as file:
-                    file.write(f"new bug-triggering input: {new_file} @ {time.ctime()}\n")
+                if pipeline is not None:
+                    new_file, prepared = pipeline.get(timeout=queue_timeout)
+                else:
+                    new_file, info = queue.get(block=True, timeout=queue_timeout)
+                    prepared = None
             except Empty:
                 print("No new files added in the last two hours")
                 with open(f"{logs_folder_name}/log.txt", 'a') as file:
                     file.write(f"No new files added in the last hour, exiting @ {time.ctime()}\n")
-                os.kill(fuzzer_pid, signal.SIGINT)
+                if pipeline is not None:
+                    pipeline.stop()
+                stop_fuzzers(fuzzer_pids)
                 shutil.rmtree(tmp_path)
                 fuzzing_thread.join()
                 stop_monitoring_event.set()
@@ -782,59 +4732,189 @@ if __name__ == "__main__":
                 print("exiting...")
                 exit(0)
 
-
-            # then we reproduce the bug: we substitute "INPUT" or "INPUT_STDIN" in the provided instructions
-            # with the faulty input identified by the fuzzer
-            # we return the report fetched from stderr and if the program is actually crashing
-            is_crashing, report = run_program(path, run_instr, f"./{fuzzer_output_folder}/default/crashes/{new_file}")
-
-            if is_crashing:
-                # we try to fix the program leveraging an LLM model (e.g. ChatGPT 3.5)
-                # first of all if we have a generic report we use the LLM to find file, fucntion and line of possible buggy functions
-                if not compiled_with_asan:
-                    file_to_check_json = ask_llm_to_find(client, report, logs_folder_name) 
-                    buggy_functions = parse_llm_buggy_function_response(file_to_check_json)
-                # otherwise we parse the ASAN report
-                else:
-                    buggy_functions, report = asan_report_parser(report)
-                
+            if prepared is None:
+                # then we reproduce the bug and compute its signature, the inputs that do not crash and the duplicates are dropped
+                if info is None:
+                    info = triage(new_file)
+                    if info is None:
+                        continue
+                    # the crash is ranked with the other pending crashes and repaired when its turn comes
+                    if config["priority_queue"]:
+                        queue.put_triaged(new_file, info)
+                        continue
+                prepared = prepare(new_file, info)
+
+            crash_input, report, frames, signature = prepared["crash_input"], prepared["report"], prepared["frames"], prepared["signature"]
+            buggy_functions = prepared["buggy_functions"]
+            is_crashing = True
+
+            # the bug-triggering input is copied into the repair snapshot
+            if is_crashing and repair_path != path:
+                input_name = new_file.replace('/', '_')
+                os.makedirs(f"{repair_path}/.afl_loop_input", exist_ok=True)
+                shutil.copyfile(f"{path}/{crash_input}", f"{repair_path}/.afl_loop_input/{input_name}")
+                crash_input = f"./.afl_loop_input/{input_name}"
+
+            # the fixes are checked by replaying the known crashes and a sample of the queue of the fuzzer
+            validate = None
+            if is_crashing and config["regression_replay"]:
+                # the crash index is copied since the triage stage of the pipeline adds buckets to it while the fix is checked
+                validate = lambda tree_path: check_regressions(tree_path, run_instr, f"{path}/{fuzzer_output_folder}", instance_names,
+                                                               dict(crash_index), config, logs_folder_name, regression_corpus_path, signature)
 
             # if we have found buggy functions we try to fix them, we give the LLM x amount of tries
             it = 0
             done_something = False
+            # the original content of the files of the buggy functions, every attempt starts from it (see restore_files)
+            original_files = {}
+            stale_files = set()
+            # the last rejected attempt: its fixes, why it has been rejected and the report of the program with the fix (see add_rejected_fix)
+            rejected = None
             while is_crashing and it < num_tries_to_fix:
                 print(it)
                 print(f"bugs in: {buggy_functions}")
-                # for each item we think might be buggy we fetch the code of the function and ask the LLM to fix it
-                for item in buggy_functions:
-                    file_path = find_file(item["file"], path)
-                    print(f"file_path: {file_path}")
-                    if file_path is None:
-                        with open(f"{logs_folder_name}/log.txt", 'a') as file:
-                            file.write(f"Could not find the file {item['file']} @ {time.ctime()}\n")
-                        continue
-                    starting_line, ending_line, function_code = get_function_code(file_path, item["function"])
-                    print(f"starting_line: {starting_line}, ending_line: {ending_line}")
-                    if starting_line is not None:
-                        print(f"function_code: {function_code}")
-                        fixed_function_code = ask_llm_to_fix(client, report, function_code, logs_folder_name)
-                        print(f"fixed_function_code: {fixed_function_code}")
-                        time.sleep(llm_timeout) #this timeout is not to hit the rate limiter of OpenAI
-
-                        # we replace the buggy function with the fixed one, rebuild the program and rerun it and loop again
-                        if fixed_function_code is not None and fixed_function_code != "None" and fixed_function_code != "":
-                            replace_function_in_c_file(file_path, item["function"], fixed_function_code, starting_line, ending_line)
-                            done_something = True
 
-                if done_something:
-                    build_program(path, build_instr)
-                    is_crashing, report = run_program(path, run_instr, f"./{fuzzer_output_folder}/default/crashes/{new_file}")
+                # the patches of a failed attempt are rolled back, the next one is not stacked on top of them
+                restored_files = restore_files(original_files)
+                if restored_files:
+                    print(f"rolled back {len(restored_files)} files to the original code")
+                    stale_files.update(restored_files)
+
+                # for each item we think might be buggy we fetch the code of the function from the repair tree
+                functions = collect_buggy_functions(buggy_functions, path, logs_folder_name, source_index, repair_path)
+                snapshot_files(original_files, [file_path for file_path, _, _ in functions])
+
+                # the request is built again from the rolled back tree: the source lines of the report are read from the original code,
+                # the one sent to the LLM, and the rejected fixes are added with the reason why they have been rejected
+                if rejected is not None:
+                    if rejected["report"] is not None:
+                        base_report = compact(rejected["report"], repair_path)
+                    report = add_rejected_fix(base_report, rejected["functions"], rejected["fixes"], rejected["reason"])
+                    rejected = None
+                else:
+                    base_report = report
+                attempt_id = store.add_attempt(new_file, signature, it, config["num_candidates"]) if store is not None else None
+
+                # several candidate fixes are built and run in parallel, each one in its own copy of the repair tree
+                if config["num_candidates"] > 1:
+                    is_crashing, report, done_something = fix_with_parallel_candidates(client, report, functions, repair_path, build_instr, run_instr,
+                                                                                       crash_input, config, tmp_path, worktree_exclude,
+                                                                                       object_cache_path, logs_folder_name, validate, compilation_database)
+                    report = compact(report, repair_path)
+                    if not done_something:
+                        print("did not do anything")
+                    if store is not None:
+                        store.finish_attempt(attempt_id, "no_patch" if not done_something else "crashing" if is_crashing else "fixed")
+                    it += 1
+                    continue
+
+                touched_files = set()
+                # the fixes requested by the pipeline are used only if they were requested for the same code,
+                # e.g. not if the file has been changed by the fix of another crash in the meantime
+                fixes = prepared.pop("fixes", None)
+                if fixes is not None and [(os.path.relpath(file_path, repair_path), name, code) for file_path, name, code in functions] != \
+                                         [(os.path.relpath(file_path, path), name, code) for file_path, name, code in prepared["functions"]]:
+                    print("the buggy functions have changed since their fixes were requested, asking again")
+                    fixes = None
+                # we ask the LLM to fix them, all the functions are sent in a single request, or concurrently if batching is disabled or fails
+                if fixes is None:
+                    fixes = client.run(request_fixes_async(client, report, functions, logs_folder_name, config["batch_fix_requests"]))
+
+                for (file_path, function_name, _), fixed_function_code in zip(functions, fixes):
+                    print(f"fixed_function_code: {fixed_function_code}")
+
+                    # we replace the buggy function with the fixed one, rebuild the program and rerun it and loop again
+                    if fixed_function_code is not None and fixed_function_code != "None" and fixed_function_code != "":
+                        # the function is looked up again since a previous fix might have changed the lines of the same file
+                        starting_line, ending_line, _ = get_function_code(file_path, function_name)
+                        if starting_line is not None:
+                            with METRICS.timer("patch", function=function_name):
+                                replace_function_in_c_file(file_path, function_name, fixed_function_code, starting_line, ending_line)
+                            touched_files.add(file_path)
+                            done_something = True
+                            if store is not None:
+                                store.add_patch(attempt_id, os.path.relpath(file_path, repair_path), function_name, fixed_function_code)
+
+                outcome = "no_patch"
+                # a fix that does not compile is rejected without building, the compiler errors are sent with the next request
+                diagnostics = None
+                if touched_files and compilation_database:
+                    with METRICS.timer("syntax_check", files=len(touched_files)):
+                        diagnostics = check_syntax(compilation_database, touched_files, repair_path)
+                if diagnostics is not None:
+                    print(f"try #{it} - the fix does not compile")
+                    outcome = "syntax_error"
+                    record_fix_outcome(client, report, functions, fixes, False)
+                    rejected = {"report": None, "functions": functions, "fixes": fixes, "reason": f"it does not compile:\n{diagnostics}"}
+                elif done_something:
+                    # only the modified files are recompiled, the full build script is used only for the first build
+                    # the files rolled back since the last build are recompiled as well
+                    if config["incremental_rebuild"]:
+                        rebuild_program(repair_path, build_instr, config["rebuild_instr"], touched_files | stale_files, object_cache_path)
+                    else:
+                        build_program(repair_path, build_instr)
+                    stale_files = set()
+                    request_report = report
+                    is_crashing, report = run_program(repair_path, run_instr, crash_input, **get_run_options(config))
                     print(f"try #{it} - is_crashing: {is_crashing}")
+                    outcome = "crashing" if is_crashing else "fixed"
+
+                    # a fix that introduces new crashes is rejected, the new crashes are sent to the LLM at the next try
+                    if not is_crashing and validate is not None:
+                        regression_report = validate(repair_path)
+                        if regression_report is not None:
+                            is_crashing, report = True, regression_report
+                            outcome = "regression"
+                    # the report is compacted at the next try, once the fix has been rolled back
+                    if is_crashing:
+                        reason = "it introduces the new crashes reported above" if outcome == "regression" else \
+                                 "the program does not terminate anymore" if is_hang(report) else "the program still crashes as reported above"
+                        rejected = {"report": report, "functions": functions, "fixes": fixes, "reason": reason}
+
+                    # the fixes that solved the bug are marked as good in the LLM cache, the ones that did not are removed
+                    record_fix_outcome(client, request_report, functions, fixes, not is_crashing)
                 else:
                     print("did not do anything")
+                if store is not None:
+                    store.finish_attempt(attempt_id, outcome)
                 it += 1
 
 
+            # a fix that did not work is discarded by bringing the repair snapshot back to the target tree,
+            # or by restoring the original code if the fixes are applied to the target tree directly
+            if is_crashing and done_something and repair_path != path:
+                sync_tree(path, repair_path, worktree_exclude)
+            elif is_crashing and done_something:
+                restored_files = restore_files(original_files) | stale_files
+                if restored_files:
+                    rebuild_tree(path, build_instr, config["rebuild_instr"] if config["incremental_rebuild"] else None, restored_files, object_cache_path)
+
+            # the accepted fix is exported as a unified diff of the target tree
+            if not is_crashing and it > 0:
+                diff_path = f"{logs_folder_name}/fixes/{new_file.replace('/', '_')}.diff"
+                if export_fix_diff(original_files, repair_path, diff_path):
+                    with open(f"{logs_folder_name}/log.txt", 'a') as file:
+                        file.write(f"fix of {new_file} written to {diff_path} @ {time.ctime()}\n")
+
+            if it > 0:
+                METRICS.event("fix_outcome", fixed=not is_crashing, tries=it, signature=signature)
+
+            # we record the outcome in the bucket of the crash
+            if signature is not None and it > 0:
+                with index_lock:
+                    crash_index[signature]["status"] = "fixed" if not is_crashing else "not_fixed"
+                    save_crash_index(crash_index, crash_index_path)
+                    if store is not None:
+                        store.save_bucket(signature, crash_index[signature])
+                    # the inputs of the fixed crash are kept for the regression replays of the next fixes
+                    if not is_crashing:
+                        add_to_regression_corpus(regression_corpus_path, crash_index[signature], f"{path}/{fuzzer_output_folder}", store)
+
+            # the crash has been handled, it is not resumed anymore
+            if store is not None:
+                store.update_crash(new_file, "not_crashing" if not is_crashing and it == 0 else "fixed" if not is_crashing else "not_fixed",
+                                   signature=signature, bug_type=crash_index[signature]["bug_type"] if signature is not None else None)
+
             # if we have not fixed the program we log it and move on
             if it == 10 and is_crashing:
                 with open(f"{logs_folder_name}/log.txt", 'a') as file:
@@ -850,13 +4930,23 @@ if __name__ == "__main__":
                 with open(f"{logs_folder_name}/log.txt", 'a') as file:
                     file.write(f"fixed the issue in {it} try @ {time.ctime()}\n\n")
                 print("successfully applied a fix\nStopping and restarting fuzzing")
-                os.kill(fuzzer_pid, signal.SIGINT)
+                # the crashes in the pipeline have been reproduced against the program before the fix, they are triaged again after the restart
+                if pipeline is not None:
+                    pipeline.stop()
+                stop_fuzzers(fuzzer_pids)
                 print("    killed fuzzer")
                 fuzzing_thread.join()
                 print("stopped fuzzing thread & ", end='')
                 stop_monitoring_event.set()
                 monitoring_thread.join()
                 print("stopped monitoring thread")
+
+                # the fixed sources and the binary built in the repair snapshot are swapped in, no need to build again
+                if repair_path != path:
+                    sync_tree(repair_path, path, worktree_exclude)
+                    needs_build = False
+                else:
+                    needs_build = True
                 inner_loop = False
 
     #|_|_| end of inner loop |_|_|#
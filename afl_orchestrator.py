@@ -0,0 +1,214 @@
+import os, sys, signal, time, argparse, threading, json
+from subprocess import Popen, STDOUT
+from multiprocessing.managers import BaseManager, AcquirerProxy
+from afl_loop import RateLimiter, CONFIG_FILE_PATH, COORDINATOR_KEY_VARIABLE, CRASH_INDEX_FILE, load_config_file, load_crash_index, setup_logs_folder, set_state_folder_name
+
+# --------------------------------------------------------- #
+#
+# HOW TO - a readme might be provided with more informations
+# the orchestrator runs one afl_loop.py process per target
+# listed in a manifest, a json file like the following:
+#   {
+#       "max_builds": 2,
+#       "targets": [
+#           {"path": "libxml2", "build": "build.txt", "run": "run.txt", "fuzz": "fuzz.txt", "cores": 2},
+#           {"path": "libpng", "cores": 1}
+#       ]
+#   }
+# the fuzzers are pinned to different cores, at most max_builds
+# targets build at the same time and all the targets share the
+# same LLM rate limit.
+#
+# --------------------------------------------------------- #
+
+
+AFL_LOOP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "afl_loop.py")
+
+
+def parse_arguments():
+    """
+    This function parses and returns the arguments provided by the user using the argparse library.
+    The arguments collected are the path of the manifest and how often [seconds] the throughput is reported.
+    """
+
+    help = "AFL loop orchestrator\n -m: the path of the json manifest listing the targets.\n  -i: how often [seconds] the aggregate throughput is reported."
+
+    parser = argparse.ArgumentParser(add_help=True, description=help)
+
+    parser.add_argument("-m", default="manifest.json", type=str)
+    parser.add_argument("-i", default=600, type=int)
+    args = parser.parse_args()
+
+    print(f"manifest: {args.m}, \nreport_interval: {args.i}")
+    return args.m, args.i
+# --------------------------------------------------------- #
+
+
+
+def load_manifest(file_path):
+    """
+    This function loads the manifest and returns the maximum number of concurrent builds and the list of targets.
+    Every target has the -p/-b/-r/-f arguments of afl_loop.py (path, build, run, fuzz) and the number of cores of its fuzzer,
+    missing values are set to the defaults of afl_loop.py.
+    Two targets cannot share the basename of their path, since afl_loop.py names its tmp, state and logs folders after it.
+    """
+
+    with open(file_path, 'r') as file:
+        manifest = json.load(file)
+
+    targets = []
+    names = set()
+    for item in manifest["targets"]:
+        target = {"build": "build.txt", "run": "run.txt", "fuzz": "fuzz.txt", "cores": 1}
+        target.update(item)
+        target["name"] = os.path.basename(os.path.normpath(target["path"]))
+        if target["name"] in names:
+            raise ValueError(f"two targets are named {target['name']}, the basenames of the paths must be unique")
+        names.add(target["name"])
+        targets.append(target)
+
+    return manifest.get("max_builds", 1), targets
+# --------------------------------------------------------- #
+
+
+
+def assign_cores(targets):
+    """
+    This function assigns to every target the cores its fuzzer is pinned to, the cores are taken in order
+    from the ones this process is allowed to run on so that no two fuzzers share a core.
+    """
+
+    available = sorted(os.sched_getaffinity(0))
+    needed = sum(target["cores"] for target in targets)
+    if needed > len(available):
+        raise ValueError(f"the fuzzers need {needed} cores but only {len(available)} are available")
+
+    for target in targets:
+        target["fuzzer_cores"] = available[:target["cores"]]
+        available = available[target["cores"]:]
+# --------------------------------------------------------- #
+
+
+
+def start_coordinator(config, max_builds, authkey):
+    """
+    This function starts the coordinator, a multiprocessing manager that serves the rate limiter shared
+    by the LLM clients of all the targets and the semaphore that limits the number of concurrent builds.
+    afl_loop.py connects to it with connect_to_coordinator. It returns the manager and its address.
+    """
+
+    rate_limiter = RateLimiter(config["llm_requests_per_minute"], config["llm_tokens_per_minute"])
+    build_slots = threading.BoundedSemaphore(max_builds)
+
+    class Coordinator(BaseManager):
+        pass
+
+    Coordinator.register("rate_limiter", callable=lambda: rate_limiter)
+    Coordinator.register("build_slots", callable=lambda: build_slots, proxytype=AcquirerProxy)
+
+    # the manager must be started in a thread of this process: the callables are closures and it is not
+    # possible to pickle them into a server process
+    manager = Coordinator(address=("127.0.0.1", 0), authkey=authkey)
+    server = manager.get_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    host, port = server.address
+    return manager, f"{host}:{port}"
+# --------------------------------------------------------- #
+
+
+
+def launch_target(target, address, authkey, logs_folder_name):
+    """
+    This function launches afl_loop.py on a target, pinning its fuzzer and connecting it to the coordinator.
+    The output of the process is written to a file in the logs folder of the orchestrator.
+    It returns the process.
+    """
+
+    command = [sys.executable, AFL_LOOP_PATH, "-p", target["path"], "-b", target["build"], "-r", target["run"], "-f", target["fuzz"],
+               "--fuzzer-cores", ','.join(str(core) for core in target["fuzzer_cores"]), "--coordinator", address]
+    environment = dict(os.environ)
+    environment[COORDINATOR_KEY_VARIABLE] = authkey.decode()
+
+    output = open(f"{logs_folder_name}/{target['name']}.txt", 'a')
+    process = Popen(command, stdout=output, stderr=STDOUT, env=environment)
+    output.close()
+
+    print(f"started {target['name']} (pid {process.pid}) on cores {target['fuzzer_cores']}")
+    return process
+# --------------------------------------------------------- #
+
+
+
+def count_fixed_crashes(target):
+    """
+    This function returns the number of crash buckets of a target that have been fixed, read from its crash index.
+    """
+
+    crash_index = load_crash_index(f"{set_state_folder_name(target['path'])}/{CRASH_INDEX_FILE}")
+    return sum(1 for bucket in crash_index.values() if bucket.get("status") == "fixed")
+# --------------------------------------------------------- #
+
+
+
+def report_throughput(targets, baseline, start_time, logs_folder_name):
+    """
+    This function reports how many crashes have been repaired since the orchestrator started, per target and in total,
+    and the aggregate throughput in crashes repaired per hour.
+    The crash indexes are kept between runs, so the crashes fixed before the start (baseline) are not counted.
+    """
+
+    hours = max(time.monotonic() - start_time, 1) / 3600
+    repaired = {target["name"]: count_fixed_crashes(target) - baseline[target["name"]] for target in targets}
+    total = sum(repaired.values())
+
+    message = f"repaired {total} crashes in {hours:.2f}h - {total / hours:.2f} crashes/h ({', '.join(f'{name}: {count}' for name, count in repaired.items())})"
+    print(message)
+    with open(f"{logs_folder_name}/log.txt", 'a') as file:
+        file.write(f"{message} @ {time.ctime()}\n")
+# --------------------------------------------------------- #
+
+
+
+if __name__ == "__main__":
+
+#|_|_| beginning of setup phase |_|_|#
+    manifest_path, report_interval = parse_arguments()
+    max_builds, targets = load_manifest(manifest_path)
+    assign_cores(targets)
+
+    # the orchestrator shares the configuration file with the targets, the LLM budget is the one specified there
+    _, _, _, _, config = load_config_file(CONFIG_FILE_PATH)
+    logs_folder_name = setup_logs_folder("orchestrator")
+
+    authkey = os.urandom(16).hex().encode()
+    manager, address = start_coordinator(config, max_builds, authkey)
+    print(f"coordinator listening on {address}")
+
+    baseline = {target["name"]: count_fixed_crashes(target) for target in targets}
+    start_time = time.monotonic()
+    processes = {target["name"]: launch_target(target, address, authkey, logs_folder_name) for target in targets}
+#|_|_| end of setup phase |_|_|#
+
+
+#|_|_| start of monitoring loop |_|_|#
+    # the targets exit on their own once the fuzzer has not found anything for queue_timeout seconds
+    try:
+        last_report = time.monotonic()
+        while any(process.poll() is None for process in processes.values()):
+            time.sleep(1)
+            if time.monotonic() - last_report >= report_interval:
+                report_throughput(targets, baseline, start_time, logs_folder_name)
+                last_report = time.monotonic()
+    except KeyboardInterrupt:
+        print("stopping the targets...")
+        for process in processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in processes.values():
+            process.wait()
+#|_|_| end of monitoring loop |_|_|#
+
+    for name, process in processes.items():
+        print(f"{name} exited with code {process.returncode}")
+    report_throughput(targets, baseline, start_time, logs_folder_name)
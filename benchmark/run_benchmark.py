@@ -0,0 +1,157 @@
+import os, sys, shutil, argparse, json, glob, tempfile, time
+from subprocess import run, STDOUT, TimeoutExpired
+
+# --------------------------------------------------------- #
+#
+# HOW TO - see the benchmark section of the readme
+# the benchmark runs afl_loop.py end to end, with AFL and the
+# deterministic stub LLM (stub_llm/anthropic), on the targets
+# in the targets folder: small C programs with a bug detected
+# by ASAN. Every target contains build.txt, run.txt, fuzz.txt,
+# a seed in input/ and the fixes returned by the stub LLM in
+# fixes.json. The numbers are read from the metrics.jsonl
+# written by afl_loop.py.
+#
+# --------------------------------------------------------- #
+
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+AFL_LOOP_PATH = os.path.join(os.path.dirname(BENCHMARK_PATH), "afl_loop.py")
+TARGETS_PATH = os.path.join(BENCHMARK_PATH, "targets")
+STUB_LLM_PATH = os.path.join(BENCHMARK_PATH, "stub_llm")
+
+
+def parse_arguments():
+    """
+    This function parses and returns the arguments provided by the user using the argparse library.
+    The arguments collected are the targets to run (all by default), the file where the results are written,
+    the timeout of every target [seconds], the queue timeout of afl_loop.py [seconds] and if the working folders are kept.
+    """
+
+    help = "AFL loop benchmark\n -t: the targets to run, all if not specified.\n  -o: the json file where the results are written.\n  --timeout: how long [seconds] a target can run.\n  --queue-timeout: how long [seconds] afl_loop.py keeps fuzzing after the last crash.\n  --keep: keep the working folders."
+
+    parser = argparse.ArgumentParser(add_help=True, description=help)
+
+    parser.add_argument("-t", nargs='*', default=None, type=str)
+    parser.add_argument("-o", default="benchmark_results.json", type=str)
+    parser.add_argument("--timeout", default=900, type=int)
+    parser.add_argument("--queue-timeout", default=120, type=int)
+    parser.add_argument("--keep", action="store_true")
+    args = parser.parse_args()
+
+    targets = args.t or sorted(item for item in os.listdir(TARGETS_PATH) if os.path.isdir(os.path.join(TARGETS_PATH, item)))
+    return targets, args.o, args.timeout, args.queue_timeout, args.keep
+# --------------------------------------------------------- #
+
+
+
+def run_target(name, timeout, queue_timeout, keep):
+    """
+    This function runs afl_loop.py on a copy of a target in a new working folder, so that every run starts
+    without state (crash index, caches, fuzzer output). The stub LLM is put first in PYTHONPATH.
+    It returns the metrics events written by afl_loop.py and if the run has timed out.
+    """
+
+    work_path = tempfile.mkdtemp(prefix=f"afl_loop_benchmark_{name}_")
+    shutil.copytree(os.path.join(TARGETS_PATH, name), os.path.join(work_path, name))
+
+    # afl_loop.py reads its configuration from the working folder
+    with open(os.path.join(work_path, "afl_loop_config.json"), 'w') as file:
+        json.dump({"queue_timeout": queue_timeout, "metrics": True}, file)
+
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join([STUB_LLM_PATH] + ([environment["PYTHONPATH"]] if environment.get("PYTHONPATH") else []))
+    environment["BENCHMARK_FIXES"] = os.path.join(work_path, name, "fixes.json")
+    environment.setdefault("AFL_SKIP_CPUFREQ", "1")
+    environment.setdefault("AFL_I_DONT_CARE_ABOUT_MISSING_CRASHES", "1")
+    environment.setdefault("AFL_NO_UI", "1")
+
+    print(f"running {name} in {work_path}...", end='', flush=True)
+    timed_out = False
+    with open(os.path.join(work_path, "output.txt"), 'w') as output:
+        try:
+            run([sys.executable, AFL_LOOP_PATH, "-p", name], cwd=work_path, env=environment, stdout=output, stderr=STDOUT, timeout=timeout)
+        except TimeoutExpired:
+            timed_out = True
+    print(" - timed out" if timed_out else " - done")
+
+    events = []
+    for metrics_path in glob.glob(os.path.join(work_path, "logs", f"{name}_*", "metrics.jsonl")):
+        with open(metrics_path, 'r') as file:
+            events += [json.loads(line) for line in file if line.strip()]
+    events.sort(key=lambda item: item["time"])
+
+    if not keep:
+        shutil.rmtree(work_path, ignore_errors=True)
+    return events, timed_out
+# --------------------------------------------------------- #
+
+
+
+def summarize_events(events):
+    """
+    This function computes the numbers of a run from its metrics events:
+    the time from the start of the fuzzer to the first crash, the time from the first crash to the first fix,
+    the number of fixes and of failed repairs, the builds (full and incremental) and the LLM calls per fix.
+    The initial build is not counted. The times are None if the run never got there.
+    """
+
+    fuzzer_starts = [item for item in events if item["stage"] == "fuzzer_start"]
+    crashes = [item for item in events if item["stage"] == "crash_detection"]
+    outcomes = [item for item in events if item["stage"] == "fix_outcome"]
+    fixes = [item for item in outcomes if item["fixed"]]
+
+    first_crash_time = crashes[0]["time"] if crashes else None
+    builds = [item for item in events if item["stage"] in ("build", "rebuild") and first_crash_time is not None and item["time"] > first_crash_time]
+    llm_calls = [item for item in events if item["stage"] == "llm"]
+
+    result = {
+        "time_to_first_crash": None,
+        "time_to_first_fix": None,
+        "fixes": len(fixes),
+        "failed_repairs": len(outcomes) - len(fixes),
+        "builds_per_fix": None,
+        "llm_calls_per_fix": None
+    }
+    if fuzzer_starts and crashes:
+        result["time_to_first_crash"] = round(first_crash_time - (fuzzer_starts[0]["time"] - fuzzer_starts[0]["duration"]), 3)
+    if fixes:
+        result["time_to_first_fix"] = round(fixes[0]["time"] - first_crash_time, 3)
+        result["builds_per_fix"] = round(len(builds) / len(fixes), 2)
+        result["llm_calls_per_fix"] = round(len(llm_calls) / len(fixes), 2)
+    return result
+# --------------------------------------------------------- #
+
+
+
+def print_results(results):
+    """
+    This function prints the results of the benchmark as a table.
+    """
+
+    columns = ["time_to_first_crash", "time_to_first_fix", "fixes", "failed_repairs", "builds_per_fix", "llm_calls_per_fix"]
+    print(f"\n{'target':<20}" + ''.join(f"{column:>22}" for column in columns))
+    for name, result in results.items():
+        print(f"{name:<20}" + ''.join(f"{str(result[column]):>22}" for column in columns))
+# --------------------------------------------------------- #
+
+
+
+if __name__ == "__main__":
+    targets, results_path, timeout, queue_timeout, keep = parse_arguments()
+
+    for tool in ("afl-fuzz", "afl-clang-fast"):
+        if shutil.which(tool) is None:
+            print(f"{tool} not found, the benchmark needs AFL++ in PATH")
+            exit(1)
+
+    results = {}
+    for name in targets:
+        events, timed_out = run_target(name, timeout, queue_timeout, keep)
+        results[name] = summarize_events(events)
+        results[name]["timed_out"] = timed_out
+
+    print_results(results)
+    with open(results_path, 'w') as file:
+        json.dump({"time": time.ctime(), "results": results}, file, indent=4)
+    print(f"\nresults written to {results_path}")
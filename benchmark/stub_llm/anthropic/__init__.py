@@ -0,0 +1,52 @@
+import os, re, json, asyncio
+from types import SimpleNamespace
+
+# --------------------------------------------------------- #
+#
+# deterministic stand-in for the anthropic package, used by
+# run_benchmark.py: it is put first in PYTHONPATH so that
+# afl_loop.py imports it instead of the real client.
+# the answers come from the fixes.json file of the target
+# (BENCHMARK_FIXES), a dictionary from the name of every
+# buggy function to its fixed code.
+#
+# --------------------------------------------------------- #
+
+
+class APIStatusError(Exception):
+    def __init__(self, message, response=None, status_code=500):
+        super().__init__(message)
+        self.response = response
+        self.status_code = status_code
+
+
+
+class AsyncAnthropic:
+    """
+    This class answers the requests of afl_loop.py without any network access.
+    """
+
+    def __init__(self, max_retries=0, **kwargs):
+        with open(os.environ["BENCHMARK_FIXES"], 'r') as file:
+            self.fixes = json.load(file)
+        self.messages = SimpleNamespace(create=self.create)
+
+
+    async def create(self, model, max_tokens, messages, temperature=0.0, system=None, **kwargs):
+        content = messages[-1]["content"]
+
+        if '"patches"' in content:
+            # batched fix request: the functions are listed as "Function <name> in file <file>:"
+            names = re.findall(r"^Function (\w+) in file ", content, re.MULTILINE)
+            text = json.dumps({"patches": [{"function": name, "code": self.fixes[name]} for name in names if name in self.fixes]})
+        elif "provide a fix" in content:
+            # single fix request: the function is the one whose definition is in the request
+            names = [name for name in self.fixes if re.search(rf"^\w[\w \t\*]*\b{name}\s*\(", content, re.MULTILINE)]
+            text = self.fixes[names[0]] if names else "None"
+        else:
+            # the targets are compiled with ASAN, the buggy functions are never looked up by the LLM
+            text = "[]"
+
+        await asyncio.sleep(0)
+        return SimpleNamespace(content=[SimpleNamespace(type="text", text=text)],
+                               usage=SimpleNamespace(input_tokens=len(content) // 4, output_tokens=len(text) // 4))
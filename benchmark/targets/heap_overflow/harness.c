@@ -0,0 +1,40 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+/* a string is 'S' followed by its characters: the terminator is written past the end of the buffer */
+char *copy_string(const unsigned char *data, size_t size)
+{
+    char *result;
+
+    if (size < 1 || data[0] != 'S')
+        return NULL;
+
+    result = malloc(size - 1);
+    if (result == NULL)
+        return NULL;
+    memcpy(result, data + 1, size - 1);
+    result[size - 1] = '\0';
+
+    return result;
+}
+
+int main(int argc, char **argv)
+{
+    static unsigned char data[4096];
+    FILE *file;
+    size_t size;
+    char *string;
+
+    if (argc < 2 || (file = fopen(argv[1], "rb")) == NULL)
+        return 1;
+    size = fread(data, 1, sizeof(data), file);
+    fclose(file);
+
+    string = copy_string(data, size);
+    if (string != NULL) {
+        printf("%s\n", string);
+        free(string);
+    }
+    return 0;
+}
@@ -0,0 +1,50 @@
+#include <stdio.h>
+#include <string.h>
+
+struct entry {
+    char key;
+    int value;
+};
+
+static struct entry table[] = {
+    {'a', 1},
+    {'b', 2},
+    {'c', 3},
+};
+
+struct entry *find_entry(char key)
+{
+    size_t i;
+
+    for (i = 0; i < sizeof(table) / sizeof(table[0]); i++)
+        if (table[i].key == key)
+            return &table[i];
+    return NULL;
+}
+
+/* the first character of the input is looked up in the table: a missing key is not handled */
+int lookup_value(const unsigned char *data, size_t size)
+{
+    struct entry *entry;
+
+    if (size < 1)
+        return 0;
+
+    entry = find_entry((char)data[0]);
+    return entry->value;
+}
+
+int main(int argc, char **argv)
+{
+    static unsigned char data[4096];
+    FILE *file;
+    size_t size;
+
+    if (argc < 2 || (file = fopen(argv[1], "rb")) == NULL)
+        return 1;
+    size = fread(data, 1, sizeof(data), file);
+    fclose(file);
+
+    printf("%d\n", lookup_value(data, size));
+    return 0;
+}
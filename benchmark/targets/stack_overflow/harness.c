@@ -0,0 +1,34 @@
+#include <stdio.h>
+#include <string.h>
+
+/* a record is 'R', the length of the name and the name: the length is trusted */
+int parse_record(const unsigned char *data, size_t size)
+{
+    char name[16];
+    size_t length;
+
+    if (size < 2 || data[0] != 'R')
+        return 0;
+
+    length = data[1];
+    if (length > size - 2)
+        length = size - 2;
+    memcpy(name, data + 2, length);
+
+    return length > 0 ? name[0] : 0;
+}
+
+int main(int argc, char **argv)
+{
+    static unsigned char data[4096];
+    FILE *file;
+    size_t size;
+
+    if (argc < 2 || (file = fopen(argv[1], "rb")) == NULL)
+        return 1;
+    size = fread(data, 1, sizeof(data), file);
+    fclose(file);
+
+    printf("%d\n", parse_record(data, size));
+    return 0;
+}
@@ -0,0 +1,47 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+struct session {
+    char user[16];
+    int admin;
+};
+
+/* the commands are single characters: 'Q' logs out, the session is used after it has been freed */
+int handle_commands(const unsigned char *data, size_t size)
+{
+    struct session *session;
+    int admin;
+    size_t i;
+
+    session = calloc(1, sizeof(*session));
+    if (session == NULL)
+        return 0;
+    strcpy(session->user, "guest");
+
+    for (i = 0; i < size; i++) {
+        if (data[i] == 'Q')
+            free(session);
+        else if (data[i] == 'A')
+            session->admin = 1;
+    }
+
+    admin = session->admin;
+    free(session);
+    return admin;
+}
+
+int main(int argc, char **argv)
+{
+    static unsigned char data[4096];
+    FILE *file;
+    size_t size;
+
+    if (argc < 2 || (file = fopen(argv[1], "rb")) == NULL)
+        return 1;
+    size = fread(data, 1, sizeof(data), file);
+    fclose(file);
+
+    printf("%d\n", handle_commands(data, size));
+    return 0;
+}
@@ -0,0 +1,4 @@
+import os, sys
+
+# afl_loop.py is a script in the root of the repository, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,853 @@
+import os, json, queue, shutil, struct, subprocess, threading, time
+import pytest
+import afl_loop
+
+
+def test_rebuild_commands_keep_the_steps_of_a_multi_step_build(tmp_path):
+    (tmp_path / "build.txt").write_text("cd curl\n"
+                                        "./buildconf && ./configure --disable-shared && make -j4\n"
+                                        "cd ..\n"
+                                        "afl-clang-fast harness.c -Icurl/include curl/lib/.libs/libcurl.a -lz -o fuzzer\n")
+
+    commands = afl_loop.get_rebuild_commands(str(tmp_path), "build.txt", None)
+
+    assert commands == ["cd curl\n",
+                        "make -j4\n",
+                        "cd ..\n",
+                        "afl-clang-fast harness.c -Icurl/include curl/lib/.libs/libcurl.a -lz -o fuzzer\n"]
+
+
+def test_rebuild_commands_skip_the_configuration_steps(tmp_path):
+    (tmp_path / "build.txt").write_text("git clone https://github.com/curl/curl.git\n"
+                                        "CC=afl-clang-fast ./configure; make clean; make\n"
+                                        "make distclean && CFLAGS=-g make clean all\n")
+
+    commands = afl_loop.get_rebuild_commands(str(tmp_path), "build.txt", None)
+
+    assert commands == ["make\n", "CFLAGS=-g make all\n"]
+
+
+def test_replace_function_written_on_one_line(tmp_path):
+    file_path = tmp_path / "one_liner.c"
+    file_path.write_text("#include <stdio.h>\n"
+                         "static void one_liner(void) { puts(\"x\"); }\n"
+                         "int main(void) { one_liner(); return 0; }\n")
+
+    starting_line, ending_line, code = afl_loop.get_function_code(str(file_path), "one_liner")
+    assert code == "static void one_liner(void) { puts(\"x\"); }\n"
+
+    afl_loop.replace_function_in_c_file(str(file_path), "one_liner", "static void one_liner(void)\n{\n    puts(\"y\");\n}",
+                                        starting_line, ending_line)
+
+    assert file_path.read_text() == ("#include <stdio.h>\n"
+                                     "static void one_liner(void) {\n    puts(\"y\");\n}\n"
+                                     "int main(void) { one_liner(); return 0; }\n")
+    # the index has been moved, the next function is still found
+    assert afl_loop.get_function_code(str(file_path), "main")[2] == "int main(void) { one_liner(); return 0; }\n"
+
+
+def test_replace_function_with_alternative_signatures(tmp_path):
+    file_path = tmp_path / "alternatives.c"
+    file_path.write_text("#ifdef WIDE\n"
+                         "int parse(long value)\n"
+                         "#else\n"
+                         "int parse(int value)\n"
+                         "#endif\n"
+                         "{\n"
+                         "    return value;\n"
+                         "}\n")
+
+    starting_line, ending_line, _ = afl_loop.get_function_code(str(file_path), "parse")
+    afl_loop.replace_function_in_c_file(str(file_path), "parse", "int parse(int value)\n{\n    return value + 1;\n}",
+                                        starting_line, ending_line)
+
+    # both signatures are kept, only the body is replaced
+    assert file_path.read_text() == ("#ifdef WIDE\n"
+                                     "int parse(long value)\n"
+                                     "#else\n"
+                                     "int parse(int value)\n"
+                                     "#endif\n"
+                                     "{\n"
+                                     "    return value + 1;\n"
+                                     "}\n")
+
+
+def test_function_whose_body_crosses_a_conditional_is_skipped(tmp_path):
+    file_path = tmp_path / "crossing.c"
+    file_path.write_text("#ifdef WIDE\n"
+                         "int parse(long value) {\n"
+                         "#else\n"
+                         "int parse(int value) {\n"
+                         "#endif\n"
+                         "    return value;\n"
+                         "}\n"
+                         "int other(void) { return 0; }\n")
+
+    assert afl_loop.get_function_code(str(file_path), "parse") == (None, None, None)
+    assert afl_loop.get_function_code(str(file_path), "other")[2] == "int other(void) { return 0; }\n"
+
+
+class RecordingBackend:
+    rate_limited = False
+
+    async def create(self, model, max_tokens, temperature, system, messages):
+        return afl_loop.LLMResponse("int parse(char *input)\n{\n    return 0;\n}", 10, 10)
+
+
+def test_transcript_is_replayed_for_another_reproduction_of_the_crash(tmp_path, monkeypatch):
+    # load_config_file writes the default configuration in the working folder
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "target.c").write_text("#include <stdlib.h>\n"
+                                       "#include <string.h>\n"
+                                       "int main(void) { char *buffer = malloc(8); memset(buffer, 'A', 16); free(buffer); return 0; }\n")
+    if subprocess.run(["gcc", "-g", "-fsanitize=address", "-o", str(tmp_path / "target"), str(tmp_path / "target.c")]).returncode != 0:
+        pytest.skip("gcc with AddressSanitizer is not available")
+    (tmp_path / "run.txt").write_text("./target INPUT\n")
+    (tmp_path / "input").write_text("A")
+
+    reports = []
+    for _ in range(2):
+        is_crashing, report = afl_loop.run_program(str(tmp_path), "run.txt", "./input")
+        assert is_crashing
+        reports.append(afl_loop.compact_report(report, str(tmp_path), None, 2000))
+
+    _, _, _, _, config = afl_loop.load_config_file(afl_loop.CONFIG_FILE_PATH)
+    transcript_path = str(tmp_path / "transcript.jsonl")
+    client = afl_loop.LLMClient(config, backend=RecordingBackend(), transcript_path=transcript_path)
+    recorded = client.run(client.create_message("fix", f"{reports[0]}\n{afl_loop.FIX_PROMPT}", 100))
+
+    config["llm_replay_transcript"] = transcript_path
+    client = afl_loop.LLMClient(config, backend=afl_loop.ReplayBackend(config))
+    replayed = client.run(client.create_message("fix", f"{reports[1]}\n{afl_loop.FIX_PROMPT}", 100))
+
+    assert not replayed.error
+    assert replayed.text == recorded.text
+
+
+def test_pending_crash_is_resumed_from_its_copy(tmp_path):
+    crashes_path = tmp_path / "output" / "default" / "crashes"
+    crashes_path.mkdir(parents=True)
+    (crashes_path / "id:000000").write_bytes(b"crash")
+
+    store = afl_loop.StateStore(str(tmp_path / "state.db"), str(tmp_path / "crash_inputs"))
+    store.add_crash("default/crashes/id:000000", str(crashes_path / "id:000000"))
+    # the fuzzer renames its crashes folder when it is restarted
+    crashes_path.rename(tmp_path / "output" / "default" / "crashes.2024-01-01-00:00:00")
+
+    store = afl_loop.StateStore(str(tmp_path / "state.db"), str(tmp_path / "crash_inputs"))
+    assert store.pending_inputs() == ["default/crashes/id:000000"]
+    with open(store.input_path("default/crashes/id:000000"), 'rb') as file:
+        assert file.read() == b"crash"
+
+
+def test_fixed_crashes_are_replayed_from_the_regression_corpus(tmp_path):
+    output_path = tmp_path / "output"
+    (output_path / "main" / "crashes").mkdir(parents=True)
+    (output_path / "main" / "crashes" / "id:000000").write_bytes(b"first")
+    (output_path / "main" / "crashes" / "id:000001").write_bytes(b"duplicate")
+    bucket = {"first_input": "main/crashes/id:000000", "duplicates": ["main/crashes/id:000001"], "status": "fixed"}
+    corpus_path = str(tmp_path / "regression_corpus")
+
+    afl_loop.add_to_regression_corpus(corpus_path, bucket, str(output_path))
+    # the fuzzer clears its crashes folder when it is restarted
+    for item in (output_path / "main" / "crashes").iterdir():
+        item.unlink()
+
+    inputs = afl_loop.get_regression_inputs({"signature": bucket}, str(output_path), ["main"], 10, corpus_path)
+
+    assert sorted(open(item, 'rb').read() for item in inputs) == [b"duplicate", b"first"]
+
+
+def test_pipeline_stop_waits_for_the_crash_being_prepared():
+    queue = afl_loop.CrashQueue({}, {})
+    prepared = threading.Event()
+    finished = []
+
+    def prepare(item, info, stop_event):
+        prepared.set()
+        time.sleep(0.5)
+        finished.append(item)
+        return None if stop_event.is_set() else {"item": item}
+
+    pipeline = afl_loop.RepairPipeline(queue, lambda item: {"signature": None, "severity": 0, "top_frame": None, "found": time.time()}, prepare, 1)
+    pipeline.start()
+    queue.put("id:000000")
+    assert prepared.wait(5)
+
+    pipeline.stop()
+
+    # nothing runs in the stages once stop returns
+    assert finished == ["id:000000"]
+    assert not pipeline.triage_thread.is_alive() and not pipeline.prepare_thread.is_alive()
+
+
+def test_add_rejected_fix_lists_the_rolled_back_functions():
+    functions = [("a.c", "parse", "int parse() { return 0; }"), ("a.c", "check", "int check() { return 0; }")]
+    report = afl_loop.add_rejected_fix("ERROR: AddressSanitizer\n", functions, ["int parse() { return 1; }", "None"],
+                                       "the program still crashes as reported above")
+    assert report.startswith("ERROR: AddressSanitizer\n" + afl_loop.REJECTED_FIX_HEADER)
+    assert "Function parse:\nint parse() { return 1; }" in report
+    assert "Function check" not in report
+    assert report.endswith("It has been rejected because the program still crashes as reported above")
+
+
+def test_hang_is_told_apart_from_a_crash(tmp_path):
+    (tmp_path / "run.txt").write_text("sleep 5 && cat INPUT\n")
+    (tmp_path / "input").write_text("")
+
+    is_crashing, report = afl_loop.run_program(str(tmp_path), "run.txt", "./input", timeout=1)
+
+    assert is_crashing
+    assert afl_loop.is_hang(report)
+    assert not afl_loop.is_hang("ERROR: AddressSanitizer: heap-buffer-overflow\nthe target has been killed by signal SIGABRT\n")
+
+
+def test_cpp_frame_is_found_in_the_function_index(tmp_path):
+    (tmp_path / "parser.cpp").write_text("namespace ns {\n"
+                                         "int Foo::bar(int size, const char *data) {\n"
+                                         "    return data[size];\n"
+                                         "}\n"
+                                         "}\n")
+    (tmp_path / "logs").mkdir()
+    report = ("==1==ERROR: AddressSanitizer: heap-buffer-overflow on address 0x602000000011 at pc 0x1 bp 0x2 sp 0x3\n"
+              "READ of size 1 at 0x602000000011 thread T0\n"
+              f"    #0 0x4f1a2b in ns::Foo::bar(int, char const*) {tmp_path}/parser.cpp:3:12\n"
+              f"    #1 0x4f1c3d in main {tmp_path}/main.cpp:9:5\n"
+              "SUMMARY: AddressSanitizer: heap-buffer-overflow parser.cpp:3:12 in ns::Foo::bar(int, char const*)\n")
+
+    frames, _ = afl_loop.asan_report_parser(report)
+    assert frames[0]["function"] == "ns::Foo::bar(int, char const*)"
+
+    functions = afl_loop.collect_buggy_functions(frames[:1], str(tmp_path), str(tmp_path / "logs"))
+    assert [(name, code) for _, name, code in functions] == \
+           [("ns::Foo::bar", "int Foo::bar(int size, const char *data) {\n    return data[size];\n}\n")]
+
+
+def record_worker_event():
+    afl_loop.METRICS.event("build", 0.5, worker=True)
+    return afl_loop.METRICS.pid
+
+
+def test_worker_events_are_appended_to_the_metrics_file(tmp_path, monkeypatch):
+    for name in ("jsonl_path", "textfile_path", "store", "pid"):
+        monkeypatch.setattr(afl_loop.METRICS, name, getattr(afl_loop.METRICS, name))
+    afl_loop.METRICS.configure(str(tmp_path / "metrics.jsonl"), str(tmp_path / "metrics.prom"))
+
+    with afl_loop.create_process_pool(1) as pool:
+        worker_pid = pool.submit(record_worker_event).result()
+
+    events = [json.loads(line) for line in (tmp_path / "metrics.jsonl").read_text().splitlines()]
+    assert [(event["stage"], event["worker"]) for event in events] == [("build", True)]
+    # only the main process writes the textfile
+    assert worker_pid == os.getpid()
+    assert not (tmp_path / "metrics.prom").exists()
+
+
+def test_batch_fix_prompt_example_is_parsed():
+    example = afl_loop.BATCH_FIX_PROMPT[afl_loop.BATCH_FIX_PROMPT.index('{'):]
+
+    assert afl_loop.parse_llm_batch_fix_response(example, ["function1", "function2"]) == ["int function1(int a)\n{\n    return a;\n}", None]
+    # the same answer with real newlines in the code
+    assert afl_loop.parse_llm_batch_fix_response(example.replace("\\n", "\n"), ["function1"]) == ["int function1(int a)\n{\n    return a;\n}"]
+
+
+def test_crash_in_a_fixed_bucket_reopens_it():
+    crash_index = {}
+    assert afl_loop.add_crash_to_index(crash_index, "abc", "heap-buffer-overflow", ["parse"], "id:000000")
+    assert not afl_loop.add_crash_to_index(crash_index, "abc", "heap-buffer-overflow", ["parse"], "id:000001")
+    crash_index["abc"]["status"] = "fixed"
+
+    assert afl_loop.add_crash_to_index(crash_index, "abc", "heap-buffer-overflow", ["parse"], "id:000002")
+    bucket = crash_index["abc"]
+    assert (bucket["status"], bucket["first_input"], bucket["count"]) == ("pending", "id:000002", 3)
+    assert sorted(bucket["duplicates"]) == ["id:000000", "id:000001"]
+    # the interrupted repair of the reopened bucket is resumed
+    assert afl_loop.add_crash_to_index(crash_index, "abc", "heap-buffer-overflow", ["parse"], "id:000002")
+
+
+def test_fuzzer_launch_waits_for_the_pids_of_every_instance(tmp_path, monkeypatch):
+    monkeypatch.setattr(afl_loop, "tmp_path", str(tmp_path), raising=False)
+    (tmp_path / "logs").mkdir()
+    (tmp_path / "process.pid").write_text("")
+    started, done = threading.Event(), threading.Event()
+
+    def shell():
+        started.set()
+        for pid in (101, 102):
+            time.sleep(0.3)
+            with open(tmp_path / "process.pid", 'a') as file:
+                file.write(f"{pid}\n")
+        done.wait()
+
+    thread = threading.Thread(target=shell)
+    thread.start()
+    try:
+        assert afl_loop.check_fuzzer_launch(started, thread, str(tmp_path / "logs"), 2) == [101, 102]
+    finally:
+        done.set()
+        thread.join()
+
+
+def test_fuzzer_launch_fails_if_an_instance_is_missing(tmp_path, monkeypatch):
+    monkeypatch.setattr(afl_loop, "tmp_path", str(tmp_path / "tmp"), raising=False)
+    (tmp_path / "tmp").mkdir()
+    (tmp_path / "logs").mkdir()
+    (tmp_path / "tmp" / "process.pid").write_text("101\n")
+    stopped = []
+    monkeypatch.setattr(afl_loop, "stop_fuzzers", stopped.extend)
+    started, done = threading.Event(), threading.Event()
+    started.set()
+    thread = threading.Thread(target=done.wait)
+    thread.start()
+    threading.Timer(1, done.set).start()
+
+    with pytest.raises(SystemExit):
+        afl_loop.check_fuzzer_launch(started, thread, str(tmp_path / "logs"), 2, timeout=0.5)
+    assert stopped == [101]
+
+
+def test_inputs_of_the_bucket_being_repaired_must_not_crash(tmp_path, monkeypatch):
+    # load_config_file writes the default configuration in the working folder
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "target.c").write_text("#include <stdio.h>\n"
+                                       "#include <stdlib.h>\n"
+                                       "int main(int argc, char **argv) { char *buffer = malloc(8); FILE *file = fopen(argv[1], \"r\");\n"
+                                       "    if (fgetc(file) == 'A') buffer[8] = 0; free(buffer); return 0; }\n")
+    if subprocess.run(["gcc", "-g", "-fsanitize=address", "-o", str(tmp_path / "target"), str(tmp_path / "target.c")]).returncode != 0:
+        pytest.skip("gcc with AddressSanitizer is not available")
+    (tmp_path / "run.txt").write_text("./target INPUT\n")
+    crashes_path = tmp_path / "output" / "default" / "crashes"
+    crashes_path.mkdir(parents=True)
+    (crashes_path / "id:000000").write_text("A")
+    (crashes_path / "id:000001").write_text("AA")
+    (tmp_path / "logs").mkdir()
+
+    _, _, _, _, config = afl_loop.load_config_file(afl_loop.CONFIG_FILE_PATH)
+    _, signature, _ = afl_loop.replay_input(str(tmp_path), "run.txt", "output/default/crashes/id:000001", config["crash_signature_frames"],
+                                            afl_loop.get_run_options(config))
+    crash_index = {signature: {"first_input": "id:000000", "duplicates": ["id:000001"], "status": "pending"}}
+    check = lambda repaired_signature: afl_loop.check_regressions(str(tmp_path), "run.txt", str(tmp_path / "output"), ["default"], crash_index,
+                                                                  config, str(tmp_path / "logs"), None, repaired_signature)
+
+    # the crashes of another pending bucket are expected, the ones of the bucket being repaired are not
+    assert check(None) is None
+    assert check(signature).startswith("The fix stops the original crash but not the same crash with other inputs")
+
+
+def test_llm_cache_key_depends_on_the_request_settings(tmp_path, monkeypatch):
+    # load_config_file writes the default configuration in the working folder
+    monkeypatch.chdir(tmp_path)
+    _, _, _, _, config = afl_loop.load_config_file(afl_loop.CONFIG_FILE_PATH)
+    cache = afl_loop.LLMCache(str(tmp_path / "llm_cache"), 1024 * 1024)
+
+    def key(temperature=None, **settings):
+        client = afl_loop.LLMClient(dict(config, **settings), cache=cache, backend=RecordingBackend())
+        return cache.key(client.get_cache_settings(temperature), afl_loop.FIX_PROMPT, "report", "int f() {}")
+
+    assert key() == key()
+    assert key() != key(llm_system_prompt="Respond only in plain English.")
+    assert key() != key(0.8)
+    assert key() != key(llm_model="another-model")
+    assert key(llm_backend="openai") != key(llm_backend="openai", llm_base_url="http://localhost:9000/v1")
+
+
+class PipeInotify:
+    """
+    This class stands for the inotify functions of libc, the events are written by the test to a pipe.
+    """
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+
+    def inotify_init1(self, flags):
+        return self.read_fd
+
+    def inotify_add_watch(self, fd, path, mask):
+        return 1
+
+    def inotify_rm_watch(self, fd, wd):
+        return 0
+
+
+def test_inotify_overflow_lists_the_crashes_folder(tmp_path):
+    libc = PipeInotify()
+    crashes = queue.Queue()
+    stop_event = threading.Event()
+    thread = threading.Thread(target=afl_loop.monitor_folder_inotify, args=(libc, str(tmp_path), crashes, stop_event))
+    thread.start()
+    try:
+        time.sleep(0.5)
+        # the event of the new file has been lost, only the overflow is reported
+        (tmp_path / "id:000000").write_bytes(b"crash")
+        os.write(libc.write_fd, struct.pack("iIII", -1, afl_loop.IN_Q_OVERFLOW, 0, 0))
+
+        assert crashes.get(timeout=5) == "id:000000"
+    finally:
+        stop_event.set()
+        thread.join()
+        os.close(libc.write_fd)
+
+
+def test_rate_limiter_waits_for_the_buckets_to_refill():
+    limiter = afl_loop.RateLimiter(2, 1000)
+
+    assert limiter.try_acquire(400) == 0
+    assert limiter.try_acquire(400) == 0
+    # no request is left: one comes back every 30 seconds
+    assert limiter.try_acquire(100) == pytest.approx(30, abs=0.1)
+
+    limiter = afl_loop.RateLimiter(60, 1000)
+    assert limiter.try_acquire(800) == 0
+    assert limiter.try_acquire(800) == pytest.approx(36, abs=0.1)
+    # a request bigger than the bucket waits for the bucket to be full
+    assert limiter.try_acquire(5000) == pytest.approx(48, abs=0.1)
+
+
+def test_source_index_finds_the_file_with_the_longest_common_suffix(tmp_path):
+    for folder in ("src/a", "src/b", "output/default/crashes"):
+        (tmp_path / folder).mkdir(parents=True)
+    (tmp_path / "src" / "a" / "util.c").write_text("")
+    (tmp_path / "src" / "b" / "util.c").write_text("")
+    (tmp_path / "output" / "default" / "crashes" / "util.c").write_text("")
+    search_path = str(tmp_path)
+    index_path = str(tmp_path / "source_index.json")
+
+    source_index = afl_loop.load_source_index(index_path, search_path, ["output"])
+    assert afl_loop.find_file(f"{search_path}/src/b/util.c", search_path, source_index) == f"{search_path}/src/b/util.c"
+    assert afl_loop.find_file(f"{search_path}/output/default/crashes/util.c", search_path, source_index) != f"{search_path}/output/default/crashes/util.c"
+
+    # a file added after the index has been built is found by refreshing the index
+    (tmp_path / "src" / "c").mkdir()
+    (tmp_path / "src" / "c" / "parser.c").write_text("")
+    assert afl_loop.find_file(f"{search_path}/src/c/parser.c", search_path, source_index) == f"{search_path}/src/c/parser.c"
+    # the index is saved and loaded again
+    assert afl_loop.load_source_index(index_path, search_path, ["output"])["basenames"]["util.c"]
+
+
+def test_crash_input_is_minimized_preserving_its_signature(tmp_path, monkeypatch):
+    # load_config_file writes the default configuration in the working folder
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "target.c").write_text("#include <stdlib.h>\n"
+                                       "#include <string.h>\n"
+                                       "#include <stdio.h>\n"
+                                       "int main(int argc, char **argv) { char data[64] = {0}; FILE *file = fopen(argv[1], \"r\");\n"
+                                       "    fread(data, 1, 63, file); char *buffer = malloc(8); if (strstr(data, \"BUG\")) buffer[8] = 0; free(buffer); return 0; }\n")
+    if subprocess.run(["gcc", "-g", "-fsanitize=address", "-o", str(tmp_path / "target"), str(tmp_path / "target.c")]).returncode != 0:
+        pytest.skip("gcc with AddressSanitizer is not available")
+    (tmp_path / "run.txt").write_text("./target INPUT\n")
+    (tmp_path / "input").write_text("some text before the BUG and some after it")
+
+    _, _, _, _, config = afl_loop.load_config_file(afl_loop.CONFIG_FILE_PATH)
+    config["minimizer"] = "ddmin"
+    _, signature, _ = afl_loop.replay_input(str(tmp_path), "run.txt", "./input", config["crash_signature_frames"], afl_loop.get_run_options(config))
+    minimized_input = afl_loop.minimize_crash_input(str(tmp_path), "run.txt", "./input", signature, config, str(tmp_path / "minimized_inputs"))
+
+    assert (tmp_path / minimized_input).read_text() == "BUG"
+    # the result is cached by the hash of the original input
+    assert afl_loop.minimize_crash_input(str(tmp_path), "run.txt", "./input", signature, config, str(tmp_path / "minimized_inputs")) == minimized_input
+
+
+def test_metrics_are_written_as_jsonl_and_prometheus_textfile(tmp_path):
+    metrics = afl_loop.Metrics()
+    metrics.configure(str(tmp_path / "metrics.jsonl"), str(tmp_path / "metrics.prom"))
+
+    with metrics.timer("llm_request", input_tokens=100) as fields:
+        fields["fixed"] = True
+    metrics.event("build", 2.0)
+
+    events = [json.loads(line) for line in (tmp_path / "metrics.jsonl").read_text().splitlines()]
+    assert [(event["stage"], event.get("input_tokens"), event.get("fixed")) for event in events] == [("llm_request", 100, True), ("build", None, None)]
+    textfile = (tmp_path / "metrics.prom").read_text()
+    assert 'afl_loop_input_tokens_total{stage="llm_request"} 100' in textfile
+    assert 'afl_loop_fixed_total{stage="llm_request",value="true"} 1' in textfile
+    assert 'afl_loop_stage_duration_seconds_bucket{stage="build",le="1"} 0' in textfile
+    assert 'afl_loop_stage_duration_seconds_bucket{stage="build",le="5"} 1' in textfile
+
+
+def test_metrics_are_discarded_until_configured(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    metrics = afl_loop.Metrics()
+    metrics.event("build", 2.0)
+
+    assert metrics.counters == {}
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_report_is_compacted_with_the_source_of_the_faulting_line(tmp_path):
+    (tmp_path / "parser.c").write_text("int parse(char *data) {\n"
+                                       "    char buffer[8];\n"
+                                       "    int i = 0;\n"
+                                       "    buffer[8] = data[0];\n"
+                                       "    return i;\n"
+                                       "}\n")
+    report = ("some output of the target\n"
+              "some output of the target\n"
+              "=================================================================\n"
+              "==4242==ERROR: AddressSanitizer: stack-buffer-overflow on address 0x7ffd1234 at pc 0x4f1a2b bp 0x7ffd sp 0x7ffc\n"
+              "WRITE of size 1 at 0x7ffd1234 thread T0\n"
+              "    #0 0x4f1a2b in __asan_memcpy /src/llvm/compiler-rt/lib/asan/asan_interceptors.cpp:22\n"
+              f"    #1 0x4f1a2c in parse {tmp_path}/parser.c:4:15\n"
+              "    #2 0x7f12 in __libc_start_main (/lib/x86_64-linux-gnu/libc.so.6+0x21b96)\n"
+              "\n"
+              "HINT: this may be a false positive\n"
+              f"SUMMARY: AddressSanitizer: stack-buffer-overflow {tmp_path}/parser.c:4:15 in parse\n"
+              "Shadow bytes around the buggy address:\n"
+              "  0x10007fff: 00 00 00 00\n"
+              "==4242==ABORTING\n")
+
+    compacted = afl_loop.compact_report(report, str(tmp_path), None, 2000)
+
+    assert compacted.count("some output of the target") == 1
+    assert "    #1 parse parser.c:4" in compacted
+    assert ">     4 |     buffer[8] = data[0];" in compacted
+    for dropped in ("__asan_memcpy", "__libc_start_main", "HINT", "Shadow bytes", "0x4f1a2c", "==4242=="):
+        assert dropped not in compacted
+    # the output of the target and the source lines are the first to go over the budget
+    compacted = afl_loop.compact_report(report, str(tmp_path), None, 60)
+    assert "some output of the target" not in compacted
+    assert "buffer[8] = data[0]" not in compacted
+    assert "stack-buffer-overflow" in compacted
+
+
+def test_new_crashes_come_first_then_the_best_scored_one():
+    crash_index = {
+        "write": {"count": 1, "frames": ["parse"]},
+        "read": {"count": 1, "frames": ["parse"]},
+        "leak": {"count": 1, "frames": ["load"]}
+    }
+    crashes = afl_loop.CrashQueue(crash_index, {"severity": 1.0})
+    now = time.time()
+    crashes.put_triaged("id:000000", {"signature": "read", "severity": 0.5, "top_frame": "parse", "found": now})
+    crashes.put_triaged("id:000001", {"signature": "write", "severity": 0.9, "top_frame": "parse", "found": now})
+    crashes.put("id:000002")
+
+    assert crashes.get(timeout=1) == ("id:000002", None)
+    assert crashes.get(timeout=1)[0] == "id:000001"
+    assert crashes.get(timeout=1)[0] == "id:000000"
+    with pytest.raises(queue.Empty):
+        crashes.get(timeout=0.1)
+
+
+def test_crash_score_follows_the_duplicates_and_the_shared_top_frames():
+    crash_index = {
+        "frequent": {"count": 20, "frames": ["parse"]},
+        "rare": {"count": 1, "frames": ["load"]},
+        "other": {"count": 1, "frames": ["parse"]}
+    }
+    now = time.time()
+    frequent = {"signature": "frequent", "severity": 0.5, "top_frame": "parse", "found": now}
+    rare = {"signature": "rare", "severity": 0.5, "top_frame": "load", "found": now}
+
+    crashes = afl_loop.CrashQueue(crash_index, {"frequency": 1.0})
+    crashes.put_triaged("id:000000", rare)
+    crashes.put_triaged("id:000001", frequent)
+    assert crashes.get(timeout=1)[0] == "id:000001"
+
+    # the top frame of the frequent crash is shared with another bucket, the rare one is more novel
+    crashes = afl_loop.CrashQueue(crash_index, {"novelty": 1.0})
+    crashes.put_triaged("id:000000", frequent)
+    crashes.put_triaged("id:000001", rare)
+    assert crashes.get(timeout=1)[0] == "id:000001"
+
+
+def test_write_is_more_severe_than_read_and_null_dereference():
+    write = "==1==ERROR: AddressSanitizer: heap-buffer-overflow on address 0x602000000018 at pc 0x1 bp 0x2 sp 0x3\nWRITE of size 1 at 0x602000000018 thread T0\n"
+    read = write.replace("WRITE", "READ")
+    null = "==1==ERROR: AddressSanitizer: SEGV on unknown address 0x000000000000 (pc 0x1 bp 0x2 sp 0x3 T0)\n"
+
+    assert afl_loop.get_crash_severity(write) > afl_loop.get_crash_severity(read) > afl_loop.get_crash_severity(null)
+
+
+def test_patch_is_checked_with_the_flags_of_its_file_in_the_repair_tree(tmp_path):
+    target_path = tmp_path / "target"
+    (target_path / "src").mkdir(parents=True)
+    (target_path / "include").mkdir()
+    (target_path / "include" / "config.h").write_text("#define SIZE 8\n")
+    (target_path / "src" / "parser.c").write_text("#include \"config.h\"\nint parse(void) {\n    return SIZE;\n}\n")
+    (target_path / "compile_commands.json").write_text(json.dumps([{
+        "directory": f"{target_path}/src",
+        "command": "gcc -I../include -O2 -c parser.c -o parser.o -MD -MF parser.d",
+        "file": "parser.c"
+    }]))
+    compilation_database = afl_loop.load_compilation_database(str(target_path), [str(target_path / "compile_commands.json")])
+    assert list(compilation_database) == ["src/parser.c"]
+
+    repair_path = tmp_path / "repair"
+    shutil.copytree(target_path, repair_path)
+    patched_file = repair_path / "src" / "parser.c"
+    assert afl_loop.check_syntax(compilation_database, {str(patched_file)}, str(repair_path)) is None
+
+    patched_file.write_text("#include \"config.h\"\nint parse(void) {\n    return SIZE\n}\n")
+    diagnostics = afl_loop.check_syntax(compilation_database, {str(patched_file)}, str(repair_path))
+    assert "src/parser.c:4:1: error" in diagnostics and str(repair_path) not in diagnostics
+    # nothing is written next to the sources
+    assert sorted(item.name for item in (repair_path / "src").iterdir()) == ["parser.c"]
+
+
+def test_stale_repair_snapshot_is_synced_with_the_target_tree(tmp_path):
+    target_path = tmp_path / "target"
+    (target_path / "src").mkdir(parents=True)
+    (target_path / "output").mkdir()
+    (target_path / "src" / "parser.c").write_text("int parse(void) { return 0; }\n")
+    (target_path / "output" / "fuzzer_stats").write_text("")
+    repair_path = tmp_path / "repair"
+
+    afl_loop.create_worktree(str(target_path), str(repair_path), ["output"])
+    assert (repair_path / "src" / "parser.c").read_text() == "int parse(void) { return 0; }\n"
+    assert not (repair_path / "output").exists()
+
+    # a try interrupted after its patch has been applied to the snapshot
+    (repair_path / "src" / "parser.c").write_text("int parse(void) { return 1; }\n")
+    afl_loop.sync_tree(str(target_path), str(repair_path), ["output"])
+
+    assert (repair_path / "src" / "parser.c").read_text() == "int parse(void) { return 0; }\n"
+    assert os.stat(repair_path / "src" / "parser.c").st_mtime_ns == os.stat(target_path / "src" / "parser.c").st_mtime_ns
+
+
+def test_single_fuzz_command_is_split_in_main_and_secondary_instances(tmp_path):
+    (tmp_path / "fuzz.txt").write_text("afl-fuzz -i input -o output -- ./target @@\n")
+
+    assert afl_loop.get_fuzzer_commands(str(tmp_path), "fuzz.txt", 1) == [("default", "afl-fuzz -i input -o output -- ./target @@")]
+    assert afl_loop.get_fuzzer_commands(str(tmp_path), "fuzz.txt", 3) == [
+        ("main", "afl-fuzz -i input -o output -M main -- ./target @@"),
+        ("secondary_1", "afl-fuzz -i input -o output -S secondary_1 -- ./target @@"),
+        ("secondary_2", "afl-fuzz -i input -o output -S secondary_2 -- ./target @@")
+    ]
+
+    # the commands written by hand are kept as they are
+    (tmp_path / "fuzz.txt").write_text("afl-fuzz -i input -o output -M fast -- ./target @@\nafl-fuzz -i input -o output -S slow -- ./target @@\n")
+    assert [name for name, _ in afl_loop.get_fuzzer_commands(str(tmp_path), "fuzz.txt", 4)] == ["fast", "slow"]
+
+
+def test_crashes_of_every_instance_are_merged_in_the_queue(tmp_path):
+    for name in ("main", "secondary_1"):
+        (tmp_path / name / "crashes").mkdir(parents=True)
+    crashes = queue.Queue()
+    stop_event = threading.Event()
+    thread = threading.Thread(target=afl_loop.monitor_instances, args=(str(tmp_path), ["main", "secondary_1"], crashes, stop_event, "polling"))
+    thread.start()
+    try:
+        time.sleep(0.5)
+        (tmp_path / "main" / "crashes" / "id:000000").write_bytes(b"a")
+        (tmp_path / "secondary_1" / "crashes" / "id:000000").write_bytes(b"b")
+
+        assert sorted([crashes.get(timeout=5), crashes.get(timeout=5)]) == ["main/crashes/id:000000", "secondary_1/crashes/id:000000"]
+    finally:
+        stop_event.set()
+        thread.join()
+
+
+def test_failed_try_is_rolled_back_and_the_accepted_fix_exported(tmp_path):
+    (tmp_path / "src").mkdir()
+    file_path = str(tmp_path / "src" / "parser.c")
+    (tmp_path / "src" / "parser.c").write_text("int parse(int size) {\n    return size;\n}\n")
+    snapshot = {}
+    afl_loop.snapshot_files(snapshot, [file_path])
+
+    starting_line, ending_line, _ = afl_loop.get_function_code(file_path, "parse")
+    afl_loop.replace_function_in_c_file(file_path, "parse", "int parse(int size) {\n    return size + 1;\n}", starting_line, ending_line)
+    assert afl_loop.restore_files(snapshot) == {file_path}
+    assert afl_loop.restore_files(snapshot) == set()
+    # the function index follows the restored file
+    assert afl_loop.get_function_code(file_path, "parse")[2] == "int parse(int size) {\n    return size;\n}\n"
+
+    starting_line, ending_line, _ = afl_loop.get_function_code(file_path, "parse")
+    afl_loop.replace_function_in_c_file(file_path, "parse", "int parse(int size) {\n    return size > 0 ? size : 0;\n}", starting_line, ending_line)
+    diff = afl_loop.export_fix_diff(snapshot, str(tmp_path), str(tmp_path / "fixes" / "id_000000.diff"))
+    assert "--- a/src/parser.c" in diff and "-    return size;" in diff and "+    return size > 0 ? size : 0;" in diff
+    assert (tmp_path / "fixes" / "id_000000.diff").read_text() == diff
+
+
+def test_parser_collects_the_crash_free_and_allocation_stacks():
+    report = ("==7==ERROR: AddressSanitizer: heap-use-after-free on address 0x602000000010 at pc 0x1 bp 0x2 sp 0x3\n"
+              "READ of size 4 at 0x602000000010 thread T0\n"
+              "    #0 0x4f1a2b in parse /src/parser.c:12:5\n"
+              "    #1 0x4f1c3d in main /src/main.c:9:5\n"
+              "\n"
+              "0x602000000010 is located 0 bytes inside of 4-byte region [0x602000000010,0x602000000014)\n"
+              "freed by thread T0 here:\n"
+              "    #0 0x49d0ad in free (/src/target+0x49d0ad)\n"
+              "    #1 0x4f1b00 in release /src/parser.c:30:3\n"
+              "\n"
+              "previously allocated by thread T0 here:\n"
+              "    #0 0x49d32d in malloc (/src/target+0x49d32d)\n"
+              "    #1 0x4f1a00 in create /src/parser.c:20:10\n"
+              "\n"
+              "SUMMARY: AddressSanitizer: heap-use-after-free /src/parser.c:12:5 in parse\n")
+
+    # the report is fed in chunks that split the lines, as it is read from stderr
+    parser = afl_loop.SanitizerReportParser()
+    encoded = report.encode()
+    for start in range(0, len(encoded), 7):
+        parser.feed(encoded[start:start + 7])
+        if b"SUMMARY" not in encoded[:start + 7]:
+            assert not parser.finished.is_set()
+    assert parser.finished.is_set()
+
+    assert (parser.sanitizer, parser.bug_type, parser.access, parser.address) == ("AddressSanitizer", "heap-use-after-free", "READ", 0x602000000010)
+    assert [frame["function"] for frame in parser.get_frames()] == ["parse", "main"]
+    assert [frame["function"] for frame in parser.get_frames("free")] == ["release"]
+    assert [frame["function"] for frame in parser.get_frames("allocation")] == ["create"]
+
+
+def test_parser_classifies_ubsan_and_leaks():
+    parser = afl_loop.parse_sanitizer_report("/src/math.c:7:14: runtime error: signed integer overflow: 2147483647 + 1 cannot be represented in type 'int'\n"
+                                             "    #0 0x4f1a2b in add /src/math.c:7:14\n"
+                                             "SUMMARY: UndefinedBehaviorSanitizer: undefined-behavior /src/math.c:7:14\n")
+    assert (parser.sanitizer, parser.bug_type) == ("UndefinedBehaviorSanitizer", "signed-integer-overflow")
+    assert [frame["function"] for frame in parser.get_frames()] == ["add"]
+
+    parser = afl_loop.parse_sanitizer_report("==9==ERROR: LeakSanitizer: detected memory leaks\n"
+                                             "\n"
+                                             "Direct leak of 16 byte(s) in 1 object(s) allocated from:\n"
+                                             "    #0 0x49d32d in malloc (/src/target+0x49d32d)\n"
+                                             "    #1 0x4f1a00 in load /src/loader.c:40:10\n"
+                                             "\n"
+                                             "SUMMARY: AddressSanitizer: 16 byte(s) leaked in 1 allocation(s).\n")
+    assert (parser.sanitizer, parser.bug_type) == ("LeakSanitizer", "memory-leak")
+    assert [frame["function"] for frame in parser.get_frames()] == ["load"]
+
+
+def test_target_is_stopped_after_the_sanitizer_summary(tmp_path):
+    (tmp_path / "run.txt").write_text("cat INPUT >&2 && sleep 10\n")
+    (tmp_path / "input").write_text("==1==ERROR: AddressSanitizer: heap-buffer-overflow on address 0x602000000018 at pc 0x1 bp 0x2 sp 0x3\n"
+                                    "SUMMARY: AddressSanitizer: heap-buffer-overflow /src/parser.c:3 in parse\n")
+
+    start = time.monotonic()
+    is_crashing, report = afl_loop.run_program(str(tmp_path), "run.txt", "./input", timeout=20, summary_grace=0.5)
+
+    assert time.monotonic() - start < 5
+    assert is_crashing and "SUMMARY: AddressSanitizer" in report
+    assert not afl_loop.is_hang(report)
+
+
+def test_run_command_is_executed_without_a_shell_when_possible():
+    assert afl_loop.parse_run_command("ASAN_OPTIONS=detect_leaks=0 ./harness 'input file'") == (["./harness", "input file"], {"ASAN_OPTIONS": "detect_leaks=0"})
+    assert afl_loop.parse_run_command("./harness input | tee log") == (None, {})
+    assert afl_loop.parse_run_command("./harness $INPUT") == (None, {})
+
+
+def test_output_keeps_its_beginning_and_its_end():
+    output = afl_loop.BoundedOutput(100)
+    for i in range(100):
+        output.write(f"{i:03d}\n".encode())
+
+    value = output.getvalue()
+    assert value.startswith(b"000\n001\n")
+    assert value.endswith(b"098\n099\n")
+    assert output.dropped == 300
+
+
+def test_input_is_fed_to_the_standard_input(tmp_path):
+    (tmp_path / "run.txt").write_text("sh -c 'grep -q BUG || kill -SEGV $$' INPUT_STDIN\n")
+    (tmp_path / "crash").write_text("no bug here")
+    (tmp_path / "no_crash").write_text("BUG")
+
+    is_crashing, report = afl_loop.run_program(str(tmp_path), "run.txt", "./crash")
+    assert is_crashing and "killed by signal SIGSEGV" in report
+    assert afl_loop.run_program(str(tmp_path), "run.txt", "./no_crash") == (False, '')
+
+
+def test_state_store_records_the_handled_crashes_and_the_attempts(tmp_path):
+    store = afl_loop.StateStore(str(tmp_path / "state.db"), str(tmp_path / "crash_inputs"))
+    store.add_crash("id:000000")
+    store.add_crash("id:000001")
+    store.update_crash("id:000000", "duplicate", signature="abc", bug_type="heap-buffer-overflow")
+    store.save_bucket("abc", {"bug_type": "heap-buffer-overflow", "frames": ["parse"], "first_input": "id:000001", "count": 2,
+                              "status": "fixed", "first_seen": time.ctime()})
+    attempt_id = store.add_attempt("id:000001", "abc", 0)
+    store.add_patch(attempt_id, "src/parser.c", "parse", "int parse(void) { return 0; }")
+    store.finish_attempt(attempt_id, "fixed")
+    store.update_crash("id:000001", "fixed", signature="abc")
+
+    # the state survives a restart
+    store = afl_loop.StateStore(str(tmp_path / "state.db"), str(tmp_path / "crash_inputs"))
+    assert store.pending_inputs() == []
+    assert store.handled_inputs() == {"id:000000", "id:000001"}
+    assert store.execute("SELECT status, count FROM buckets WHERE signature = 'abc'") == [("fixed", 2)]
+    assert store.execute("SELECT try, outcome FROM attempts") == [(0, "fixed")]
+    assert store.execute("SELECT file, function FROM patches WHERE attempt = ?", (attempt_id,)) == [("src/parser.c", "parse")]
+
+
+def test_reverted_source_gets_its_objects_from_the_cache(tmp_path, monkeypatch, capsys):
+    if shutil.which("make") is None or shutil.which("gcc") is None:
+        pytest.skip("make and gcc are needed")
+    # the build commands are run in the target tree, relative to the working folder
+    monkeypatch.chdir(tmp_path)
+    target_path = tmp_path / "target"
+    target_path.mkdir()
+    (target_path / "Makefile").write_text("target: main.o parser.o\n\tgcc -o target main.o parser.o\n"
+                                          "%.o: %.c\n\tgcc -c $< -o $@\n")
+    (target_path / "main.c").write_text("int parse(void);\nint main(void) { return parse(); }\n")
+    (target_path / "parser.c").write_text("int parse(void) { return 1; }\n")
+    (target_path / "build.txt").write_text("./configure && make clean && make\n")
+    subprocess.run(["make"], cwd=target_path, check=True, stdout=subprocess.DEVNULL)
+    afl_loop.store_objects_in_cache("target/parser.c", "target", "object_cache")
+
+    (target_path / "parser.c").write_text("int parse(void) { return 0; }\n")
+    afl_loop.rebuild_program("target", "build.txt", "rebuild.txt", ["target/parser.c"], "object_cache")
+    assert subprocess.run([str(target_path / "target")]).returncode == 0
+
+    capsys.readouterr()
+    (target_path / "parser.c").write_text("int parse(void) { return 1; }\n")
+    afl_loop.rebuild_program("target", "build.txt", "rebuild.txt", ["target/parser.c"], "object_cache")
+    assert "objects restored from cache" in capsys.readouterr().out
+    assert subprocess.run([str(target_path / "target")]).returncode == 1
+
+
+def test_crash_signature_ignores_the_lines_and_the_addresses():
+    report = ("==1==ERROR: AddressSanitizer: heap-buffer-overflow on address 0x602000000018 at pc 0x1 bp 0x2 sp 0x3\n"
+              "WRITE of size 1 at 0x602000000018 thread T0\n"
+              "    #0 0x4f1a2b in parse /src/parser.c:12:5\n"
+              "    #1 0x4f1c3d in load /src/loader.c:30:3\n"
+              "    #2 0x4f1d4e in main /src/main.c:9:5\n"
+              "SUMMARY: AddressSanitizer: heap-buffer-overflow /src/parser.c:12:5 in parse\n")
+    moved = report.replace("parser.c:12:5", "parser.c:14:9").replace("0x602000000018", "0x603000000028")
+
+    signature, bug_type, frames = afl_loop.compute_crash_signature(report, afl_loop.asan_report_parser(report)[0], 2)
+    assert (bug_type, frames) == ("heap-buffer-overflow", ["parse@parser.c", "load@loader.c"])
+    assert afl_loop.compute_crash_signature(moved, afl_loop.asan_report_parser(moved)[0], 2)[0] == signature
+
+    # another bug type or another top frame is another bucket
+    other_bug = report.replace("heap-buffer-overflow", "heap-use-after-free")
+    assert afl_loop.compute_crash_signature(other_bug, afl_loop.asan_report_parser(other_bug)[0], 2)[0] != signature
+    assert afl_loop.compute_crash_signature("no report", [], 2) == (None, None, None)
+
+
+def test_crash_index_is_saved_and_loaded(tmp_path):
+    crash_index = {}
+    afl_loop.add_crash_to_index(crash_index, "abc", "heap-buffer-overflow", ["parse@parser.c"], "id:000000")
+    afl_loop.save_crash_index(crash_index, str(tmp_path / "crash_index.json"))
+
+    assert afl_loop.load_crash_index(str(tmp_path / "crash_index.json")) == crash_index
+    assert afl_loop.load_crash_index(str(tmp_path / "missing.json")) == {}
+
+
+class BatchBackend:
+    rate_limited = False
+
+    def __init__(self):
+        self.requests = []
+
+    async def create(self, model, max_tokens, temperature, system, messages):
+        self.requests.append(messages[-1]["content"])
+        return afl_loop.LLMResponse('```json\n{"patches": [{"function": "parse", "code": "int parse(void)\\n{\\n    return 0;\\n}"},\n'
+                                    '             {"function": "load", "code": "int load(void)\n{\n    return 1;\n}"}]}\n```', 10, 10)
+
+
+def test_functions_of_a_crash_are_fixed_in_one_request(tmp_path, monkeypatch):
+    # load_config_file writes the default configuration in the working folder
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "logs").mkdir()
+    _, _, _, _, config = afl_loop.load_config_file(afl_loop.CONFIG_FILE_PATH)
+    backend = BatchBackend()
+    client = afl_loop.LLMClient(config, cache=afl_loop.LLMCache(str(tmp_path / "llm_cache"), 1024 * 1024), backend=backend)
+    functions = [("parser.c", "parse", "int parse(void) { return 1; }"), ("loader.c", "load", "int load(void) { return 0; }")]
+
+    fixes = client.run(afl_loop.request_fixes_async(client, "report", functions, str(tmp_path / "logs"), True))
+
+    assert fixes == ["int parse(void)\n{\n    return 0;\n}", "int load(void)\n{\n    return 1;\n}"]
+    assert len(backend.requests) == 1
+    # the same request is served by the cache
+    assert client.run(afl_loop.request_fixes_async(client, "report", functions, str(tmp_path / "logs"), True)) == fixes
+    assert len(backend.requests) == 1
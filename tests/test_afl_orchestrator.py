@@ -0,0 +1,48 @@
+import json
+import pytest
+import afl_loop
+import afl_orchestrator
+
+
+def test_manifest_targets_get_the_defaults_and_unique_names(tmp_path):
+    manifest_path = tmp_path / "manifest.json"
+    manifest_path.write_text(json.dumps({"max_builds": 2, "targets": [{"path": "targets/libxml2", "cores": 2}, {"path": "libpng/"}]}))
+
+    max_builds, targets = afl_orchestrator.load_manifest(str(manifest_path))
+
+    assert max_builds == 2
+    assert [(target["name"], target["build"], target["cores"]) for target in targets] == [("libxml2", "build.txt", 2), ("libpng", "build.txt", 1)]
+
+    manifest_path.write_text(json.dumps({"targets": [{"path": "a/libpng"}, {"path": "b/libpng"}]}))
+    with pytest.raises(ValueError):
+        afl_orchestrator.load_manifest(str(manifest_path))
+
+
+def test_fuzzers_are_pinned_to_different_cores(monkeypatch):
+    monkeypatch.setattr(afl_orchestrator.os, "sched_getaffinity", lambda pid: {0, 1, 2, 3})
+    targets = [{"cores": 2}, {"cores": 1}]
+
+    afl_orchestrator.assign_cores(targets)
+
+    assert [target["fuzzer_cores"] for target in targets] == [[0, 1], [2]]
+    with pytest.raises(ValueError):
+        afl_orchestrator.assign_cores([{"cores": 3}, {"cores": 2}])
+
+
+def test_targets_share_the_rate_limiter_and_the_build_slots_of_the_coordinator():
+    config = {"llm_requests_per_minute": 2, "llm_tokens_per_minute": 1000}
+    manager, address = afl_orchestrator.start_coordinator(config, 1, b"secret")
+
+    first_limiter, first_slots = afl_loop.connect_to_coordinator(address, "secret")
+    second_limiter, second_slots = afl_loop.connect_to_coordinator(address, "secret")
+
+    assert first_limiter.try_acquire(100) == 0
+    assert second_limiter.try_acquire(100) == 0
+    # the two requests of the minute have been taken by the two targets
+    assert first_limiter.try_acquire(100) > 0
+
+    assert first_slots.acquire(timeout=1)
+    assert not second_slots.acquire(timeout=0.1)
+    first_slots.release()
+    assert second_slots.acquire(timeout=1)
+    second_slots.release()
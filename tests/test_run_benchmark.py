@@ -0,0 +1,30 @@
+from benchmark import run_benchmark
+
+
+def test_events_are_summarized_from_the_first_crash():
+    events = [
+        {"time": 10.0, "stage": "build", "duration": 5.0},
+        {"time": 12.0, "stage": "fuzzer_start", "duration": 2.0},
+        {"time": 40.0, "stage": "crash_detection", "duration": 0.5},
+        {"time": 45.0, "stage": "llm", "duration": 3.0},
+        {"time": 50.0, "stage": "rebuild", "duration": 1.0},
+        {"time": 52.0, "stage": "fix_outcome", "fixed": False},
+        {"time": 55.0, "stage": "llm", "duration": 3.0},
+        {"time": 60.0, "stage": "rebuild", "duration": 1.0},
+        {"time": 70.0, "stage": "fix_outcome", "fixed": True}
+    ]
+
+    assert run_benchmark.summarize_events(events) == {
+        "time_to_first_crash": 30.0,
+        "time_to_first_fix": 30.0,
+        "fixes": 1,
+        "failed_repairs": 1,
+        "builds_per_fix": 2.0,
+        "llm_calls_per_fix": 2.0
+    }
+
+
+def test_run_without_crashes_has_no_times():
+    result = run_benchmark.summarize_events([{"time": 12.0, "stage": "fuzzer_start", "duration": 2.0}])
+
+    assert (result["time_to_first_crash"], result["time_to_first_fix"], result["builds_per_fix"]) == (None, None, None)